@@ -19,7 +19,9 @@ This Image plugin module can read and write .png files if PyPNG is
 installed. See http://pypi.python.org/pypi/pypng
 """
 
+import io
 import os
+import struct
 import sys
 import warnings
 import Image
@@ -37,20 +39,48 @@ except ImportError:
 def can_load(filename):
     """Returns 100 if this module can do a lossless load, 0 if it can't
     load the file, and something inbetween if it can do a lossy load."""
-    return (80 if png is not None and
-            os.path.splitext(filename)[1].lower() == ".png" else 0)
+    return _can("load", filename)
 
 
 def can_save(filename):
     """Returns 100 if this module can do a lossless save, 0 if it can't
     save the file, and something inbetween if it can do a lossy save."""
-    return can_load(filename)
+    return _can("save", filename)
+
+
+def _can(action, filename):
+    # Even without PyPNG there may be a cyImage backend
+    available = png is not None or ("Png." + action) in Image._Backends
+    return (80 if available and
+            os.path.splitext(filename)[1].lower() == ".png" else 0)
+
+
+_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+
+def probe(image, filename):
+    """read just the width and height of a PNG file (PyPNG isn't
+    needed for this)"""
+    with open(filename, "rb") as file:
+        header = file.read(24)
+    if len(header) != 24 or header[:8] != _SIGNATURE or (header[12:16] !=
+            b"IHDR"):
+        raise Image.Error("invalid PNG file '{}'".format(filename))
+    image.width, image.height = struct.unpack(">II", header[16:24])
 
 
 if png is not None:
     def load(image, filename):
         """load a PNG file"""
-        reader = png.Reader(filename=filename)
+        _load(image, png.Reader(filename=filename))
+
+
+    def load_bytes(image, data):
+        """load a PNG image from the bytes of a PNG file"""
+        _load(image, png.Reader(bytes=data))
+
+
+    def _load(image, reader):
         image.width, image.height, pixels, _ = reader.asRGBA8()
         image.pixels = Image.create_array(image.width, image.height)
         index = 0
@@ -63,9 +93,20 @@ if png is not None:
     def save(image, filename):
         """save a PNG file"""
         with open(filename, "wb") as file:
-            writer = png.Writer(width=image.width, height=image.height,
-                    alpha=True)
-            writer.write_array(file, list(_rgba_for_pixels(image.pixels)))
+            _save(image, file)
+
+
+    def save_bytes(image, filename):
+        """returns the bytes of a PNG file of the image"""
+        file = io.BytesIO()
+        _save(image, file)
+        return file.getvalue()
+
+
+    def _save(image, file):
+        writer = png.Writer(width=image.width, height=image.height,
+                alpha=True)
+        writer.write_array(file, list(_rgba_for_pixels(image.pixels)))
 
 
     def _rgba_for_pixels(pixels):
@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+# Copyright © 2012-13 Qtrac Ltd. All rights reserved.
+# This program or module is free software: you can redistribute it
+# and/or modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version. It is provided for
+# educational purposes and is distributed in the hope that it will be
+# useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+
+"""
+    import Image
+Use the above rather than importing this module explicitly. This works
+because Image imports any modules it finds (to allow for new image
+processing modules to be added post-facto).
+
+This Image plugin module can read and write .argb files: a HEADER_SIZE
+byte header (MAGIC, VERSION, width, and height as little-endian
+uint32s) followed by the pixels, row by row, as little-endian ARGB
+uint32s. Since each pixel is at a known offset any part of an .argb
+file can be read without reading the rest (e.g., by memory mapping it;
+see imageproxy3.py). Meta data isn't stored.
+"""
+
+import os
+import struct
+import sys
+import Image
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+MAGIC = b"ARGB"
+VERSION = 1
+_HEADER = struct.Struct("<4sIII")
+HEADER_SIZE = _HEADER.size
+
+
+def can_load(filename):
+    """Returns 100 if this module can do a lossless load, 0 if it can't
+    load the file, and something inbetween if it can do a lossy load."""
+    return 100 if os.path.splitext(filename)[1].lower() == ".argb" else 0
+
+
+def can_save(filename):
+    """Returns 100 if this module can do a lossless save, 0 if it can't
+    save the file, and something inbetween if it can do a lossy save."""
+    return can_load(filename)
+
+
+def load(image, filename):
+    """load an ARGB file"""
+    with open(filename, "rb") as file:
+        load_bytes(image, file.read())
+
+
+def load_bytes(image, data):
+    """load an ARGB image from the bytes of an ARGB file"""
+    image.width, image.height = parse_header(data[:HEADER_SIZE])
+    size = image.width * image.height * 4
+    if len(data) != HEADER_SIZE + size:
+        raise Image.Error("invalid ARGB file: expected {} bytes of pixels "
+                "not {}".format(size, len(data) - HEADER_SIZE))
+    image.pixels = pixels_for_bytes(memoryview(data)[HEADER_SIZE:])
+
+
+def probe(image, filename):
+    """read just the width and height of an ARGB file"""
+    with open(filename, "rb") as file:
+        image.width, image.height = parse_header(file.read(HEADER_SIZE))
+
+
+def parse_header(data):
+    """returns the (width, height) from the header bytes of an ARGB
+    file"""
+    if len(data) < HEADER_SIZE:
+        raise Image.Error("invalid ARGB file: too short")
+    magic, version, width, height = _HEADER.unpack(data[:HEADER_SIZE])
+    if magic != MAGIC:
+        raise Image.Error("invalid ARGB file: missing '{}'".format(
+                MAGIC.decode("ascii")))
+    if version != VERSION:
+        raise Image.Error("unsupported ARGB file version {}".format(
+                version))
+    return width, height
+
+
+def header(width, height):
+    """returns the header bytes of an ARGB file"""
+    return _HEADER.pack(MAGIC, VERSION, width, height)
+
+
+def pixels_for_bytes(data):
+    """returns a pixel array (as create_array() does) of the
+    little-endian ARGB uint32s in data"""
+    if numpy is not None:
+        return numpy.frombuffer(data, dtype="<u4").astype(numpy.uint32)
+    pixels = Image.create_array(0, 0) # An array.array
+    if sys.byteorder == "little" and pixels.itemsize == 4:
+        pixels.frombytes(data)
+    else:
+        pixels.extend(value for (value,) in struct.iter_unpack("<I", data))
+    return pixels
+
+
+def bytes_for_pixels(pixels):
+    """returns the little-endian ARGB uint32 bytes of the pixels"""
+    if numpy is not None:
+        return numpy.ascontiguousarray(pixels, dtype="<u4").tobytes()
+    if sys.byteorder == "little" and pixels.itemsize == 4:
+        return pixels.tobytes()
+    return struct.pack("<{}I".format(len(pixels)), *pixels)
+
+
+def save(image, filename):
+    """save an ARGB file"""
+    with open(filename, "wb") as file:
+        file.write(header(image.width, image.height))
+        file.write(bytes_for_pixels(image.pixels))
+
+
+def save_bytes(image, filename):
+    """returns the bytes of an ARGB file of the image"""
+    return header(image.width, image.height) + bytes_for_pixels(
+            image.pixels)
@@ -51,6 +51,30 @@ _Y_HOT = b"y_hot"
 
 def load(image, filename):
     """load an XBM file"""
+    with open(filename, "rb") as file:
+        xbm = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        _load(image, xbm, filename)
+
+
+def load_bytes(image, data):
+    """load an XBM image from the bytes of an XBM file"""
+    _load(image, data, image.filename)
+
+
+def _load(image, xbm, filename):
+    i = xbm.find(_DEFINE)
+    j = xbm.find(_BITS)
+    if i == -1 or j == -1:
+        raise Image.Error("failed to parse '{}'".format(filename))
+    _parse_defines(image, xbm[i:j])
+    image.pixels = Image.create_array(image.width, image.height,
+            Image.ColorForName["white"])
+    _parse_bits(image, xbm[j + len(_BITS):])
+
+
+def probe(image, filename):
+    """read just the width and height (and hotspot if any) of an XBM
+    file"""
     with open(filename, "rb") as file:
         xbm = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
         i = xbm.find(_DEFINE)
@@ -58,9 +82,6 @@ def load(image, filename):
         if i == -1 or j == -1:
             raise Image.Error("failed to parse '{}'".format(filename))
         _parse_defines(image, xbm[i:j])
-        image.pixels = Image.create_array(image.width, image.height,
-                Image.ColorForName["white"])
-        _parse_bits(image, xbm[j + len(_BITS):])
 
 
 def _parse_defines(image, defines):
@@ -122,6 +143,14 @@ def save(image, filename):
         _write_pixels(image, file)
 
 
+def save_bytes(image, filename):
+    """returns the bytes of an XBM file of the image"""
+    file = io.StringIO()
+    _write_header(image, file, Image.sanitized_name(filename))
+    _write_pixels(image, file)
+    return file.getvalue().encode("ascii")
+
+
 def _write_header(image, file, name):
     file.write("#define {}_width {}\n".format(name, image.width))
     file.write("#define {}_height {}\n".format(name, image.height))
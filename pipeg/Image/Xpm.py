@@ -55,36 +55,69 @@ def can_save(filename):
 
 def load(image, filename):
     """load an XPM file"""
+    with open(filename, "rt", encoding="ascii") as file:
+        _load(image, file)
+
+
+def load_bytes(image, data):
+    """load an XPM image from the bytes of an XPM file"""
+    try:
+        lines = data.decode("ascii").splitlines()
+    except UnicodeDecodeError as err:
+        raise Image.Error("invalid XPM file: {}".format(err))
+    _load(image, lines)
+
+
+def _load(image, lines):
     colors = cpp = count = None
     state = _WANT_XPM
     palette = {}
     index = 0
+    for lino, line in enumerate(lines, start=1):
+        line = line.strip()
+        if not line or (line.startswith(("/*", "//")) and state !=
+                _WANT_XPM):
+            continue
+        # if branches are ordered by frequency of occurrence
+        if state == _WANT_COLOR:
+            count, state = _parse_color(lino, line, palette, cpp,
+                    count)
+            if state == _WANT_PIXELS:
+                count = image.height
+        elif state == _WANT_PIXELS:
+            count, state, index = _parse_pixels(lino, line,
+                    image.pixels, palette, cpp, count, index)
+            if state == _DONE:
+                break
+        elif state == _WANT_XPM:
+            state = _parse_xpm(lino, line)
+        elif state == _WANT_NAME:
+            state = _parse_name(lino, line)
+        elif state == _WANT_VALUES:
+            colors, cpp, count, state = _parse_values(lino, line,
+                    image)
+            image.pixels = Image.create_array(image.width,
+                    image.height)
+
+
+def probe(image, filename):
+    """read just the width and height (and hotspot if any) of an XPM
+    file"""
+    state = _WANT_XPM
     with open(filename, "rt", encoding="ascii") as file:
         for lino, line in enumerate(file, start=1):
             line = line.strip()
             if not line or (line.startswith(("/*", "//")) and state !=
                     _WANT_XPM):
                 continue
-            # if branches are ordered by frequency of occurrence
-            if state == _WANT_COLOR:
-                count, state = _parse_color(lino, line, palette, cpp,
-                        count)
-                if state == _WANT_PIXELS:
-                    count = image.height
-            elif state == _WANT_PIXELS:
-                count, state, index = _parse_pixels(lino, line,
-                        image.pixels, palette, cpp, count, index)
-                if state == _DONE:
-                    break
-            elif state == _WANT_XPM:
+            if state == _WANT_XPM:
                 state = _parse_xpm(lino, line)
             elif state == _WANT_NAME:
                 state = _parse_name(lino, line)
-            elif state == _WANT_VALUES:
-                colors, cpp, count, state = _parse_values(lino, line,
-                        image)
-                image.pixels = Image.create_array(image.width,
-                        image.height)
+            else:
+                _parse_values(lino, line, image)
+                return
+    raise Image.Error("invalid XPM file: missing values")
 
 
 def _parse_xpm(lino, line):
@@ -158,18 +191,28 @@ def _sanitize_quoted_line(lino, line):
 
 def save(image, filename):
     """save an XPM file"""
-    name = Image.sanitized_name(filename)
-    palette, cpp = _palette_and_cpp(image.pixels)
     with open(filename, "w+t", encoding="ascii") as file:
-        _write_header(image, file, name, cpp, len(palette))
-        _write_palette(file, palette)
-        _write_pixels(image, file, palette)
+        _save(image, file, Image.sanitized_name(filename))
+
+
+def save_bytes(image, filename):
+    """returns the bytes of an XPM file of the image"""
+    file = io.StringIO()
+    _save(image, file, Image.sanitized_name(filename))
+    return file.getvalue().encode("ascii")
+
+
+def _save(image, file, name):
+    palette, cpp = _palette_and_cpp(image.pixels)
+    _write_header(image, file, name, cpp, len(palette))
+    _write_palette(file, palette)
+    _write_pixels(image, file, palette)
 
 
 def _palette_and_cpp(pixels):
     colors = set()
     transparent = Image.ColorForName["transparent"]
-    for color in pixels:
+    for color in set(pixels.tolist()): # Only name each color once
         if color == transparent:
             name = "None" # special-case transparent
         else: # strip off alpha
@@ -211,11 +254,10 @@ def _write_palette(file, palette):
 
 
 def _write_pixels(image, file, palette):
+    codes = {color: code for color, (code, _) in palette.items()}
     for y in range(image.height):
-        file.write('"')
-        for x in range(image.width):
-            code = palette[image.pixel(x, y)][0]
-            file.write(code)
-        file.write('",\n')
+        row = image.pixels[y * image.width:(y + 1) * image.width]
+        file.write('"{}",\n'.format("".join(map(codes.__getitem__,
+                                                 row.tolist()))))
     file.seek(file.tell() - 2, io.SEEK_SET) # Get rid of spurious ,\n
     file.write("};\n")
@@ -0,0 +1,271 @@
+#!/usr/bin/env python3
+# Copyright © 2012-13 Qtrac Ltd. All rights reserved.
+# This program or module is free software: you can redistribute it
+# and/or modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version. It is provided for
+# educational purposes and is distributed in the hope that it will be
+# useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+
+"""
+numpy-vectorized implementations of Image operations.
+
+Image registers these as the "numpy" backend when numpy is installed
+(see Image.backend_info()); don't use this module directly. Every
+function produces exactly the same pixels as the corresponding pure
+Python implementation in Image.
+"""
+
+import numpy
+import Image
+
+
+def scale(pixels, width, height, ratio, band=None):
+    """returns the number of columns and the pixels of a smoothly scaled
+    copy of the image with the given pixels; band is an optional (first,
+    last) range of the scaled image's rows to produce
+
+    Each new pixel is the mean of the box of old pixels it covers; the
+    box sums are computed from cumulative sums along the rows and then
+    along the columns so that no Python-level loop is needed.
+    """
+    assert 0 < ratio < 1
+    columns, rows = Image.scaled_size(width, height, ratio)
+    x0, x1 = _edges(columns, width / columns, width)
+    y0, y1 = _edges(rows, height / rows, height)
+    image = as_grid(pixels, width, height)
+    if band is not None: # Only sum the old rows the band's rows cover
+        first, last = band
+        top = y0[first]
+        image = image[top:y1[last - 1]]
+        y0 = y0[first:last] - top
+        y1 = y1[first:last] - top
+        rows = last - first
+    counts = (y1 - y0)[:, numpy.newaxis] * (x1 - x0)[numpy.newaxis, :]
+    newPixels = numpy.zeros((rows, columns), dtype=numpy.uint32)
+    for shift in (24, 16, 8, 0):
+        totals = _box_sums((image >> shift) & 0xFF, x0, x1, y0, y1)
+        means = numpy.round(totals / counts).astype(numpy.uint32)
+        newPixels |= means << shift
+    return columns, newPixels.ravel()
+
+
+def _edges(count, step, limit):
+    # Python's round() and numpy.round() both round halves to even
+    starts = numpy.round(numpy.arange(count) * step)
+    ends = numpy.minimum(numpy.round(starts + step), limit)
+    return starts.astype(numpy.intp), ends.astype(numpy.intp)
+
+
+def _box_sums(channel, x0, x1, y0, y1):
+    height, width = channel.shape
+    sums = numpy.zeros((height, width + 1), dtype=numpy.uint32)
+    numpy.cumsum(channel, axis=1, out=sums[:, 1:])
+    sums = (sums[:, x1] - sums[:, x0]).astype(numpy.uint64)
+    totals = numpy.zeros((height + 1, sums.shape[1]), dtype=numpy.uint64)
+    numpy.cumsum(sums, axis=0, out=totals[1:])
+    return totals[y1] - totals[y0]
+
+
+def subsample(pixels, width, height, stride):
+    """returns the number of columns and the pixels of a subsampled copy
+    of the image with the given pixels"""
+    columns = width // stride
+    rows = height // stride
+    image = as_grid(pixels, width, height)
+    return columns, image[:rows * stride:stride,
+                          :columns * stride:stride].ravel()
+
+
+def as_grid(pixels, width, height):
+    """returns a height x width numpy.uint32 view of the given pixels"""
+    return numpy.asarray(pixels, dtype=numpy.uint32).reshape(height, width)
+
+
+def composite(pixels, width, other, otherWidth, x0, y0, x1, y1, x, y,
+        mode):
+    """returns the pixels with the (x0, y0, x1, y1) rectangle blended
+    with the pixels of other whose top-left corner is at (x, y)
+
+    Each channel is split out into a numpy.uint32 array and the same
+    integer arithmetic as Image's pure Python implementation is done on
+    the whole rectangle at once.
+    """
+    pixels = numpy.asarray(pixels, dtype=numpy.uint32)
+    image = pixels.reshape(-1, width)
+    otherImage = as_grid(other, otherWidth, len(other) // otherWidth)
+    destination = image[y0:y1, x0:x1]
+    source = otherImage[y0 - y:y1 - y, x0 - x:x1 - x]
+    sα = source >> 24
+    dα = destination >> 24
+    weight = _div255(dα * (0xFF - sα))
+    α = sα + weight
+    divisor = numpy.maximum(α, 1) # Where α is 0 so are the numerators
+    newPixels = α << 24
+    for shift in (16, 8, 0):
+        s = (source >> shift) & 0xFF
+        d = (destination >> shift) & 0xFF
+        if mode == "multiply":
+            blended = _div255(s * d)
+        elif mode == "screen":
+            blended = s + d - _div255(s * d)
+        elif mode == "add":
+            blended = numpy.minimum(s + d, 0xFF)
+        else:
+            blended = s
+        s = _div255((0xFF - dα) * s + dα * blended)
+        newPixels |= ((s * sα + d * weight + α // 2) // divisor) << shift
+    destination[...] = newPixels
+    return pixels
+
+
+def diff(pixels, other, width, height):
+    """returns the (mask, box, count, error) of Image.diff() for the two
+    images' pixels; only the differing pixels' channels are compared"""
+    pixels = as_grid(pixels, width, height)
+    other = as_grid(other, width, height)
+    mask = pixels != other
+    rows = numpy.flatnonzero(mask.any(axis=1))
+    if not len(rows):
+        return mask.ravel(), None, 0, 0
+    columns = numpy.flatnonzero(mask.any(axis=0))
+    box = (int(columns[0]), int(rows[0]), int(columns[-1]), int(rows[-1]))
+    a = pixels[mask].view(numpy.uint8).astype(numpy.int16)
+    b = other[mask].view(numpy.uint8).astype(numpy.int16)
+    return (mask.ravel(), box, int(numpy.count_nonzero(mask)),
+            int(numpy.abs(a - b).max()))
+
+
+def _div255(values):
+    values = values + 128
+    return (values + (values >> 8)) >> 8
+
+
+def filter(pixels, width, height, kernel, edge, stride):
+    """returns the number of columns and the pixels of a copy of the
+    image with the given pixels convolved with the kernel (see
+    Image.Image.filter())
+
+    The pixels are viewed as a height x width x 4 array of bytes so that
+    all four channels are filtered at once: for a separable kernel by
+    one weighted sum of whole rows per kernel row followed by one of
+    whole columns per kernel column, and otherwise by one weighted sum
+    of shifted planes per weight. The sums are 32-bit unless the weights
+    are so big that they might overflow, and the column sums of a
+    separable kernel 16-bit if they can't.
+    """
+    columns = width // stride
+    rows = height // stride
+    image = as_grid(pixels, width, height)
+    channels = image.view(numpy.uint8).reshape(height, width, 4)
+    rowTaps = _taps(rows, stride, len(kernel.weights), height, edge)
+    columnTaps = _taps(columns, stride, len(kernel.weights[0]), width,
+            edge)
+    dtype = (numpy.int32 if 0xFF * sum(sum(abs(weight) for weight in row)
+             for row in kernel.weights) < 2 ** 31 else numpy.int64)
+    if kernel.vertical is not None:
+        sumsType = (numpy.int16 if 0xFF * sum(abs(weight) for weight in
+                    kernel.vertical) < 2 ** 15 else dtype)
+        sums = numpy.zeros((rows, width, 4), dtype=sumsType)
+        for weight, taps in zip(kernel.vertical, rowTaps.T):
+            if weight:
+                sums += channels[taps].astype(sumsType) * weight
+        totals = numpy.zeros((rows, columns, 4), dtype=dtype)
+        for weight, taps in zip(kernel.horizontal, columnTaps.T):
+            if weight:
+                totals += numpy.take(sums, taps, axis=1).astype(
+                        dtype) * weight
+    else:
+        totals = numpy.zeros((rows, columns, 4), dtype=dtype)
+        for weights, ys in zip(kernel.weights, rowTaps.T):
+            band = channels[ys].astype(dtype)
+            for weight, xs in zip(weights, columnTaps.T):
+                if weight:
+                    totals += band[:, xs] * weight
+    totals += kernel.divisor // 2
+    totals //= kernel.divisor
+    totals += kernel.offset
+    newChannels = numpy.clip(totals, 0, 0xFF).astype(numpy.uint8)
+    newPixels = newChannels.view(numpy.uint32).reshape(rows, columns)
+    if not sum(sum(row) for row in kernel.weights): # Keep the alpha
+        newPixels &= 0x00FFFFFF
+        newPixels |= image[:rows * stride:stride,
+                           :columns * stride:stride] & 0xFF000000
+    return columns, newPixels.ravel()
+
+
+def _taps(count, stride, size, limit, edge):
+    # A count x size array of the old indexes each new index's kernel
+    # covers, with those beyond the edges replaced as Image._edge_index()
+    radius = size // 2
+    indexes = (numpy.arange(count)[:, numpy.newaxis] * stride +
+               numpy.arange(-radius, radius + 1)[numpy.newaxis, :])
+    if edge == "wrap":
+        return indexes % limit
+    if edge == "mirror" and limit > 1:
+        period = 2 * (limit - 1)
+        indexes = numpy.abs(indexes) % period
+        return numpy.where(indexes >= limit, period - indexes, indexes)
+    return numpy.clip(indexes, 0, limit - 1)
+
+
+_SHIFTS = (16, 8, 0, 24) # As Image._SHIFTS
+
+
+def quantize(pixels, maxColors):
+    """returns pixels if they have at most maxColors colors or new pixels
+    that do, chosen by median cut exactly as Image's pure Python
+    implementation does
+
+    The histogram is made by numpy.unique() and each box holds the
+    indexes of its colors so that measuring, sorting, and splitting a
+    box are all vectorized.
+    """
+    pixels = numpy.asarray(pixels, dtype=numpy.uint32)
+    opaque = (pixels >> 24) != 0
+    colors, inverse, counts = numpy.unique(pixels[opaque],
+            return_inverse=True, return_counts=True)
+    transparents = not opaque.all()
+    if len(colors) + transparents <= maxColors:
+        return pixels
+    channels = {shift: ((colors >> shift) & 0xFF).astype(numpy.int64)
+                for shift in _SHIFTS}
+    counts = counts.astype(numpy.int64)
+    boxes = [_box(numpy.arange(len(colors)), channels, counts)]
+    while len(boxes) < maxColors - transparents:
+        i = max(range(len(boxes)), key=lambda i: (boxes[i][0], -i))
+        _, shift, box = boxes[i]
+        if shift is None: # Every box has only one color
+            break
+        box = box[numpy.argsort(channels[shift][box], kind="stable")]
+        running = numpy.cumsum(counts[box])
+        split = int(numpy.searchsorted(2 * running, running[-1])) + 1
+        split = min(split, len(box) - 1)
+        boxes[i:i + 1] = [_box(box[:split], channels, counts),
+                          _box(box[split:], channels, counts)]
+    palette = numpy.zeros(len(colors), dtype=numpy.uint32)
+    for _, _, box in boxes:
+        total = counts[box].sum()
+        mean = 0
+        for shift in _SHIFTS:
+            channel = (channels[shift][box] * counts[box]).sum()
+            mean |= int((2 * channel + total) // (2 * total)) << shift
+        palette[box] = mean
+    newPixels = numpy.zeros_like(pixels) # Transparent
+    newPixels[opaque] = palette[inverse.ravel()]
+    return newPixels
+
+
+def _box(box, channels, counts):
+    # As Image._box() but box holds indexes into the colors
+    best = (0, None)
+    if len(box) > 1:
+        count = int(counts[box].sum())
+        for shift in _SHIFTS:
+            values = channels[shift][box]
+            score = int(values.max() - values.min()) * count
+            if score > best[0]:
+                best = (score, shift)
+    return best + (box,)
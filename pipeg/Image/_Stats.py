@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+# Copyright © 2012-13 Qtrac Ltd. All rights reserved.
+# This program or module is free software: you can redistribute it
+# and/or modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version. It is provided for
+# educational purposes and is distributed in the hope that it will be
+# useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+
+"""
+Counters and timers for Image's hot paths.
+
+Image records how many times each operation (load, _choose_module,
+scale, subsample, composite, filter, quantize, diff, save) is called,
+how long it takes, and how many pixels and bytes it handles; don't use
+this module directly, use the functions Image exports (instrumented(),
+stats(), merge_stats(), dump_stats(), and format_stats()).
+
+Recording is off by default and costs a single test per operation when
+off. Turn it on by setting the IMAGE_STATS environment variable (to
+anything other than "" or "0") or for a block of code using the
+instrumented() context manager. Each process keeps its own totals; to
+aggregate across processes have each worker return stats(reset=True)
+with its results and merge_stats() them in the parent.
+"""
+
+import contextlib
+import json
+import os
+import threading
+import time
+
+
+ENV = "IMAGE_STATS"
+FIELDS = ("count", "seconds", "pixels", "bytes")
+
+Enabled = os.environ.get(ENV, "0") not in {"", "0"}
+_Totals = {} # operation: [count, seconds, pixels, bytes]
+_Lock = threading.Lock() # Threads share the totals
+
+
+def start():
+    """returns a start time if recording is on, otherwise None"""
+    return time.perf_counter() if Enabled else None
+
+
+def record(operation, start, pixels=0, bytes=0):
+    """adds a call of operation that began at start and handled the
+    given number of pixels and bytes to the totals"""
+    seconds = time.perf_counter() - start
+    with _Lock:
+        totals = _Totals.get(operation)
+        if totals is None:
+            totals = _Totals[operation] = [0, 0.0, 0, 0]
+        totals[0] += 1
+        totals[1] += seconds
+        totals[2] += pixels
+        totals[3] += bytes
+
+
+def enable(on=True):
+    """turns recording on or off in this process and in any processes
+    it starts afterwards"""
+    global Enabled
+    Enabled = on
+    os.environ[ENV] = "1" if on else "0"
+
+
+@contextlib.contextmanager
+def instrumented(on=True):
+    """records stats (or doesn't, if on is False) within a with block,
+    and restores the previous setting after it"""
+    previous = os.environ.get(ENV)
+    wasEnabled = Enabled
+    enable(on)
+    try:
+        yield
+    finally:
+        enable(wasEnabled)
+        if previous is None:
+            del os.environ[ENV]
+        else:
+            os.environ[ENV] = previous
+
+
+def stats(reset=False):
+    """returns a snapshot of this process's totals as a JSON-compatible
+    dict of operation: {"count": int, "seconds": float, "pixels": int,
+    "bytes": int}, and zeroes the totals if reset is True"""
+    with _Lock:
+        snapshot = {operation: dict(zip(FIELDS, totals))
+                    for operation, totals in _Totals.items()}
+        if reset:
+            _Totals.clear()
+    return snapshot
+
+
+def merge_stats(snapshot):
+    """adds a snapshot (e.g., one returned by a worker process) to this
+    process's totals"""
+    if not snapshot:
+        return
+    with _Lock:
+        for operation, values in snapshot.items():
+            totals = _Totals.get(operation)
+            if totals is None:
+                totals = _Totals[operation] = [0, 0.0, 0, 0]
+            for i, field in enumerate(FIELDS):
+                totals[i] += values.get(field, 0)
+
+
+def dump_stats(filename, snapshot=None):
+    """writes the snapshot (or this process's totals) to the named file
+    as JSON"""
+    if snapshot is None:
+        snapshot = stats()
+    with open(filename, "wt", encoding="utf-8") as file:
+        json.dump(snapshot, file, indent=2, sort_keys=True)
+
+
+def format_stats(snapshot=None):
+    """returns a table (as a str) with a line per operation showing its
+    calls, total and mean time, and throughput"""
+    if snapshot is None:
+        snapshot = stats()
+    lines = ["{:<15} {:>7} {:>10} {:>10} {:>9} {:>9}".format("stage",
+             "calls", "total sec", "mean ms", "MPixel/s", "MB/s")]
+    for operation in sorted(snapshot, key=lambda operation:
+            -snapshot[operation]["seconds"]):
+        values = snapshot[operation]
+        seconds = values["seconds"]
+        count = values["count"]
+        lines.append("{:<15} {:>7} {:>10.3f} {:>10.3f} {:>9} {:>9}".format(
+                operation, count, seconds,
+                (seconds * 1000 / count) if count else 0,
+                _rate(values["pixels"], seconds),
+                _rate(values["bytes"], seconds)))
+    return "\n".join(lines)
+
+
+def _rate(amount, seconds):
+    if not amount or not seconds:
+        return "-"
+    return "{:.2f}".format(amount / seconds / 1e6)
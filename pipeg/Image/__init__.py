@@ -27,35 +27,71 @@ filename) functions. If you want to override an existing module (e.g.,
 Xbm.py, just create a new one, say, Xbm2.py, and make sure its
 can_load() and can_save() functions return higher values than the Xpm.py
 module. (All standard modules return 100 or less for what they can and 0
-for what they can't.)
+for what they can't.) Modules may also provide a probe(image, filename)
+function that sets just the image's width and height (and meta), ideally
+by reading only the file's header; see probe(). And they may provide
+load_bytes(image, data) and save_bytes(image, filename) functions that
+decode from and return the bytes of a file (filename is used only for
+any name the format stores) so that images can be decoded and encoded
+without touching the disk; see from_bytes() and Image.to_bytes().
 
 Rather than creating Images directly, use one of the construction
-functions, create(), from_file(), or from_data().
+functions, create(), from_file(), from_bytes(), or from_data(); to
+load lots of images concurrently use load_many().
+
+Some operations have more than one implementation (backend): the
+always available pure Python one, a numpy-vectorized one if numpy is
+installed, and a Cython one if cyImage has been built. For each
+operation the fastest available backend is used; this can be overridden
+by setting the IMAGE_BACKEND environment variable, e.g., to "python" to
+use pure Python throughout, or to "scale=numpy,Xpm.load=python" to
+choose backends for particular operations. Call backend_info() to see
+which backend is used for each operation.
+
+The time spent in and the pixels and bytes handled by load(), save(),
+scale(), subsample(), composite(), filter(), quantize(), diff(), and module
+choice can be recorded by setting the IMAGE_STATS environment variable
+or within a "with instrumented():" block; call stats() to get the
+totals or format_stats() for a table.
 
 For sophisticated image processing install numpy _and_ scipy and use
 the scipy image processing functions.
 """
 
 import collections
+import concurrent.futures
+import copy
+import functools
+import hashlib
 import importlib
+import math
 import os
 import re
 import sys
+import tempfile
+import types
 import warnings
+import weakref
 try:
     import numpy
 except ImportError:
     numpy = None
     import array
+from Image import _Stats
 
 
 CLEAR_ALPHA = 0x00FFFFFF # & to ARGB color int to get rid of alpha channel
 MAX_ARGB = 0xFFFFFFFF
 MAX_COMPONENT = 0xFF
 SOLID = 0xFF000000 # + to RGB color int to get a solid ARGB color int
+PROGRESS_PIXELS = 65536 # Default work between scale() progress calls
+COMPOSITE_MODES = ("over", "multiply", "screen", "add")
+EDGES = ("clamp", "mirror", "wrap") # How filter() extends the edges
+LOAD_MODES = ("thread", "process") # Where load_many() decodes
 
 
 class Error(Exception): pass
+class Canceled(Error): pass
 
 
 _Modules = []
@@ -72,8 +108,11 @@ del name, module
 
 class Image:
 
+    _share = None # The images sharing this one's pixels; see clone()
+
+
     def __init__(self, width=None, height=None, filename=None,
-            background=None, pixels=None):
+            background=None, pixels=None, data=None):
         """Create Images using one of the convenience construction
         functions: from_file(), create(), and from_data()
         
@@ -81,7 +120,9 @@ class Image:
         changed except in load() methods."""
         assert (width is not None and (height is not None or
                 pixels is not None) or (filename is not None))
-        if filename is not None: # From file
+        if data is not None: # From a file's bytes
+            self.load_bytes(data, filename)
+        elif filename is not None: # From file
             self.load(filename)
         elif pixels is not None: # From data
             self.width = width
@@ -102,6 +143,11 @@ class Image:
         return Class(filename=filename)
 
 
+    @classmethod
+    def from_bytes(Class, data, filename):
+        return Class(filename=filename, data=data)
+
+
     @classmethod
     def create(Class, width, height, background=None):
         return Class(width=width, height=height, background=background)
@@ -115,34 +161,105 @@ class Image:
     def load(self, filename):
         """loads the image from the file called filename; the format is
         determined by the file suffix"""
+        start = _Stats.start()
         module = Image._choose_module("can_load", filename)
         if module is not None:
+            self._unshare(keep=False)
             self.width = self.height = None
             self.meta = {}
-            module.load(self, filename)
+            _codec(module, "load")(self, filename)
             self.filename = filename
+            if start is not None:
+                _Stats.record("load", start, self.width * self.height,
+                        os.path.getsize(filename))
         else:
             raise Error("no Image module can load files of type {}".format(
                     os.path.splitext(filename)[1]))
 
 
-    def save(self, filename=None):
+    def save(self, filename=None, max_colors=None):
         """saves the image to a file called filename; the format is
-        determined by the file suffix"""
+        determined by the file suffix
+
+        If max_colors is given the image is saved as if quantize()d to
+        at most that many colors (this image is unchanged); this makes
+        formats that have a palette (e.g., XPM) much smaller and quicker
+        to write for photographs."""
         filename = filename if filename is not None else self.filename
         if not filename:
             raise Error("can't save without a filename")
+        start = _Stats.start()
         module = Image._choose_module("can_save", filename)
         if module is not None:
-            module.save(self, filename)
+            image = self if max_colors is None else self.quantize(
+                    max_colors)
+            _codec(module, "save")(image, filename)
             self.filename = filename
+            if start is not None:
+                _Stats.record("save", start, self.width * self.height,
+                        os.path.getsize(filename))
         else:
             raise Error("no Image module can save files of type {}".format(
                     os.path.splitext(filename)[1]))
 
 
+    def load_bytes(self, data, filename):
+        """loads the image from data, the bytes of a file called
+        filename; the format is determined by the filename's suffix and
+        the file isn't read"""
+        start = _Stats.start()
+        module = Image._choose_module("can_load", filename)
+        if module is None:
+            raise Error("no Image module can load files of type {}".format(
+                    os.path.splitext(filename)[1]))
+        self._unshare(keep=False)
+        self.width = self.height = None
+        self.meta = {}
+        self.filename = filename
+        if hasattr(module, "load_bytes"):
+            module.load_bytes(self, data)
+        else: # Go via a temporary file
+            with tempfile.TemporaryDirectory() as directory:
+                name = os.path.join(directory, os.path.basename(filename))
+                with open(name, "wb") as file:
+                    file.write(data)
+                _codec(module, "load")(self, name)
+            self.filename = filename
+        if start is not None:
+            _Stats.record("load", start, self.width * self.height,
+                    len(data))
+
+
+    def to_bytes(self, filename=None, max_colors=None):
+        """returns the bytes of the file that save(filename, max_colors)
+        would write without writing it; the format is determined by the
+        filename's suffix"""
+        filename = filename if filename is not None else self.filename
+        if not filename:
+            raise Error("can't choose a format without a filename")
+        start = _Stats.start()
+        module = Image._choose_module("can_save", filename)
+        if module is None:
+            raise Error("no Image module can save files of type {}".format(
+                    os.path.splitext(filename)[1]))
+        image = self if max_colors is None else self.quantize(max_colors)
+        if hasattr(module, "save_bytes"):
+            data = module.save_bytes(image, filename)
+        else: # Go via a temporary file
+            with tempfile.TemporaryDirectory() as directory:
+                name = os.path.join(directory, os.path.basename(filename))
+                _codec(module, "save")(image, name)
+                with open(name, "rb") as file:
+                    data = file.read()
+        if start is not None:
+            _Stats.record("save", start, self.width * self.height,
+                    len(data))
+        return data
+
+
     @staticmethod
     def _choose_module(actionName, filename):
+        start = _Stats.start()
         bestRating = 0
         bestModule = None
         for module in _Modules:
@@ -152,9 +269,47 @@ class Image:
                 if rating > bestRating:
                     bestRating = rating
                     bestModule = module
+        if start is not None:
+            _Stats.record("_choose_module", start)
         return bestModule
 
 
+    def clone(self, cow=True):
+        """returns a copy of this image (with its own copy of meta)
+
+        If cow is True the copy shares this image's pixels until either
+        of them is changed by set_pixel(), line(), rectangle(),
+        ellipse(), composite(), load(), or load_bytes(), and only then
+        is the changed one given its own pixels (copy on write). So
+        rendering many variants of a template costs one copy per variant
+        that is drawn on and none for those that aren't. Code that
+        changes .pixels directly bypasses this and must only do so on
+        an image from clone(cow=False) or one that was never cloned.
+        """
+        if cow:
+            image = self.from_data(self.width, self.pixels)
+            if self._share is None: # Images are unhashable so use ids
+                self._share = weakref.WeakValueDictionary({id(self): self})
+            self._share[id(image)] = image
+            image._share = self._share
+        else:
+            image = self.from_data(self.width, copy.copy(self.pixels))
+        image.filename = self.filename
+        image.meta = self.meta.copy()
+        return image
+
+
+    def _unshare(self, keep=True):
+        """stops sharing pixels with other images (see clone()), copying
+        them if they are to be kept and another image still uses them"""
+        share = self._share
+        if share is not None:
+            self._share = None
+            share.pop(id(self), None)
+            if keep and share:
+                self.pixels = copy.copy(self.pixels)
+
+
     def pixel(self, x, y):
         """returns the color at the given pixel as an ARGB int; x and y
         must be in range"""
@@ -164,30 +319,18 @@ class Image:
     def set_pixel(self, x, y, color):
         """sets the given pixel to the given color; x and y must be in
         range; color must be an ARGB int"""
+        if self._share is not None:
+            self._unshare()
         self.pixels[(y * self.width) + x] = color
 
 
-    # Bresenham's mid-point line scanning algorithm from 
-    # http://en.wikipedia.org/wiki/Bresenham%27s_line_algorithm 
     def line(self, x0, y0, x1, y1, color):
         """draws the line in the given color; the coordinates must be in
         range; the color must be an ARGB int"""
-        Δx = abs(x1 - x0)
-        Δy = abs(y1 - y0)
-        xInc = 1 if x0 < x1 else -1
-        yInc = 1 if y0 < y1 else -1
-        δ = Δx - Δy
-        while True:
-            self.set_pixel(x0, y0, color)
-            if x0 == x1 and y0 == y1:
-                break
-            δ2 = 2 * δ
-            if δ2 > -Δy:
-                δ -= Δy
-                x0 += xInc
-            if δ2 < Δx:
-                δ += Δx
-                y0 += yInc
+        if self._share is not None:
+            self._unshare()
+        self.pixels = backend("line")[1](self.pixels, self.width,
+                self.height, x0, y0, x1, y1, color)
 
 
     def rectangle(self, x0, y0, x1, y1, outline=None, fill=None):
@@ -197,21 +340,10 @@ class Image:
         the coordinates must be in range; the outline and fill colors
         must be ARGB ints"""
         assert outline is not None or fill is not None
-        if fill is not None:
-            if y0 > y1:
-                y0, y1 = y1, y0
-            if outline is not None: # no point drawing over the outline
-                x0 += 1
-                x1 -= 1
-                y0 += 1
-                y1 -= 1
-            for y in range(y0, y1 + 1):
-                self.line(x0, y, x1, y, fill)
-        if outline is not None:
-            self.line(x0, y0, x1, y0, outline)
-            self.line(x1, y0, x1, y1, outline)
-            self.line(x1, y1, x0, y1, outline)
-            self.line(x0, y1, x0, y0, outline)
+        if self._share is not None:
+            self._unshare()
+        self.pixels = backend("rectangle")[1](self.pixels, self.width,
+                self.height, x0, y0, x1, y1, outline, fill)
 
 
     def ellipse(self, x0, y0, x1, y1, outline=None, fill=None):
@@ -221,77 +353,102 @@ class Image:
         the coordinates must be in range; the outline and fill colors
         must be ARGB ints"""
         assert outline is not None or fill is not None
-        if x0 > x1:
-            x0, x1 = x1, x0
-        if y0 > y1:
-            y0, y1 = y1, y0
-        width = x1 - x0
-        height = y1 - y0
-        if fill is not None:
-            # Algorithm based on
-            # http://stackoverflow.com/questions/10322341/
-            # simple-algorithm-for-drawing-filled-ellipse-in-c-c
-            halfWidth = width // 2
-            halfHeight = height // 2
-            midX = x0 + halfWidth
-            midY = y0 + halfHeight
-            for y in range(-halfHeight, halfHeight + 1):
-                for x in range(-halfWidth, halfWidth + 1):
-                    Δx =  x / halfWidth
-                    Δy =  y / halfHeight
-                    if ((Δx * Δx) + (Δy * Δy)) <= 1:
-                        self.set_pixel(int(round(midX + x)),
-                                       int(round(midY + y)), fill)
-        if outline is not None:
-            # Midpoint ellipse algorithm from "Computer Graphics
-            # Principles and Practice".
-            if x1 > x0:
-                midX = ((x1 - x0) // 2) + x0
-            else:
-                midX = ((x0 - x1) // 2) + x1
-            if y1 > y0:
-                midY = ((y1 - y0) // 2) + y0
-            else:
-                midY = ((y0 - y1) // 2) + y1
-
-            def ellipse_point(Δx, Δy):
-                # Δx is always an int; Δy is always a float
-                self.set_pixel(midX + Δx, int(round(midY + Δy)), outline)
-                self.set_pixel(midX - Δx, int(round(midY - Δy)), outline)
-                self.set_pixel(midX + Δx, int(round(midY - Δy)), outline)
-                self.set_pixel(midX - Δx, int(round(midY + Δy)), outline)
-
-            a = abs(x1 - x0) / 2
-            b = abs(y1 - y0) / 2
-            a2 = a ** 2
-            b2 = b ** 2
-            Δx = 0
-            Δy = b
-            p = b2 - (a2 * b) + (a2 / 4)
-            ellipse_point(Δx, Δy)
-            while (a2 * (Δy - 0.5)) > (b2 * (Δx + 1)):
-                if p < 0:
-                    p += b2 * ((2 * Δx) + 3)
-                    Δx += 1
-                else:
-                    p += (b2 * ((2 * Δx) + 3)) + (a2 * ((-2 * Δy) + 2))
-                    Δx += 1
-                    Δy -= 1
-                ellipse_point(Δx, Δy)
-            p = ((b2 * ((Δx + 0.5) ** 2)) + (a2 * ((Δy - 1) ** 2)) -
-                 (a2 * b2))
-            while Δy > 0:
-                if p < 0:
-                    p += (b2 * ((2 * Δx) + 2)) + (a2 * ((-2 * Δy) + 3))
-                    Δx += 1
-                    Δy -= 1
-                else:
-                    p += a2 * ((-2 * Δy) + 3)
-                    Δy -= 1
-                ellipse_point(Δx, Δy)
+        if self._share is not None:
+            self._unshare()
+        self.pixels = backend("ellipse")[1](self.pixels, self.width,
+                self.height, x0, y0, x1, y1, outline, fill)
+
+
+    def composite(self, other, x, y, mode="over"):
+        """blends the other image onto this one with its top-left corner
+        at (x, y); the parts of other that fall outside this image are
+        ignored so x and y may be out of range
+
+        mode is one of COMPOSITE_MODES. "over" is Porter-Duff source
+        over using other's alpha; "multiply" (darkens), "screen"
+        (lightens), and "add" (lightens, clipping at white) combine each
+        of other's color channels with the one beneath it and then blend
+        the result over this image in the same way, so a transparent
+        pixel of other never changes this image. All the arithmetic is
+        done on integers so every backend produces exactly the same
+        pixels.
+        """
+        if mode not in COMPOSITE_MODES:
+            raise Error("unknown composite mode {}".format(mode))
+        x0 = max(0, x)
+        y0 = max(0, y)
+        x1 = min(self.width, x + other.width)
+        y1 = min(self.height, y + other.height)
+        if x0 >= x1 or y0 >= y1:
+            return
+        start = _Stats.start()
+        self._unshare() # Some backends blend in place
+        self.pixels = backend("composite")[1](self.pixels, self.width,
+                other.pixels, other.width, x0, y0, x1, y1, x, y, mode)
+        if start is not None:
+            _Stats.record("composite", start, (x1 - x0) * (y1 - y0))
+
+
+    def filter(self, kernel, edge="clamp", stride=1):
+        """returns a copy of this image convolved with the given Kernel
+        (see kernel(), gaussian(), box(), SHARPEN, SOBEL_X, and
+        SOBEL_Y)
+
+        edge is one of EDGES and says which pixels stand in for those
+        beyond the image's edges: "clamp" repeats the edge pixels,
+        "mirror" reflects the image about its edge pixels, and "wrap"
+        uses those from the opposite edge.
+
+        If stride is more than 1 only every stride-th row and column is
+        produced, giving the same pixels as filter(kernel, edge)
+        .subsample(stride) in a fraction of the time; blurring with a
+        kernel about stride wide (e.g., box(stride // 2)) first avoids
+        the aliasing that plain subsampling suffers from. Whether this
+        is faster than scale() depends on the backend: for an 800x600
+        image, box(2) at stride 4 took about a quarter of scale(0.25)'s
+        time with numpy, about two thirds with cyImage, but half as long
+        again in pure Python.
+
+        Kernels whose weights sum to 0 (e.g., SOBEL_X) detect changes so
+        leave the alpha channel unchanged; others filter it too.
+        """
+        if edge not in EDGES:
+            raise Error("unknown filter edge {}".format(edge))
+        assert (1 <= stride <= min(self.width, self.height) and
+                isinstance(stride, int))
+        start = _Stats.start()
+        columns, pixels = backend("filter")[1](self.pixels, self.width,
+                self.height, kernel, edge, stride)
+        if start is not None:
+            _Stats.record("filter", start, self.width * self.height)
+        return self.from_data(columns, pixels)
+
 
+    def quantize(self, max_colors):
+        """returns a copy of this image that uses at most max_colors
+        colors (or this image itself if it already does)
 
-    def subsample(self, stride):
+        The colors are chosen by median cut: starting with a box that
+        holds all the image's colors, the box with the most pixels times
+        color range is repeatedly split at the median pixel of its
+        widest channel, until there are max_colors boxes; each pixel
+        then gets the mean color of its box. Fully transparent pixels
+        all become "transparent" (which counts as one of the colors).
+        """
+        assert max_colors >= 2
+        start = _Stats.start()
+        pixels = backend("quantize")[1](self.pixels, max_colors)
+        if start is not None:
+            _Stats.record("quantize", start, self.width * self.height)
+        if pixels is self.pixels:
+            return self
+        image = self.from_data(self.width, pixels)
+        image.filename = self.filename
+        image.meta = self.meta.copy()
+        return image
+
+
+    def subsample(self, stride, band=None):
         """returns a subsampled copy of this image.
         
         stride should be at least 2 but not too big; a stride of 2
@@ -300,24 +457,28 @@ class Image:
 
         Subsampling is fairly fast and produces good results for
         photographs: but poor results for text for which scale() is best.
+
+        If band is given it is a (first, last) range of the subsampled
+        image's rows and only these rows are produced (see scale()).
         """
         assert (2 <= stride <= min(self.width // 2, self.height // 2) and
                 isinstance(stride, int))
-        pixels = create_array(self.width // stride, self.height // stride)
-        index = 0
-        height = self.height - (self.height % stride)
-        width = self.width - (self.width % stride)
-        for y in range(0, height, stride):
-            offset = y * self.width
-            for x in range(0, width, stride):
-                if index == len(pixels):
-                    break
-                pixels[index] = self.pixels[offset + x]
-                index += 1
-        return self.from_data(self.width // stride, pixels)
-
-
-    def scale(self, ratio):
+        start = _Stats.start()
+        pixels = self.pixels
+        height = self.height
+        if band is not None:
+            first, last = band
+            pixels = pixels[first * stride * self.width:
+                            last * stride * self.width]
+            height = (last - first) * stride
+        columns, pixels = backend("subsample")[1](pixels, self.width,
+                height, stride)
+        if start is not None:
+            _Stats.record("subsample", start, self.width * height)
+        return self.from_data(columns, pixels)
+
+
+    def scale(self, ratio, band=None, progress=None, every=None):
         """returns a smoothly scaled copy of this image
 
         ratio is how much to scale by, e.g., 0.75 means reduce width and
@@ -326,45 +487,59 @@ class Image:
 
         Scaling is slow but produces good results even for text;
         subsample() is faster.
+
+        If band is given it is a (first, last) range of the scaled
+        image's rows and only these rows are produced; the rows of
+        consecutive bands make up exactly the image that scaling all at
+        once would produce, so a big image can be scaled in pieces.
+
+        If progress is given it is called as progress(done, total) with
+        the number of rows produced so far and in all, before any rows
+        are scaled and then after every every rows (by default, enough
+        rows to cover about PROGRESS_PIXELS of this image's pixels); if
+        it returns a true value scaling stops and Canceled is raised.
+        (progress may also raise an exception of its own.) The rows are
+        scaled by the backend in bands of every rows, so its inner loops
+        aren't slowed.
         """
         assert 0 < ratio < 1
-        rows = round(self.height * ratio)
-        columns = round(self.width * ratio)
-        pixels = create_array(columns, rows)
-        yStep = self.height / rows
-        xStep = self.width / columns
-        index = 0
-        for row in range(rows):
-            y0 = round(row * yStep)
-            y1 = round(y0 + yStep)
-            for column in range(columns):
-                x0 = round(column * xStep)
-                x1 = round(x0 + xStep)
-                pixels[index] = self._mean(x0, y0, x1, y1)
-                index += 1
+        start = _Stats.start()
+        function = backend("scale")[1]
+        if progress is None:
+            arguments = (self.pixels, self.width, self.height, ratio)
+            if band is not None: # Backends need not support bands else
+                arguments += (band,)
+            columns, pixels = function(*arguments)
+        elif getattr(function, "progress", False): # Calls progress itself
+            columns, pixels = function(self.pixels, self.width,
+                    self.height, ratio, band, progress, every)
+        else:
+            columns, pixels = self._scale_in_bands(function, ratio, band,
+                    progress, every)
+        if start is not None:
+            _Stats.record("scale", start, self.width * self.height)
         return self.from_data(columns, pixels)
 
 
-    def _mean(self, x0, y0, x1, y1):
-        αTotal, redTotal, greenTotal, blueTotal, count = 0, 0, 0, 0, 0
-        for y in range(y0, y1):
-            if y >= self.height:
-                break
-            offset = y * self.width
-            for x in range(x0, x1):
-                if x >= self.width:
-                    break
-                α, r, g, b = self.argb_for_color(self.pixels[offset + x])
-                αTotal += α
-                redTotal += r
-                greenTotal += g
-                blueTotal += b
-                count += 1
-        α = round(αTotal / count)
-        r = round(redTotal / count)
-        g = round(greenTotal / count)
-        b = round(blueTotal / count)
-        return self.color_for_argb(α, r, g, b)
+    def _scale_in_bands(self, scale, ratio, band, progress, every):
+        columns, rows = scaled_size(self.width, self.height, ratio)
+        first, last = band if band is not None else (0, rows)
+        total = last - first
+        pixels = create_array(columns, total)
+        if every is None: # Each scaled row covers width / ratio pixels
+            every = round(PROGRESS_PIXELS * ratio / self.width)
+        every = max(1, every)
+        for top in range(first, last, every):
+            if progress(top - first, total):
+                raise Canceled("scaling canceled")
+            bottom = min(top + every, last)
+            _, rows = scale(self.pixels, self.width, self.height, ratio,
+                    (top, bottom))
+            offset = (top - first) * columns
+            pixels[offset:offset + len(rows)] = rows
+        if progress(total, total):
+            raise Canceled("scaling canceled")
+        return columns, pixels
 
 
     def __str__(self):
@@ -376,6 +551,31 @@ class Image:
         return s
 
 
+    def __eq__(self, other):
+        """returns True if other is an Image of the same size with the
+        same pixels (filenames and meta are ignored); the pixels are
+        compared as raw buffers and only if the sizes match"""
+        if not isinstance(other, Image):
+            return NotImplemented
+        if self.width != other.width or self.height != other.height:
+            return False
+        return _same(self.pixels, other.pixels)
+
+
+    __hash__ = None # Images are mutable
+
+
+    def checksum(self):
+        """returns a hex SHA-256 digest of the image's size and pixels
+        (as little-endian 32-bit ARGB values) so equal images have equal
+        checksums whichever backend and platform produced them, e.g.,
+        to compare with a golden set without loading its images"""
+        digest = hashlib.sha256("{}x{}:".format(self.width,
+                self.height).encode("ascii"))
+        digest.update(_little_endian(self.pixels))
+        return digest.hexdigest()
+
+
     @property
     def size(self):
         """Convenience method to return the image's size"""
@@ -470,12 +670,23 @@ class Image:
 
 
 # Convenience functions
+create = Image.create
+from_file = Image.from_file
+from_bytes = Image.from_bytes
+from_data = Image.from_data
 argb_for_color = Image.argb_for_color
 rgb_for_color = Image.rgb_for_color
 color_for_argb = Image.color_for_argb
 color_for_rgb = Image.color_for_rgb
 color_for_name = Image.color_for_name
 
+# Instrumentation (see _Stats.py)
+instrumented = _Stats.instrumented
+stats = _Stats.stats
+merge_stats = _Stats.merge_stats
+dump_stats = _Stats.dump_stats
+format_stats = _Stats.format_stats
+
 
 def sanitized_name(name):
     """returns a name suitable for XBM and XPM images"""
@@ -502,6 +713,814 @@ def create_array(width, height, background=None):
         return array.array(typecode, [background] * width * height)
 
 
+def load_many(filenames, workers=None, mode="thread", ordered=True,
+        prefetch=None, on_error=None):
+    """returns an iterator of the Images loaded from the named files,
+    loading up to workers (default: the number of CPUs) at a time
+
+    If mode is "thread" each file is read and decoded in a thread,
+    which suits slow storage and codecs that release the GIL (e.g.,
+    cyImage's). If mode is "process" the files are read in threads and
+    decoded in as many processes, which suits pure Python and other
+    CPU-bound codecs. The images are produced in the order of filenames
+    if ordered is True, otherwise as soon as each is loaded. At most
+    prefetch (default: 2 × workers) images are loading or loaded but not
+    yet taken from the iterator, so memory use is bounded however many
+    filenames there are (filenames may be a lazy iterable).
+
+    A file that can't be loaded (e.g., because it is missing or
+    corrupt) doesn't stop the others: if on_error is given it is called
+    as on_error(filename, error) (and may raise to stop the iteration),
+    otherwise the error (an Error, EnvironmentError, or other Exception)
+    is produced by the iterator in that image's place.
+    """
+    if mode not in LOAD_MODES:
+        raise Error("unknown load mode {}".format(mode))
+    workers = workers or os.cpu_count() or 1
+    prefetch = max(workers, prefetch or 2 * workers)
+    return _load_many(iter(filenames), workers, mode, ordered, prefetch,
+            on_error)
+
+
+def _load_many(filenames, workers, mode, ordered, prefetch, on_error):
+    # pending holds (future, filename)s in order, or is a dict of them
+    pending = collections.deque() if ordered else {}
+    processes = None
+    with concurrent.futures.ThreadPoolExecutor(workers) as threads:
+        try:
+            if mode == "process":
+                processes = concurrent.futures.ProcessPoolExecutor(workers)
+                load = functools.partial(_read_and_decode, processes)
+            else:
+                load = Image.from_file
+            for filename in filenames:
+                future = threads.submit(load, filename)
+                if ordered:
+                    pending.append((future, filename))
+                else:
+                    pending[future] = filename
+                while len(pending) >= prefetch:
+                    yield from _loaded(pending, ordered, on_error)
+            while pending:
+                yield from _loaded(pending, ordered, on_error)
+        finally: # E.g., on_error raised or the caller stopped early
+            for future in (pending if not ordered else
+                           (future for future, _ in pending)):
+                future.cancel()
+            if processes is not None:
+                processes.shutdown()
+
+
+def _loaded(pending, ordered, on_error):
+    if ordered:
+        loaded = [pending.popleft()]
+    else:
+        done, _ = concurrent.futures.wait(pending,
+                return_when=concurrent.futures.FIRST_COMPLETED)
+        loaded = [(future, pending.pop(future)) for future in done]
+    for future, filename in loaded:
+        try:
+            image = future.result()
+        except Exception as err:
+            if on_error is None:
+                yield err
+            else:
+                on_error(filename, err)
+            continue
+        yield image
+
+
+def _read_and_decode(processes, filename):
+    with open(filename, "rb") as file:
+        data = file.read()
+    image, snapshot = processes.submit(_decode, data, filename).result()
+    _Stats.merge_stats(snapshot)
+    return image
+
+
+def _decode(data, filename):
+    # Runs in a worker process so returns its stats to be merged
+    return Image.from_bytes(data, filename), _Stats.stats(reset=True)
+
+
+def probe(filename):
+    """returns the (width, height) of the image in the named file
+    reading as little of the file as its Image module allows"""
+    module = Image._choose_module("can_load", filename)
+    if module is None:
+        raise Error("no Image module can load files of type {}".format(
+                os.path.splitext(filename)[1]))
+    if not hasattr(module, "probe"):
+        image = Image.from_file(filename)
+        return image.width, image.height
+    image = types.SimpleNamespace(width=None, height=None, meta={},
+            filename=filename)
+    module.probe(image, filename)
+    return image.width, image.height
+
+
+def scaled_size(width, height, ratio):
+    """returns the (width, height) that an image of the given width and
+    height has once scale()d by ratio; every scale() backend produces
+    this size, rounding halves to even"""
+    return round(width * ratio), round(height * ratio)
+
+
+Diff = collections.namedtuple("Diff", "mask box count error")
+Diff.__doc__ = """How two same-sized images differ; see diff()
+
+mask has one truth value per pixel (in the same order as the pixels)
+which is true where the images differ: a numpy bool array if numpy is
+installed, otherwise a bytearray of 0s and 1s. box is the (x0, y0, x1,
+y1) of the smallest rectangle (including its edges) that holds every
+differing pixel, or None if there are none. count is how many pixels
+differ and error is the largest difference between the images' values
+for any one channel (0-255)."""
+
+
+def diff(a, b):
+    """returns a Diff saying which pixels of Images a and b differ and
+    by how much; raises Error if their sizes differ"""
+    if a.width != b.width or a.height != b.height:
+        raise Error("can't diff a {}x{} image with a {}x{} one".format(
+                a.width, a.height, b.width, b.height))
+    start = _Stats.start()
+    mask, box, count, error = backend("diff")[1](a.pixels, b.pixels,
+            a.width, a.height)
+    if start is not None:
+        _Stats.record("diff", start, a.width * a.height)
+    return Diff(mask, box, count, error)
+
+
+def _same(pixels, other):
+    if numpy is not None:
+        return bool(numpy.array_equal(pixels, other))
+    pixels = memoryview(pixels)
+    other = memoryview(other)
+    if pixels.format != other.format: # e.g., "I" and "L"
+        return pixels.tolist() == other.tolist()
+    return pixels.cast("B") == other.cast("B")
+
+
+def _fill(pixels, start, end, color):
+    if numpy is not None and isinstance(pixels, numpy.ndarray):
+        pixels[start:end] = color
+    else:
+        pixels[start:end] = type(pixels)(pixels.typecode, (color,)) * (
+                end - start) # An array.array
+
+
+# The drawing backends change the pixels in place and return them; the
+# coordinates must be in range.
+
+# Bresenham's mid-point line scanning algorithm from 
+# http://en.wikipedia.org/wiki/Bresenham%27s_line_algorithm 
+def _line(pixels, width, height, x0, y0, x1, y1, color):
+    if y0 == y1: # A span (e.g., of a filled rectangle): fill it at once
+        start = (y0 * width) + min(x0, x1)
+        _fill(pixels, start, start + abs(x1 - x0) + 1, color)
+        return pixels
+    Δx = abs(x1 - x0)
+    Δy = abs(y1 - y0)
+    xInc = 1 if x0 < x1 else -1
+    yInc = 1 if y0 < y1 else -1
+    δ = Δx - Δy
+    while True:
+        pixels[(y0 * width) + x0] = color
+        if x0 == x1 and y0 == y1:
+            break
+        δ2 = 2 * δ
+        if δ2 > -Δy:
+            δ -= Δy
+            x0 += xInc
+        if δ2 < Δx:
+            δ += Δx
+            y0 += yInc
+    return pixels
+
+
+def _rectangle(pixels, width, height, x0, y0, x1, y1, outline=None,
+        fill=None):
+    if fill is not None:
+        if y0 > y1:
+            y0, y1 = y1, y0
+        if outline is not None: # no point drawing over the outline
+            x0 += 1
+            x1 -= 1
+            y0 += 1
+            y1 -= 1
+        for y in range(y0, y1 + 1):
+            _line(pixels, width, height, x0, y, x1, y, fill)
+    if outline is not None:
+        _line(pixels, width, height, x0, y0, x1, y0, outline)
+        _line(pixels, width, height, x1, y0, x1, y1, outline)
+        _line(pixels, width, height, x1, y1, x0, y1, outline)
+        _line(pixels, width, height, x0, y1, x0, y0, outline)
+    return pixels
+
+
+def _ellipse(pixels, width, height, x0, y0, x1, y1, outline=None,
+        fill=None):
+    if x0 > x1:
+        x0, x1 = x1, x0
+    if y0 > y1:
+        y0, y1 = y1, y0
+    if fill is not None:
+        # Algorithm based on
+        # http://stackoverflow.com/questions/10322341/
+        # simple-algorithm-for-drawing-filled-ellipse-in-c-c
+        halfWidth = (x1 - x0) // 2
+        halfHeight = (y1 - y0) // 2
+        midX = x0 + halfWidth
+        midY = y0 + halfHeight
+        for y in range(-halfHeight, halfHeight + 1):
+            for x in range(-halfWidth, halfWidth + 1):
+                Δx =  x / halfWidth
+                Δy =  y / halfHeight
+                if ((Δx * Δx) + (Δy * Δy)) <= 1:
+                    pixels[(int(round(midY + y)) * width) +
+                           int(round(midX + x))] = fill
+    if outline is not None:
+        # Midpoint ellipse algorithm from "Computer Graphics
+        # Principles and Practice".
+        if x1 > x0:
+            midX = ((x1 - x0) // 2) + x0
+        else:
+            midX = ((x0 - x1) // 2) + x1
+        if y1 > y0:
+            midY = ((y1 - y0) // 2) + y0
+        else:
+            midY = ((y0 - y1) // 2) + y1
+
+        def ellipse_point(Δx, Δy):
+            # Δx is always an int; Δy is always a float
+            for x, y in ((midX + Δx, midY + Δy), (midX - Δx, midY - Δy),
+                         (midX + Δx, midY - Δy), (midX - Δx, midY + Δy)):
+                pixels[(int(round(y)) * width) + x] = outline
+
+        a = abs(x1 - x0) / 2
+        b = abs(y1 - y0) / 2
+        a2 = a ** 2
+        b2 = b ** 2
+        Δx = 0
+        Δy = b
+        p = b2 - (a2 * b) + (a2 / 4)
+        ellipse_point(Δx, Δy)
+        while (a2 * (Δy - 0.5)) > (b2 * (Δx + 1)):
+            if p < 0:
+                p += b2 * ((2 * Δx) + 3)
+                Δx += 1
+            else:
+                p += (b2 * ((2 * Δx) + 3)) + (a2 * ((-2 * Δy) + 2))
+                Δx += 1
+                Δy -= 1
+            ellipse_point(Δx, Δy)
+        p = ((b2 * ((Δx + 0.5) ** 2)) + (a2 * ((Δy - 1) ** 2)) -
+             (a2 * b2))
+        while Δy > 0:
+            if p < 0:
+                p += (b2 * ((2 * Δx) + 2)) + (a2 * ((-2 * Δy) + 3))
+                Δx += 1
+                Δy -= 1
+            else:
+                p += a2 * ((-2 * Δy) + 3)
+                Δy -= 1
+            ellipse_point(Δx, Δy)
+    return pixels
+
+
+def _little_endian(pixels):
+    """returns the pixels as a buffer of little-endian uint32s"""
+    if numpy is not None:
+        return numpy.ascontiguousarray(pixels, dtype="<u4").data
+    if pixels.itemsize != 4 or sys.byteorder != "little":
+        pixels = array.array("I" if array.array("I").itemsize == 4 else
+                             "L", pixels)
+        if sys.byteorder != "little":
+            pixels.byteswap()
+    return memoryview(pixels).cast("B")
+
+
+Kernel = collections.namedtuple("Kernel",
+        "weights divisor offset vertical horizontal")
+Kernel.__doc__ = """A convolution kernel for Image.filter(); create
+Kernels using kernel(), gaussian(), or box()
+
+Each new channel value is the sum of the weights times the old values
+around it, divided by the divisor (rounding to nearest) and added to the
+offset, then limited to 0-255. vertical and horizontal are the integer
+column and row vectors whose outer product is weights if the kernel is
+separable (which makes filtering much faster), or None."""
+
+
+def kernel(weights, divisor=None, offset=0):
+    """returns a Kernel for the given weights, a sequence of equal
+    length sequences of ints (with an odd number of each); the divisor
+    defaults to the sum of the weights (or 1 if that's not positive)"""
+    weights = tuple(tuple(int(weight) for weight in row)
+                    for row in weights)
+    if (not weights or len(weights) % 2 == 0 or len(weights[0]) % 2 == 0
+            or any(len(row) != len(weights[0]) for row in weights)):
+        raise Error("kernel weights must be an odd-sized rectangle")
+    if divisor is None:
+        divisor = sum(sum(row) for row in weights)
+        if divisor <= 0:
+            divisor = 1
+    if divisor <= 0:
+        raise Error("kernel divisor must be positive")
+    vertical, horizontal = _separate(weights)
+    return Kernel(weights, divisor, offset, vertical, horizontal)
+
+
+def _separate(weights):
+    """returns (vertical, horizontal) integer vectors whose outer
+    product is weights or (None, None) if there aren't any"""
+    for first in weights:
+        if any(first):
+            break
+    else:
+        return None, None
+    divisor = 0
+    for weight in first:
+        divisor = math.gcd(divisor, weight)
+    horizontal = tuple(weight // divisor for weight in first)
+    column = next(i for i, weight in enumerate(horizontal) if weight)
+    vertical = []
+    for row in weights:
+        factor, remainder = divmod(row[column], horizontal[column])
+        if remainder or any(weight != factor * base
+                            for weight, base in zip(row, horizontal)):
+            return None, None
+        vertical.append(factor)
+    return tuple(vertical), horizontal
+
+
+def gaussian(radius, sigma=None):
+    """returns a separable Gaussian blur Kernel (2 × radius + 1)
+    square; sigma defaults to half the radius
+
+    The weights of each row and column sum to about 128: this is ample
+    precision for 8-bit channels and lets the faster backends sum in
+    16 bits."""
+    assert radius >= 1
+    if sigma is None:
+        sigma = radius / 2
+    weights = [math.exp(-(i * i) / (2 * sigma * sigma))
+               for i in range(-radius, radius + 1)]
+    total = sum(weights)
+    weights = [max(1, round(128 * weight / total)) for weight in weights]
+    return kernel([[a * b for b in weights] for a in weights])
+
+
+def box(radius):
+    """returns a separable box blur Kernel (2 × radius + 1) square: each
+    new pixel is the mean of those around it"""
+    assert radius >= 1
+    size = 2 * radius + 1
+    return kernel([[1] * size] * size)
+
+
+SHARPEN = kernel(((0, -1, 0), (-1, 5, -1), (0, -1, 0)))
+# Signed horizontal and vertical gradients; no change is mid-gray
+SOBEL_X = kernel(((-1, 0, 1), (-2, 0, 2), (-1, 0, 1)), offset=128)
+SOBEL_Y = kernel(((-1, -2, -1), (0, 0, 0), (1, 2, 1)), offset=128)
+
+
+def _subsample(pixels, width, height, stride):
+    """the pure Python subsample() backend"""
+    columns = width // stride
+    newPixels = create_array(columns, height // stride)
+    index = 0
+    height = height - (height % stride)
+    for y in range(0, height, stride):
+        offset = y * width
+        for x in range(0, columns * stride, stride):
+            if index == len(newPixels):
+                break
+            newPixels[index] = pixels[offset + x]
+            index += 1
+    return columns, newPixels
+
+
+def _scale(pixels, width, height, ratio, band=None):
+    """the pure Python scale() backend; band is an optional (first,
+    last) range of the scaled image's rows to produce"""
+    columns, rows = scaled_size(width, height, ratio)
+    first, last = band if band is not None else (0, rows)
+    newPixels = create_array(columns, last - first)
+    yStep = height / rows
+    xStep = width / columns
+    index = 0
+    for row in range(first, last):
+        y0 = round(row * yStep)
+        y1 = round(y0 + yStep)
+        for column in range(columns):
+            x0 = round(column * xStep)
+            x1 = round(x0 + xStep)
+            newPixels[index] = _mean(pixels, width, height, x0, y0, x1, y1)
+            index += 1
+    return columns, newPixels
+
+
+def _mean(pixels, width, height, x0, y0, x1, y1):
+    αTotal, redTotal, greenTotal, blueTotal, count = 0, 0, 0, 0, 0
+    for y in range(y0, y1):
+        if y >= height:
+            break
+        offset = y * width
+        for x in range(x0, x1):
+            if x >= width:
+                break
+            α, r, g, b = argb_for_color(pixels[offset + x])
+            αTotal += α
+            redTotal += r
+            greenTotal += g
+            blueTotal += b
+            count += 1
+    α = round(αTotal / count)
+    r = round(redTotal / count)
+    g = round(greenTotal / count)
+    b = round(blueTotal / count)
+    return color_for_argb(α, r, g, b)
+
+
+def _composite(pixels, width, other, otherWidth, x0, y0, x1, y1, x, y,
+        mode):
+    """the pure Python composite() backend; blends the (x0, y0, x1, y1)
+    rectangle of pixels with the pixels of other whose top-left corner
+    is at (x, y) and returns the pixels (changed in place)"""
+    blend = _Blends[mode]
+    for row in range(y0, y1):
+        offset = row * width
+        otherOffset = (row - y) * otherWidth - x
+        for column in range(x0, x1):
+            pixels[offset + column] = _composite_pixel(
+                    other[otherOffset + column], pixels[offset + column],
+                    blend)
+    return pixels
+
+
+def _composite_pixel(source, destination, blend):
+    sα = source >> 24
+    dα = destination >> 24
+    weight = _div255(dα * (MAX_COMPONENT - sα)) # Of the destination
+    α = sα + weight
+    if not α:
+        return 0
+    color = α << 24
+    for shift in (16, 8, 0):
+        s = (source >> shift) & MAX_COMPONENT
+        d = (destination >> shift) & MAX_COMPONENT
+        # Where the destination is transparent the source is unblended
+        s = _div255((MAX_COMPONENT - dα) * s + dα * blend(s, d))
+        color |= ((s * sα + d * weight + α // 2) // α) << shift
+    return color
+
+
+def _filter(pixels, width, height, kernel, edge, stride):
+    """the pure Python filter() backend"""
+    columns = width // stride
+    rows = height // stride
+    newPixels = create_array(columns, rows)
+    rowTaps = _taps(rows, stride, len(kernel.weights), height, edge)
+    columnTaps = _taps(columns, stride, len(kernel.weights[0]), width,
+            edge)
+    keepAlpha = not sum(sum(row) for row in kernel.weights)
+    shifts = (16, 8, 0) if keepAlpha else (24, 16, 8, 0)
+    index = 0
+    for row in range(rows):
+        if kernel.vertical is not None:
+            # Sum each column over the kernel's height then sum those
+            sums = {shift: [0] * width for shift in shifts}
+            for weight, y in zip(kernel.vertical, rowTaps[row]):
+                if weight:
+                    offset = y * width
+                    for x in range(width):
+                        pixel = int(pixels[offset + x]) # Not numpy's
+                        for shift in shifts:
+                            sums[shift][x] += weight * ((pixel >> shift) &
+                                                        MAX_COMPONENT)
+        for column in range(columns):
+            color = (pixels[row * stride * width + column * stride] &
+                     0xFF000000) if keepAlpha else 0
+            for shift in shifts:
+                if kernel.vertical is not None:
+                    channel = sums[shift]
+                    total = sum(weight * channel[x] for weight, x in
+                                zip(kernel.horizontal, columnTaps[column]))
+                else:
+                    total = 0
+                    for weights, y in zip(kernel.weights, rowTaps[row]):
+                        offset = y * width
+                        for weight, x in zip(weights, columnTaps[column]):
+                            total += weight * ((int(pixels[offset + x])
+                                                >> shift) & MAX_COMPONENT)
+                value = ((total + kernel.divisor // 2) // kernel.divisor +
+                         kernel.offset)
+                color |= min(MAX_COMPONENT, max(0, value)) << shift
+            newPixels[index] = color
+            index += 1
+    return columns, newPixels
+
+
+def _taps(count, stride, size, limit, edge):
+    """returns for each of the count new rows (or columns) the indexes
+    of the size old ones its kernel covers, replacing those beyond the
+    old image's limit according to edge"""
+    radius = size // 2
+    return [[_edge_index(i * stride + δ, limit, edge)
+             for δ in range(-radius, radius + 1)] for i in range(count)]
+
+
+def _edge_index(index, limit, edge):
+    if 0 <= index < limit:
+        return index
+    if edge == "wrap":
+        return index % limit
+    if edge == "mirror" and limit > 1:
+        period = 2 * (limit - 1)
+        index = abs(index) % period
+        return period - index if index >= limit else index
+    return 0 if index < 0 else limit - 1
+
+
+def _quantize(pixels, maxColors):
+    """the pure Python quantize() backend; returns pixels if they have
+    at most maxColors colors or new pixels that do"""
+    transparent = ColorForName["transparent"]
+    histogram = collections.Counter(int(color) for color in pixels
+                                    if color >> 24)
+    transparents = len(pixels) - sum(histogram.values())
+    if len(histogram) + bool(transparents) <= maxColors:
+        return pixels
+    boxes = [_box(sorted(histogram), histogram)] # (score, shift, colors)
+    while len(boxes) < maxColors - bool(transparents):
+        i = max(range(len(boxes)), key=lambda i: (boxes[i][0], -i))
+        _, shift, box = boxes[i]
+        if shift is None: # Every box has only one color
+            break
+        box = sorted(box, key=lambda color: (color >> shift) & 0xFF)
+        boxes[i:i + 1] = [_box(half, histogram) for half in
+                          _split(box, [histogram[color] for color in box])]
+    palette = {}
+    for _, _, box in boxes:
+        total = sum(histogram[color] for color in box)
+        mean = 0
+        for shift in _SHIFTS:
+            channel = sum(((color >> shift) & 0xFF) * histogram[color]
+                          for color in box)
+            mean |= ((2 * channel + total) // (2 * total)) << shift
+        for color in box:
+            palette[color] = mean
+    newPixels = create_array(len(pixels), 1)
+    for i, color in enumerate(pixels):
+        newPixels[i] = palette.get(color, transparent)
+    return newPixels
+
+
+_SHIFTS = (16, 8, 0, 24) # Red, green, blue, alpha: ties split in order
+
+
+def _box(colors, histogram):
+    """returns a median cut box of colors as a (score, shift, colors)
+    triple where score is the box's pixel count times the range of its
+    widest channel and shift is that channel's (None if there's only
+    one color)"""
+    best = (0, None)
+    if len(colors) > 1:
+        count = sum(histogram[color] for color in colors)
+        for shift in _SHIFTS:
+            values = [(color >> shift) & 0xFF for color in colors]
+            score = (max(values) - min(values)) * count
+            if score > best[0]:
+                best = (score, shift)
+    return best + (colors,)
+
+
+def _split(box, counts):
+    """returns the box (sorted by the channel to split on) split into two
+    at the median of the counts; neither half is empty"""
+    total = sum(counts)
+    running = 0
+    for i, count in enumerate(counts):
+        running += count
+        if 2 * running >= total:
+            break
+    i = min(i + 1, len(box) - 1)
+    return box[:i], box[i:]
+
+
+def _diff(pixels, other, width, height):
+    mask = bytearray(width * height)
+    x0 = y0 = x1 = y1 = None
+    count = error = 0
+    rows = memoryview(pixels)
+    otherRows = memoryview(other)
+    if rows.format != otherRows.format:
+        rows, otherRows = pixels, other
+    for y in range(height):
+        offset = y * width
+        if (rows[offset:offset + width] ==
+                otherRows[offset:offset + width]):
+            continue # Compare whole rows as buffers; most are the same
+        for x in range(width):
+            p = int(pixels[offset + x])
+            q = int(other[offset + x])
+            if p != q:
+                mask[offset + x] = 1
+                count += 1
+                if x0 is None or x < x0:
+                    x0 = x
+                if x1 is None or x > x1:
+                    x1 = x
+                for shift in (24, 16, 8, 0):
+                    error = max(error, abs(((p >> shift) & 0xFF) -
+                                           ((q >> shift) & 0xFF)))
+        if y0 is None:
+            y0 = y
+        y1 = y
+    box = (x0, y0, x1, y1) if count else None
+    return mask, box, count, error
+
+
+def _div255(value):
+    """returns round(value / 255) for 0 <= value <= 255 * 255 without
+    division, rounding halves up"""
+    value += 128
+    return (value + (value >> 8)) >> 8
+
+
+_Blends = {"over": lambda s, d: s,
+           "multiply": lambda s, d: _div255(s * d),
+           "screen": lambda s, d: s + d - _div255(s * d),
+           "add": lambda s, d: min(MAX_COMPONENT, s + d)}
+
+
+# Backends are ranked by speed: a backend is only used if it is the
+# fastest one registered for its operation or if it is chosen using the
+# IMAGE_BACKEND environment variable.
+PYTHON, NUMPY, CYIMAGE = "python", "numpy", "cyimage"
+_Speed = {PYTHON: 0, NUMPY: 10, CYIMAGE: 20}
+_Backends = collections.defaultdict(dict) # operation: {name: function}
+_Chosen = {} # operation: (name, function); a cache
+
+
+def register_backend(operation, name, function, speed=None):
+    """registers function as the implementation called name of the
+    given operation, e.g., "scale", "subsample", or a codec operation
+    such as "Xpm.load"
+
+    The function must accept the same arguments and return the same
+    result as the other implementations of the operation. If speed is
+    None the speed for a known name (python, numpy, cyimage) is used."""
+    if speed is None:
+        speed = _Speed.get(name, 0)
+    _Backends[operation][name] = (speed, function)
+    _Chosen.pop(operation, None)
+
+
+def backend(operation, name=None):
+    """returns the (name, function) of the backend to use for the given
+    operation, or of the backend with the given name if name is not
+    None; raises KeyError if there is no such backend"""
+    if name is not None:
+        return name, _Backends.get(operation, {})[name][1]
+    chosen = _Chosen.get(operation)
+    if chosen is None:
+        backends = _Backends.get(operation)
+        if not backends:
+            raise KeyError("no backend for {}".format(operation))
+        name = _Overrides.get(operation, _Overrides.get(None))
+        if name not in backends:
+            if name is not None and operation in _Overrides:
+                warnings.warn("{} backend {} is unavailable".format(
+                        operation, name))
+            name = max(backends, key=lambda name: backends[name][0])
+        chosen = _Chosen[operation] = (name, backends[name][1])
+    return chosen
+
+
+def backends(operation):
+    """returns the names of the backends registered for the given
+    operation, fastest first"""
+    candidates = _Backends.get(operation, {})
+    return sorted(candidates, key=lambda name: candidates[name][0],
+            reverse=True)
+
+
+def backend_info():
+    """returns a dict whose keys are operations (plus "storage") and
+    whose values are the names of the backends used for them, e.g., to
+    log which code paths are in use"""
+    info = {"storage": "numpy" if numpy is not None else "array"}
+    for operation in sorted(_Backends):
+        info[operation] = backend(operation)[0]
+    return info
+
+
+def _codec(module, action):
+    """returns the function to use for the given Image module's action,
+    i.e., load or save"""
+    operation = "{}.{}".format(module.__name__.rsplit(".", 1)[-1], action)
+    if operation in _Backends:
+        return backend(operation)[1]
+    return getattr(module, action)
+
+
+def _parse_overrides(text):
+    """returns a dict of operation: backend name from a string such as
+    "cyimage" or "python,scale=numpy"; the None key is for the backend
+    to use for all operations not otherwise specified"""
+    overrides = {}
+    for item in text.replace(" ", "").split(","):
+        if item:
+            operation, _, name = item.rpartition("=")
+            overrides[operation or None] = name.lower()
+    return overrides
+_Overrides = _parse_overrides(os.environ.get("IMAGE_BACKEND", ""))
+
+
+def _register_backends():
+    register_backend("scale", PYTHON, _scale)
+    register_backend("subsample", PYTHON, _subsample)
+    register_backend("composite", PYTHON, _composite)
+    register_backend("filter", PYTHON, _filter)
+    register_backend("quantize", PYTHON, _quantize)
+    register_backend("diff", PYTHON, _diff)
+    register_backend("line", PYTHON, _line)
+    register_backend("rectangle", PYTHON, _rectangle)
+    register_backend("ellipse", PYTHON, _ellipse)
+    for module in _Modules:
+        for action in ("load", "save"):
+            function = getattr(module, action, None)
+            if function is not None:
+                register_backend("{}.{}".format(
+                        module.__name__.rsplit(".", 1)[-1], action), PYTHON,
+                        function)
+    if numpy is not None:
+        from Image import _Numpy
+        register_backend("scale", NUMPY, _Numpy.scale)
+        register_backend("subsample", NUMPY, _Numpy.subsample)
+        register_backend("composite", NUMPY, _Numpy.composite)
+        register_backend("filter", NUMPY, _Numpy.filter)
+        register_backend("quantize", NUMPY, _Numpy.quantize)
+        register_backend("diff", NUMPY, _Numpy.diff)
+    try:
+        import cyImage.cyImage._Composite as cyComposite
+        import cyImage.cyImage._Draw as cyDraw
+        import cyImage.cyImage._Filter as cyFilter
+        import cyImage.cyImage._Scale as cyScale
+        import cyImage.Globals
+    except ImportError:
+        return # cyImage hasn't been built
+    def scale(pixels, width, height, ratio, band=None, progress=None,
+            every=None):
+        first, last = band if band is not None else (0, -1)
+        try:
+            columns, pixels = cyScale.scale(pixels, width, height, ratio,
+                    0, first, last, progress, every or 0)
+        except cyImage.Globals.Canceled as err:
+            raise Canceled(str(err)) from err
+        return columns, numpy.asarray(pixels)
+    scale.progress = True # Between its parallel loops; see Image.scale()
+    register_backend("scale", CYIMAGE, scale)
+    def composite(pixels, width, other, otherWidth, x0, y0, x1, y1, x, y,
+            mode):
+        pixels = numpy.asarray(pixels, dtype=numpy.uint32)
+        cyComposite.composite(pixels, width, numpy.asarray(other,
+                dtype=numpy.uint32), otherWidth, x0, y0, x1, y1, x, y, mode)
+        return pixels
+    register_backend("composite", CYIMAGE, composite)
+    def filter(pixels, width, height, kernel, edge, stride):
+        columns, pixels = cyFilter.filter(numpy.asarray(pixels,
+                dtype=numpy.uint32), width, height, kernel, edge, stride)
+        return columns, numpy.asarray(pixels)
+    register_backend("filter", CYIMAGE, filter)
+    def drawer(function):
+        def draw(pixels, width, height, *args, **kwargs):
+            pixels = numpy.asarray(pixels, dtype=numpy.uint32)
+            function(pixels, width, height, *args, **kwargs)
+            return pixels
+        return draw
+    for name in ("line", "rectangle", "ellipse"):
+        register_backend(name, CYIMAGE, drawer(getattr(cyDraw, name)))
+    for name in ("Png", "Xbm", "Xpm"):
+        module = importlib.import_module("cyImage.cyImage." + name)
+        for action in ("load", "save"):
+            register_backend("{}.{}".format(name, action), CYIMAGE,
+                    _cyimage_codec(getattr(module, action),
+                                   cyImage.Globals.Error))
+
+
+def _cyimage_codec(function, cyError):
+    def codec(image, filename):
+        try:
+            function(image, filename)
+        except cyError as err: # Callers expect Image.Error
+            raise Error(str(err)) from err
+    return codec
+
+
 # Taken from rgb.txt and converted to ARGB (with the addition of
 # transparent). Default is solid black.
 ColorForName = collections.defaultdict(lambda: 0xFF000000, {
@@ -771,3 +1790,6 @@ ColorForName = collections.defaultdict(lambda: 0xFF000000, {
     "white": 0xFFFFFFFF, "whitesmoke": 0xFFF5F5F5, "yellow": 0xFFFFFF00,
     "yellow1": 0xFFFFFF00, "yellow2": 0xFFEEEE00, "yellow3": 0xFFCDCD00,
     "yellow4": 0xFF8B8B00, "yellowgreen": 0xFF9ACD32})
+
+
+_register_backends()
@@ -0,0 +1,586 @@
+#!/usr/bin/env python3
+# Copyright © 2012-13 Qtrac Ltd. All rights reserved.
+# This program or module is free software: you can redistribute it
+# and/or modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version. It is provided for
+# educational purposes and is distributed in the hope that it will be
+# useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+
+"""
+Job creation shared by the imagescale-*.py programs.
+"""
+
+import collections
+import heapq
+import json
+import math
+import os
+import tempfile
+import threading
+import time
+import Image
+import Qtrac
+
+
+def get_jobs(source, target, manifest=None):
+    """yields a (sourceImage, targetImage) pair for each file in the
+    source directory and its subdirectories, creating the matching
+    target subdirectories as needed; if there is a manifest only files
+    that have changed since they were last scaled are yielded
+
+    The tree is walked lazily, a directory at a time, so memory use
+    doesn't depend on the number of files.
+    """
+    root = target
+    directories = [(source, target, "")]
+    while directories:
+        source, target, prefix = directories.pop()
+        made = os.path.isdir(target)
+        subdirectories = []
+        with os.scandir(source) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    if entry.path != root: # target may be inside source
+                        subdirectories.append(entry.name)
+                    continue
+                if manifest is not None and manifest.is_current(
+                        prefix + entry.name, entry.stat()):
+                    continue
+                if not made:
+                    os.makedirs(target, exist_ok=True)
+                    made = True
+                yield entry.path, os.path.join(target, entry.name)
+        for name in reversed(sorted(subdirectories)):
+            directories.append((os.path.join(source, name),
+                    os.path.join(target, name),
+                    prefix + name + os.sep))
+    if manifest is not None:
+        manifest.scanned = True
+
+
+def largest_first(jobs, lookahead=0):
+    """yields the (sourceImage, targetImage) jobs largest (by pixel
+    count) first so that big images don't start last and hold up the
+    end of a run
+
+    If lookahead is 0 all the jobs are read (and their headers probed)
+    before any are yielded; otherwise at most lookahead jobs are held
+    at once, which keeps memory use bounded but only approximates
+    largest first.
+    """
+    heap = []
+    for i, job in enumerate(jobs): # i keeps equal-sized jobs in order
+        heapq.heappush(heap, (-pixel_count(job[0]), i, job))
+        if lookahead and len(heap) > lookahead:
+            yield heapq.heappop(heap)[-1]
+    while heap:
+        yield heapq.heappop(heap)[-1]
+
+
+def pixel_count(filename):
+    """returns the named image's pixel count from its header, or 0 if
+    it can't be read"""
+    try:
+        width, height = Image.probe(filename)
+        return width * height
+    except (EnvironmentError, ValueError, Image.Error):
+        return 0
+
+
+def bands_for(size, smooth, sourceImage, count, minimum):
+    """returns a list of (first, last) row ranges that divide the
+    scaled image into count bands, or None if the source image has
+    fewer than minimum pixels or doesn't need scaling
+
+    The bands can be passed to Image.scale() or Image.subsample() by
+    separate processes, and the resulting rows joined with
+    join_rows().
+    """
+    try:
+        width, height = Image.probe(sourceImage)
+    except (EnvironmentError, ValueError, Image.Error):
+        return None
+    if width * height < minimum or (width <= size and height <= size):
+        return None
+    rows = scaled_size(size, smooth, width, height)[1]
+    count = min(count, rows)
+    if count < 2:
+        return None
+    cuts = [round(i * rows / count) for i in range(count + 1)]
+    return list(zip(cuts, cuts[1:]))
+
+
+def scaled_size(size, smooth, width, height):
+    """returns the (width, height) that an image of the given width and
+    height will have once scaled (or subsampled if not smooth) to fit
+    size"""
+    if width <= size and height <= size:
+        return width, height
+    if smooth:
+        return Image.scaled_size(width, height, min(size / width,
+                size / height))
+    stride = int(math.ceil(max(width / size, height / size)))
+    return width // stride, height // stride
+
+
+def join_rows(parts):
+    """returns the pixels of the given bands' pixels joined in order"""
+    if hasattr(parts[0], "typecode"): # array.array
+        pixels = parts[0][:]
+        for part in parts[1:]:
+            pixels.extend(part)
+        return pixels
+    import numpy
+    return numpy.concatenate(parts)
+
+
+class Manifest:
+    """Records each source image's modification time and size, and the
+    scaling parameters, for the files that have been scaled into a
+    target directory so that later runs need only scale new or changed
+    files.
+
+    Files that are still current are trusted: delete the manifest
+    (FILENAME in the target directory) to force every file to be
+    scaled.
+    """
+
+    FILENAME = ".imagescale-manifest.json"
+
+    def __init__(self, target, parameters, clean=False):
+        """target is the target directory; parameters is a list of
+        JSON-compatible values (e.g., size and smooth) which if changed
+        since the last run means every file must be rescaled; if clean
+        is True the target images for sources that have been deleted
+        are deleted"""
+        self.target = target
+        self.filename = os.path.join(target, Manifest.FILENAME)
+        self.parameters = list(parameters)
+        self.clean = clean
+        self.entries = {} # relative name: [mtime_ns, size]
+        self.pending = {} # name: [mtime_ns, size] for scheduled files
+        self.seen = set()
+        self.scanned = False
+        try:
+            with open(self.filename, "rt", encoding="utf-8") as file:
+                data = json.load(file)
+            if data.get("parameters") == self.parameters:
+                self.entries = data.get("entries", {})
+        except FileNotFoundError:
+            pass
+        except (EnvironmentError, ValueError) as err:
+            Qtrac.report("ignoring unreadable manifest {}: {}".format(
+                    self.filename, err), True)
+
+
+    def is_current(self, name, stat):
+        """returns True if the named source image (named by its path
+        relative to the source directory) with the given os.stat_result
+        is unchanged since it was last scaled; otherwise remembers its
+        details ready for done() and returns False"""
+        self.seen.add(name)
+        details = [stat.st_mtime_ns, stat.st_size]
+        if self.entries.get(name) == details:
+            return True
+        self.pending[name] = details
+        return False
+
+
+    def done(self, targetImage):
+        """records that the image that was scaled to targetImage is
+        current"""
+        name = os.path.relpath(targetImage, self.target)
+        details = self.pending.pop(name, None)
+        if details is not None:
+            self.entries[name] = details
+
+
+    def save(self):
+        """writes the manifest (atomically, so an interrupted run can't
+        leave a broken one), first deleting the target images of sources
+        that no longer exist if cleaning and the whole source directory
+        was scanned"""
+        if self.clean and self.scanned:
+            for name in set(self.entries) - self.seen:
+                Qtrac.remove_if_exists(os.path.join(self.target, name))
+                del self.entries[name]
+        descriptor, filename = tempfile.mkstemp(dir=self.target,
+                prefix=".imagescale-")
+        try:
+            with open(descriptor, "wt", encoding="utf-8") as file:
+                json.dump(dict(parameters=self.parameters,
+                               entries=self.entries), file)
+            os.replace(filename, self.filename)
+        finally:
+            Qtrac.remove_if_exists(filename) # Only if not replaced
+
+
+class Watcher:
+    """Tracks the files in a source tree across repeated get_jobs()
+    scans (pass a Watcher as get_jobs()'s manifest) so that each scan
+    yields only files that are new or changed since they were last
+    yielded.
+
+    A file is only yielded once its modification time and size have
+    stayed the same for settle seconds, so files that are still being
+    written (e.g., uploaded or copied) aren't scaled half-finished. If
+    there is a manifest, files it says are current aren't yielded and
+    the files scaled are recorded in it; and when get_jobs() finishes a
+    scan the manifest is told which files exist so that it can clean
+    the targets of those that have gone.
+    """
+
+    def __init__(self, target, settle=1.0, manifest=None):
+        self.target = target
+        self.settle = settle
+        self.manifest = manifest
+        self.known = {} # relative name: (mtime_ns, size) when yielded
+        self.changing = {} # name: ((mtime_ns, size), changed, arrived)
+        self.arrived = {} # name: time first seen, for yielded files
+        self.seen = set() # names found so far by the current scan
+        self._scanned = False
+
+
+    @property
+    def scanned(self):
+        return self._scanned
+
+
+    @scanned.setter
+    def scanned(self, scanned):
+        # Set by get_jobs() at the end of each scan
+        self._scanned = scanned
+        if not scanned:
+            return
+        for name in set(self.known) - self.seen: # Deleted; rescale if back
+            del self.known[name]
+        for name in set(self.changing) - self.seen:
+            del self.changing[name]
+        if self.manifest is not None:
+            self.manifest.seen = self.seen
+            self.manifest.scanned = True
+        self.seen = set()
+
+
+    def is_current(self, name, stat):
+        """returns False if the named source image (named by its path
+        relative to the source directory) with the given os.stat_result
+        is new or changed and has settled; otherwise returns True so
+        that get_jobs() skips it for now"""
+        self.seen.add(name)
+        details = (stat.st_mtime_ns, stat.st_size)
+        if self.known.get(name) == details:
+            return True
+        if self.manifest is not None and self.manifest.is_current(name,
+                stat):
+            self.known[name] = details
+            return True
+        now = time.monotonic()
+        previous = self.changing.get(name)
+        if previous is None:
+            self.changing[name] = (details, now, now)
+            return self.settle > 0 or self._settled(name, details, now)
+        if previous[0] != details: # Still being written
+            self.changing[name] = (details, now, previous[2])
+            return True
+        if now - previous[1] < self.settle:
+            return True
+        return self._settled(name, details, previous[2])
+
+
+    def _settled(self, name, details, arrived):
+        del self.changing[name]
+        self.known[name] = details
+        self.arrived[name] = arrived
+        return False
+
+
+    def done(self, targetImage):
+        """records that the image that was scaled to targetImage is
+        current and returns the seconds since its source image was first
+        seen (or None if it wasn't yielded by this Watcher)"""
+        if self.manifest is not None:
+            self.manifest.done(targetImage)
+        arrived = self.arrived.pop(os.path.relpath(targetImage,
+                self.target), None)
+        return None if arrived is None else time.monotonic() - arrived
+
+
+    def forget(self, targetImage):
+        """records that the image that should have been scaled to
+        targetImage failed so that it is retried if it changes"""
+        name = os.path.relpath(targetImage, self.target)
+        self.arrived.pop(name, None)
+
+
+def parse_bytes(text):
+    """returns the number of bytes given as, e.g., "512M", "1.5G", or
+    "200000K"; a plain number is in MiB"""
+    text = text.strip().upper().rstrip("B")
+    factor = 1024 ** 2
+    for i, suffix in enumerate("KMGT", start=1):
+        if text.endswith(suffix):
+            text = text[:-1]
+            factor = 1024 ** i
+            break
+    return int(float(text) * factor)
+
+
+class MemoryBudget:
+    """Admits batches of jobs only while their estimated memory use
+    fits in a budget so that too many big images aren't held in memory
+    at once.
+
+    A job's estimate is 4 bytes for each of its source and scaled
+    images' pixels, using the sizes from the source image's header. A
+    batch that doesn't fit waits while later, smaller batches are
+    admitted (backfill); if nothing else is running a batch is always
+    admitted even if it is bigger than the whole budget.
+    """
+
+    def __init__(self, budget, size, smooth, waiting=16):
+        self.budget = budget
+        self.size = size
+        self.smooth = smooth
+        self.waiting = waiting
+        self.used = 0
+        self.costs = {} # batch's first targetImage: estimated bytes
+
+
+    def cost(self, batch):
+        """returns the estimated bytes needed to scale the batch's
+        images"""
+        total = 0
+        for sourceImage, _ in batch:
+            try:
+                width, height = Image.probe(sourceImage)
+            except (EnvironmentError, ValueError, Image.Error):
+                continue # It will fail quickly without using memory
+            newWidth, newHeight = scaled_size(self.size, self.smooth,
+                    width, height)
+            total += ((width * height) + (newWidth * newHeight)) * 4
+        return total
+
+
+    def schedule(self, batches):
+        """yields the batches in the order they are admitted, or None
+        when none of those waiting fits; after a None the caller must
+        wait for at least one admitted batch to finish and release()
+        it before asking for the next batch"""
+        waiting = collections.deque()
+        batches = iter(batches)
+        exhausted = False
+        while waiting or not exhausted:
+            if not exhausted and len(waiting) <= self.waiting:
+                try:
+                    batch = next(batches)
+                    waiting.append((batch, self.cost(batch)))
+                except StopIteration:
+                    exhausted = True
+            for i, (batch, cost) in enumerate(waiting):
+                if self.used == 0 or self.used + cost <= self.budget:
+                    del waiting[i]
+                    self.used += cost
+                    self.costs[batch[0][1]] = cost
+                    yield batch
+                    break
+            else:
+                if exhausted or len(waiting) > self.waiting:
+                    yield None # Nothing fits and can't read more
+
+
+    def release(self, targetImage):
+        """records that the batch whose first image is targetImage has
+        finished"""
+        self.used -= self.costs.pop(targetImage, 0)
+
+
+    def release_all(self):
+        """records that no batches are running (e.g., because the one a
+        dead worker process had can't be identified)"""
+        self.used = 0
+        self.costs.clear()
+
+
+class Batcher:
+    """Groups small images into batches so that each task sent to a
+    worker process does enough work to outweigh the cost of sending it
+    and its results between processes.
+
+    Images are added to a batch until the batch's estimated scaling
+    time reaches latency seconds (or it has maximum images); the
+    estimate is based on the images' file sizes and is tuned from the
+    measured times passed to record(). Images bigger than small bytes
+    are always sent on their own.
+    """
+
+    def __init__(self, latency=0.05, small=64 * 1024, maximum=256):
+        self.latency = latency
+        self.small = small
+        self.maximum = maximum if latency > 0 else 1
+        self.secondsPerByte = None # Unknown until a result is recorded
+
+
+    def batches(self, jobs):
+        """yields lists of (sourceImage, targetImage) jobs; jobs whose
+        source image has gone (or can't be read) are skipped"""
+        batch = []
+        estimate = 0
+        for job in jobs:
+            try:
+                size = os.path.getsize(job[0]) if self.maximum > 1 else 0
+            except EnvironmentError as err:
+                Qtrac.report("skipping {}: {}".format(job[0], err), True)
+                continue
+            if size > self.small:
+                yield [job]
+                continue
+            batch.append(job)
+            if self.secondsPerByte is not None:
+                estimate += size * self.secondsPerByte
+            if (estimate >= self.latency or len(batch) >= self.maximum or
+                    self.secondsPerByte is None):
+                yield batch
+                batch = []
+                estimate = 0
+        if batch:
+            yield batch
+
+
+    def record(self, results):
+        """updates the time estimates using results which must have
+        seconds and bytes attributes"""
+        seconds = sum(result.seconds for result in results)
+        size = sum(result.bytes for result in results)
+        if seconds > 0 and size > 0:
+            secondsPerByte = seconds / size
+            if self.secondsPerByte is None:
+                self.secondsPerByte = secondsPerByte
+            else: # Exponential moving average to smooth out outliers
+                self.secondsPerByte = ((0.8 * self.secondsPerByte) +
+                                       (0.2 * secondsPerByte))
+
+
+class Timer:
+    """Times the stages (e.g., load, scale, and save) of scaling one
+    image in whichever thread or process does the work. The record()
+    is small and JSON-compatible so that it can be returned with the
+    image's results and added to the parent's RunStats.
+    """
+
+    def __init__(self, targetImage, worker=None):
+        self.name = targetImage
+        self.worker = worker
+        self.started = time.time() # Comparable across processes
+        self.last = time.perf_counter()
+        self.stages = {}
+
+
+    def lap(self, stage):
+        """adds the time since the last lap (or since the Timer was
+        created) to the given stage"""
+        now = time.perf_counter()
+        self.stages[stage] = self.stages.get(stage, 0.0) + now - self.last
+        self.last = now
+
+
+    def record(self, pixels, bytesIn, bytesOut):
+        """returns the stage times and the given source image pixel
+        count, source file bytes, and target file bytes as a dict"""
+        worker = self.worker
+        if worker is None:
+            worker = "{}:{}".format(os.getpid(),
+                    threading.current_thread().name)
+        return dict(name=self.name, worker=worker, started=self.started,
+                stages=self.stages, pixels=pixels, bytesIn=bytesIn,
+                bytesOut=bytesOut)
+
+
+class RunStats:
+    """Collects the Timer records for a run's images and writes them,
+    with totals, per-worker throughput, and percentiles, to a JSON
+    file.
+
+    Call submit() when an image's job is handed to a worker (so that
+    the time it spends queued can be measured) and add() with its
+    record when its results arrive.
+    """
+
+    PERCENTILES = (50, 95, 99)
+
+    def __init__(self, filename, program, concurrency):
+        self.filename = filename
+        self.program = program
+        self.concurrency = concurrency
+        self.start = time.time()
+        self.submitted = {} # targetImage: time.time() when submitted
+        self.images = []
+
+
+    def submit(self, jobs):
+        """records that the (sourceImage, targetImage) jobs have been
+        handed to a worker"""
+        now = time.time()
+        for _, targetImage in jobs:
+            self.submitted[targetImage] = now
+
+
+    def add(self, record):
+        """adds an image's Timer record (or does nothing if it is None,
+        e.g., because the image failed)"""
+        if record is None:
+            return
+        submitted = self.submitted.pop(record["name"], record["started"])
+        record = dict(record, wait=max(0.0, record["started"] - submitted),
+                latency=time.time() - submitted)
+        self.images.append(record)
+
+
+    def summary(self):
+        """returns the run's statistics as a JSON-compatible dict"""
+        stages = collections.defaultdict(list)
+        workers = {}
+        for image in self.images:
+            for stage, seconds in image["stages"].items():
+                stages[stage].append(seconds)
+            stages["wait"].append(image["wait"])
+            stages["latency"].append(image["latency"])
+            worker = workers.setdefault(image["worker"], dict(images=0,
+                    megapixels=0.0, seconds=0.0))
+            worker["images"] += 1
+            worker["megapixels"] += image["pixels"] / 1e6
+            worker["seconds"] += sum(image["stages"].values())
+        for worker in workers.values():
+            worker["megapixelsPerSecond"] = (worker["megapixels"] /
+                    worker["seconds"]) if worker["seconds"] else 0.0
+        return dict(program=self.program, concurrency=self.concurrency,
+                seconds=time.time() - self.start, count=len(self.images),
+                megapixels=sum(image["pixels"] for image in self.images) /
+                    1e6,
+                bytesIn=sum(image["bytesIn"] for image in self.images),
+                bytesOut=sum(image["bytesOut"] for image in self.images),
+                stages={stage: self._statistics(times)
+                        for stage, times in stages.items()},
+                workers=workers, images=self.images)
+
+
+    def _statistics(self, times):
+        times = sorted(times)
+        stats = dict(total=sum(times), mean=sum(times) / len(times),
+                max=times[-1])
+        for percent in RunStats.PERCENTILES:
+            index = (len(times) - 1) * percent / 100
+            lower = math.floor(index)
+            upper = math.ceil(index)
+            stats["p{}".format(percent)] = times[lower] + ((times[upper] -
+                    times[lower]) * (index - lower))
+        return stats
+
+
+    def save(self):
+        """writes the statistics to the JSON file"""
+        with open(self.filename, "wt", encoding="utf-8") as file:
+            json.dump(self.summary(), file, indent=2)
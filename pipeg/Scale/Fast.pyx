@@ -13,10 +13,17 @@
 # Throughout, pixels and newPixels are really of type
 # numpy.ndarray[_DTYPE_t] but using a memory view is almost 4x faster
 
+# The row loop runs in parallel using OpenMP if the module was built with
+# it (see setup.py) and serially otherwise; either way it runs without
+# the GIL so that other Python threads can make progress meanwhile.
+
 from libc.math cimport round
+import multiprocessing
+import os
 import numpy
 cimport numpy
 cimport cython
+from cython.parallel cimport prange
 
 
 # See: http://docs.cython.org/src/tutorial/numpy.html
@@ -32,13 +39,24 @@ cdef struct Argb:
 DEF MAX_COMPONENT = 0xFF
 
 
+# The number of threads to use when scale() isn't given a thread count;
+# honors OMP_NUM_THREADS and can be changed at runtime.
+try:
+    THREADS = max(1, int(os.environ.get("OMP_NUM_THREADS", "")))
+except ValueError:
+    THREADS = multiprocessing.cpu_count()
+
+
 @cython.boundscheck(False)
-def scale(_DTYPE_t[:] pixels, int width, int height, double ratio):
+def scale(_DTYPE_t[:] pixels, int width, int height, double ratio,
+        int threads=0):
     """returns a smoothly scaled copy of this image
 
     ratio is how much to scale by, e.g., 0.75 means reduce width and
     height to ¾ their original size, 0.5 to half (making the image ¼
     of the original size), and so on.
+
+    threads is how many threads to scale with; 0 means use THREADS.
     """
     assert 0 < ratio < 1
     cdef int rows = <int>round(height * ratio)
@@ -46,23 +64,35 @@ def scale(_DTYPE_t[:] pixels, int width, int height, double ratio):
     cdef _DTYPE_t[:] newPixels = numpy.zeros(rows * columns, dtype=_DTYPE)
     cdef double yStep = height / rows
     cdef double xStep = width / columns
-    cdef int index = 0
-    cdef int row, column, y0, y1, x0, x1
-    for row in range(rows):
-        y0 = <int>round(row * yStep)
-        y1 = <int>round(y0 + yStep)
-        for column in range(columns):
-            x0 = <int>round(column * xStep)
-            x1 = <int>round(x0 + xStep)
-            newPixels[index] = _mean(pixels, width, height, x0, y0, x1, y1)
-            index += 1
+    cdef int row
+    if threads <= 0:
+        threads = THREADS
+    for row in prange(rows, nogil=True, num_threads=threads,
+            schedule="static"):
+        _scale_row(pixels, width, height, newPixels, row, columns, xStep,
+                yStep)
     return columns, newPixels
 
 
+@cython.boundscheck(False)
+cdef void _scale_row(_DTYPE_t[:] pixels, int width, int height,
+        _DTYPE_t[:] newPixels, int row, int columns, double xStep,
+        double yStep) noexcept nogil:
+    cdef int y0 = <int>round(row * yStep)
+    cdef int y1 = <int>round(y0 + yStep)
+    cdef int index = row * columns
+    cdef int column, x0, x1
+    for column in range(columns):
+        x0 = <int>round(column * xStep)
+        x1 = <int>round(x0 + xStep)
+        newPixels[index + column] = _mean(pixels, width, height, x0, y0,
+                x1, y1)
+
+
 @cython.cdivision(True)
 @cython.boundscheck(False)
 cdef _DTYPE_t _mean(_DTYPE_t[:] pixels, int width, int height, int x0,
-        int y0, int x1, int y1):
+        int y0, int x1, int y1) noexcept nogil:
     cdef int alphaTotal = 0
     cdef int redTotal = 0
     cdef int greenTotal = 0
@@ -90,14 +120,15 @@ cdef _DTYPE_t _mean(_DTYPE_t[:] pixels, int width, int height, int x0,
     return _color_for_argb(a, r, g, b)
 
 
-cdef inline Argb _argb_for_color(_DTYPE_t color):
+cdef inline Argb _argb_for_color(_DTYPE_t color) noexcept nogil:
     """returns an ARGB quadruple for a color specified as a numpy.uint32"""
     return Argb((color >> 24) & MAX_COMPONENT,
             (color >> 16) & MAX_COMPONENT, (color >> 8) & MAX_COMPONENT,
             (color & MAX_COMPONENT))
 
 
-cdef inline _DTYPE_t _color_for_argb(int a, int r, int g, int b):
+cdef inline _DTYPE_t _color_for_argb(int a, int r, int g,
+        int b) noexcept nogil:
     """returns a numpy.uint32 representing the given ARGB values"""
     return (((a & MAX_COMPONENT) << 24) | ((r & MAX_COMPONENT) << 16) |
             ((g & MAX_COMPONENT) << 8) | (b & MAX_COMPONENT))
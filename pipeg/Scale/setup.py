@@ -11,11 +11,49 @@
 
 # Build with: python3 setup.py build_ext --inplace
 
+import distutils.ccompiler
 import distutils.core
+import distutils.errors
+import distutils.sysconfig
+import os
+import shutil
+import tempfile
 import numpy
 import Cython.Build
 
 
+def openmp_flags():
+    """returns the compile and link flags needed to build with OpenMP, or
+    empty lists if the compiler doesn't support it, in which case the
+    prange() loops are built to run serially"""
+    compiler = distutils.ccompiler.new_compiler()
+    distutils.sysconfig.customize_compiler(compiler)
+    flag = "/openmp" if compiler.compiler_type == "msvc" else "-fopenmp"
+    compileFlags = [flag]
+    linkFlags = [] if compiler.compiler_type == "msvc" else [flag]
+    directory = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(directory, "openmp.c")
+        with open(filename, "wt", encoding="ascii") as file:
+            file.write("#include <omp.h>\nint main(void) "
+                       "{ return omp_get_max_threads() < 1; }\n")
+        objects = compiler.compile([filename], output_dir=directory,
+                extra_postargs=compileFlags)
+        compiler.link_executable(objects, "openmp", directory,
+                extra_postargs=linkFlags)
+        return compileFlags, linkFlags
+    except (distutils.errors.CompileError, distutils.errors.LinkError):
+        print("OpenMP is unavailable: building serial version")
+        return [], []
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+compileFlags, linkFlags = openmp_flags()
+extensions = Cython.Build.cythonize("Fast.pyx")
+for extension in extensions:
+    extension.extra_compile_args.extend(compileFlags)
+    extension.extra_link_args.extend(linkFlags)
 distutils.core.setup(name="Scale.Fast",
         include_dirs=[numpy.get_include()],
-        ext_modules=Cython.Build.cythonize("Fast.pyx"))
+        ext_modules=extensions)
@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+# Copyright © 2012-13 Qtrac Ltd. All rights reserved.
+# This program or module is free software: you can redistribute it
+# and/or modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version. It is provided for
+# educational purposes and is distributed in the hope that it will be
+# useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+
+"""
+A persistent cache of scaled images (thumbnails) used by imagescale/.
+
+Each thumbnail is stored as the bytes of its file, keyed by a hash of
+its source image's bytes, the size it was scaled to, and its file's
+name (which says its format, and XPM and XBM files contain a name made
+from it). The most recently used thumbnails are also kept in memory.
+Files are written atomically so an interrupted run can't leave a broken
+one, and the least recently used are deleted whenever they take more
+than the cache's limit.
+
+Hashing a source means reading all of it, so each source's hash is
+remembered with its modification time and size (in the INDEX file) and
+only recomputed if they change; this is what makes a rerun over a big
+folder of unchanged photos fast.
+"""
+
+import collections
+import hashlib
+import json
+import os
+import sys
+import tempfile
+import threading
+import Qtrac
+
+
+def default_directory():
+    """returns the per-user directory for the cache"""
+    if sys.platform.startswith("win"):
+        base = os.environ.get("LOCALAPPDATA", os.path.expanduser("~"))
+    else:
+        base = os.environ.get("XDG_CACHE_HOME", os.path.join(
+                os.path.expanduser("~"), ".cache"))
+    return os.path.join(base, "imagescale-thumbnails")
+
+
+class ThumbnailCache:
+    """Stores thumbnails on disk (in directory) and in memory
+
+    limit is the most bytes of thumbnails to keep on disk and memory the
+    most to keep in memory. All the methods may be called from any
+    thread.
+    """
+
+    INDEX = "hashes.json"
+    CHUNK = 1024 * 1024 # For hashing sources
+
+    def __init__(self, directory=None, limit=512 * 1024 * 1024,
+            memory=32 * 1024 * 1024):
+        self.directory = (directory if directory is not None else
+                          default_directory())
+        os.makedirs(self.directory, exist_ok=True)
+        self.limit = limit
+        self.memory = memory
+        self.lock = threading.Lock()
+        self.recent = collections.OrderedDict() # key: data; LRU first
+        self.recentBytes = 0
+        self.files = collections.OrderedDict() # key: size; LRU first
+        self.fileBytes = 0
+        self.hashes = {} # source filename: [mtime_ns, size, hash]
+        self.changed = False
+        self._load_index()
+        self._scan()
+
+
+    def _load_index(self):
+        try:
+            with open(os.path.join(self.directory, self.INDEX), "rt",
+                    encoding="utf-8") as file:
+                self.hashes = json.load(file)
+        except FileNotFoundError:
+            pass
+        except (EnvironmentError, ValueError) as err:
+            Qtrac.report("ignoring unreadable thumbnail index: {}".format(
+                    err), True)
+
+
+    def _scan(self):
+        """finds the cached files, least recently used first"""
+        files = []
+        for entry in os.scandir(self.directory):
+            if not entry.is_dir() or len(entry.name) != 2:
+                continue
+            for file in os.scandir(entry.path):
+                if file.name.startswith("."): # Left by an interrupted put()
+                    Qtrac.remove_if_exists(file.path)
+                else:
+                    stat = file.stat()
+                    files.append((stat.st_mtime_ns, file.name,
+                                  stat.st_size))
+        for _, key, size in sorted(files):
+            self.files[key] = size
+            self.fileBytes += size
+
+
+    def key(self, sourceImage, size, targetImage):
+        """returns the key for the thumbnail of sourceImage scaled to fit
+        size and saved as targetImage; raises EnvironmentError if the
+        source can't be read"""
+        text = "{}:{}:{}".format(self._source_hash(sourceImage), size,
+                os.path.basename(targetImage))
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+    def _source_hash(self, filename):
+        filename = os.path.abspath(filename)
+        stat = os.stat(filename)
+        details = [stat.st_mtime_ns, stat.st_size]
+        with self.lock:
+            known = self.hashes.get(filename)
+        if known is not None and known[:2] == details:
+            return known[2]
+        digest = hashlib.sha256()
+        with open(filename, "rb") as file:
+            for chunk in iter(lambda: file.read(self.CHUNK), b""):
+                digest.update(chunk)
+        with self.lock:
+            self.hashes[filename] = details + [digest.hexdigest()]
+            self.changed = True
+        return digest.hexdigest()
+
+
+    def get(self, key):
+        """returns the bytes of the thumbnail with the given key or None
+        if it isn't cached"""
+        with self.lock:
+            data = self.recent.get(key)
+            if data is not None:
+                self.recent.move_to_end(key)
+                self._used(key)
+                return data
+            if key not in self.files:
+                return None
+        try:
+            with open(self._filename(key), "rb") as file:
+                data = file.read()
+        except EnvironmentError: # Deleted behind our back
+            with self.lock:
+                self.fileBytes -= self.files.pop(key, 0)
+            return None
+        with self.lock:
+            self._used(key)
+            self._remember(key, data)
+        return data
+
+
+    def put(self, key, data):
+        """caches data, the bytes of the thumbnail with the given key"""
+        filename = self._filename(key)
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        descriptor, temporary = tempfile.mkstemp(
+                dir=os.path.dirname(filename), prefix=".")
+        try:
+            with open(descriptor, "wb") as file:
+                file.write(data)
+            os.replace(temporary, filename)
+        finally:
+            Qtrac.remove_if_exists(temporary) # Only if not replaced
+        with self.lock:
+            self.fileBytes += len(data) - self.files.pop(key, 0)
+            self.files[key] = len(data)
+            self._remember(key, data)
+            self._evict()
+
+
+    def save(self):
+        """writes the index of source hashes (atomically) if it has
+        changed, forgetting sources that no longer exist"""
+        with self.lock:
+            if not self.changed:
+                return
+            hashes = {filename: details for filename, details in
+                      self.hashes.items() if os.path.exists(filename)}
+            self.hashes = hashes
+            self.changed = False
+        descriptor, filename = tempfile.mkstemp(dir=self.directory,
+                prefix=".")
+        try:
+            with open(descriptor, "wt", encoding="utf-8") as file:
+                json.dump(hashes, file)
+            os.replace(filename, os.path.join(self.directory, self.INDEX))
+        finally:
+            Qtrac.remove_if_exists(filename) # Only if not replaced
+
+
+    def _filename(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+
+    # The methods below must be called with self.lock held
+
+    def _used(self, key):
+        self.files.move_to_end(key)
+        try: # So that the order survives to the next run
+            os.utime(self._filename(key))
+        except EnvironmentError:
+            pass
+
+
+    def _remember(self, key, data):
+        if len(data) > self.memory:
+            return
+        old = self.recent.pop(key, None)
+        if old is not None:
+            self.recentBytes -= len(old)
+        self.recent[key] = data
+        self.recentBytes += len(data)
+        while self.recentBytes > self.memory:
+            _, old = self.recent.popitem(last=False)
+            self.recentBytes -= len(old)
+
+
+    def _evict(self):
+        while self.fileBytes > self.limit and len(self.files) > 1:
+            key, size = self.files.popitem(last=False)
+            self.fileBytes -= size
+            data = self.recent.pop(key, None)
+            if data is not None:
+                self.recentBytes -= len(data)
+            Qtrac.remove_if_exists(self._filename(key))
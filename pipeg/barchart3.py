@@ -14,10 +14,7 @@ import os
 import re
 import tempfile
 import Qtrac
-try:
-    import cyImage as Image
-except ImportError:
-    import Image
+import Image # Uses cyImage's backends if available
 
 
 def main():
@@ -82,6 +79,9 @@ class ImageBarRenderer:
               "blue", "yellow", "magenta", "cyan")]
 
 
+    Blanks = {} # size: white Image to clone()
+
+
     def __init__(self, stepHeight=10, barWidth=30, barGap=2):
         self.stepHeight = stepHeight
         self.barWidth = barWidth
@@ -91,9 +91,14 @@ class ImageBarRenderer:
     def initialize(self, bars, maximum):
         assert bars > 0 and maximum > 0
         self.index = 0
-        color = Image.color_for_name("white")
-        self.image = Image.Image(bars * (self.barWidth + self.barGap),
-                maximum * self.stepHeight, background=color)
+        size = (bars * (self.barWidth + self.barGap),
+                maximum * self.stepHeight)
+        blank = ImageBarRenderer.Blanks.get(size)
+        if blank is None:
+            color = Image.color_for_name("white")
+            blank = ImageBarRenderer.Blanks[size] = Image.Image(*size,
+                    background=color)
+        self.image = blank.clone() # Only copied once drawn on
 
 
     def draw_caption(self, caption):
@@ -0,0 +1,381 @@
+#!/usr/bin/env python3
+# Copyright © 2012-13 Qtrac Ltd. All rights reserved.
+# This program or module is free software: you can redistribute it
+# and/or modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version. It is provided for
+# educational purposes and is distributed in the hope that it will be
+# useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+
+"""
+Benchmarks the Image operations (load, save, scale, subsample, and
+draw) for every available implementation over a matrix of image sizes,
+ratios, and file formats.
+
+The implementations (targets) are:
+    Image               Image using its fastest backends
+    Image:BACKEND       Image using the given backend (e.g., Image:numpy)
+    cyImage             cyImage (if built)
+    Scale.scale_slow    Scale's numpy-based Python scale (scale only)
+    Scale.scale_fast    Scale's Cython scale (if built; scale only)
+
+Each case is run a few times untimed (warmups) and then timed
+repeatedly; the median and percentiles are reported. Use --json to save
+the results and --compare to compare a run against saved results and
+flag any regressions (the exit status is 1 if there are any).
+"""
+
+import argparse
+import collections
+import copy
+import datetime
+import functools
+import itertools
+import json
+import math
+import os
+import platform
+import sys
+import tempfile
+import time
+import Image
+import imagecorpus
+try:
+    import numpy
+    import cyImage
+except ImportError:
+    cyImage = None
+try:
+    import Scale
+except ImportError: # Scale needs numpy and Scale.Fast to have been built
+    Scale = None
+
+
+OPERATIONS = ("load", "save", "scale", "subsample", "draw")
+FORMATS = ("xpm", "xbm", "png")
+PERCENTILES = (50, 90, 95, 99)
+
+Case = collections.namedtuple("Case", "target operation size parameter "
+        "setup function")
+Result = collections.namedtuple("Result", "target operation size "
+        "parameter times")
+
+
+def main():
+    args = handle_commandline()
+    cases = list(create_cases(args))
+    results = []
+    for case in cases:
+        result = run(case, args.warmups, args.repeats)
+        if result is not None:
+            results.append(result)
+            print(describe(result))
+        else:
+            print("{:<42} [unavailable]".format(key_text(case)))
+    report = create_report(args, results)
+    if args.json:
+        with open(args.json, "wt", encoding="utf-8") as file:
+            json.dump(report, file, indent=2, sort_keys=True)
+        print("wrote", args.json)
+    if args.compare:
+        with open(args.compare, "rt", encoding="utf-8") as file:
+            baseline = json.load(file)
+        if compare(baseline, report, args.threshold):
+            sys.exit(1)
+
+
+def handle_commandline():
+    parser = argparse.ArgumentParser(description="Benchmarks the Image "
+            "implementations")
+    parser.add_argument("-w", "--warmups", type=int, default=1,
+            help="untimed runs per case [default: %(default)d]")
+    parser.add_argument("-r", "--repeats", type=int, default=5,
+            help="timed runs per case [default: %(default)d]")
+    parser.add_argument("-s", "--sizes", default="64x64,256x256,800x600",
+            help="comma-separated WIDTHxHEIGHT image sizes "
+                "[default: %(default)s]")
+    parser.add_argument("-R", "--ratios", default="0.75,0.5,0.25",
+            help="comma-separated scale ratios; subsample uses the "
+                "nearest stride [default: %(default)s]")
+    parser.add_argument("-f", "--formats", default=",".join(FORMATS),
+            help="comma-separated file formats for load and save "
+                "[default: %(default)s]")
+    parser.add_argument("-o", "--operations", default=",".join(OPERATIONS),
+            help="comma-separated operations [default: %(default)s]")
+    parser.add_argument("-t", "--targets", default="",
+            help="comma-separated targets [default: all available: "
+                "{}]".format(", ".join(available_targets())))
+    parser.add_argument("-i", "--image",
+            help="benchmark this image file rather than synthetic images "
+                "of the given sizes")
+    parser.add_argument("-j", "--json",
+            help="write the results as JSON to the given file")
+    parser.add_argument("-c", "--compare",
+            help="compare the results with those in the given JSON file")
+    parser.add_argument("-T", "--threshold", type=float, default=0.1,
+            help="with --compare, the fractional slowdown of the median "
+                "that counts as a regression [default: %(default)s]")
+    args = parser.parse_args()
+    args.sizes = [tuple(int(x) for x in size.lower().split("x"))
+                  for size in split(args.sizes)]
+    args.ratios = [float(ratio) for ratio in split(args.ratios)]
+    args.formats = [suffix.lstrip(".").lower() for suffix in
+                    split(args.formats)]
+    args.operations = split(args.operations)
+    for operation in args.operations:
+        if operation not in OPERATIONS:
+            parser.error("unknown operation {}".format(operation))
+    targets = available_targets()
+    args.targets = split(args.targets) or targets
+    for target in args.targets:
+        if target not in targets:
+            parser.error("unavailable target {}".format(target))
+    if args.warmups < 0 or args.repeats < 1:
+        parser.error("need at least one repeat and no negative warmups")
+    return args
+
+
+def split(text):
+    return [item for item in text.replace(" ", "").split(",") if item]
+
+
+def available_targets():
+    targets = ["Image"]
+    names = set()
+    for operation in ("scale", "subsample"):
+        names.update(Image.backends(operation))
+    targets += ["Image:" + name for name in sorted(names)]
+    if cyImage is not None:
+        targets.append("cyImage")
+    if Scale is not None:
+        targets += ["Scale.scale_slow", "Scale.scale_fast"]
+    return targets
+
+
+def create_cases(args):
+    directory = tempfile.mkdtemp()
+    sources = ([load_source(args.image)] if args.image else
+               [imagecorpus.synthetic_image(width, height) for width, height in
+                args.sizes])
+    for image, target, operation in itertools.product(sources,
+            args.targets, args.operations):
+        image = convert(image, target)
+        size = "{}x{}".format(image.width, image.height)
+        if operation in {"load", "save"}:
+            for suffix in args.formats:
+                filename = os.path.join(directory, "{}.{}".format(
+                        size, suffix))
+                yield codec_case(target, operation, size, image, suffix,
+                        filename)
+        elif operation in {"scale", "subsample"}:
+            for ratio in args.ratios:
+                yield resize_case(target, operation, size, image, ratio)
+        elif operation == "draw":
+            yield draw_case(target, size, image)
+
+
+def load_source(filename):
+    return Image.Image.from_file(filename)
+
+
+def convert(image, target):
+    if target == "cyImage" and cyImage is not None:
+        return cyImage.Image.from_data(image.width, numpy.array(
+                image.pixels, dtype=numpy.uint32))
+    return image
+
+
+def codec_case(target, operation, size, image, suffix, filename):
+    parameter = suffix
+    if target.startswith("Scale."):
+        return Case(target, operation, size, parameter, None, None)
+    if target == "cyImage":
+        Class = cyImage.Image
+        if operation == "load":
+            setup = lambda: image.save(filename)
+            function = lambda: Class.from_file(filename)
+        else:
+            setup = None
+            function = lambda: image.save(filename)
+        return Case(target, operation, size, parameter, setup, function)
+    codec = None
+    for module in Image._Modules:
+        if module.can_load("x." + suffix):
+            codec = "{}.{}".format(module.__name__.rsplit(".", 1)[-1],
+                    operation)
+    if codec is None:
+        return Case(target, operation, size, parameter, None, None)
+    try:
+        name = target.partition(":")[2] or None
+        action = Image.backend(codec, name)[1]
+    except KeyError:
+        return Case(target, operation, size, parameter, None, None)
+    if operation == "load":
+        setup = lambda: image.save(filename)
+        function = lambda: action(Image.Image(width=1, height=1), filename)
+    else:
+        setup = None
+        function = lambda: action(image, filename)
+    return Case(target, operation, size, parameter, setup, function)
+
+
+def resize_case(target, operation, size, image, ratio):
+    stride = max(2, int(round(1 / ratio)))
+    parameter = ratio if operation == "scale" else stride
+    function = None
+    if operation == "subsample" and (stride > min(image.width // 2,
+            image.height // 2)):
+        pass # Too small to subsample
+    elif target == "Image" or target == "cyImage":
+        if operation == "scale":
+            function = lambda: image.scale(ratio)
+        else:
+            function = lambda: image.subsample(stride)
+    elif target.startswith("Image:"):
+        try:
+            action = Image.backend(operation, target.partition(":")[2])[1]
+            argument = ratio if operation == "scale" else stride
+            function = lambda: action(image.pixels, image.width,
+                    image.height, argument)
+        except KeyError:
+            pass
+    elif target.startswith("Scale.") and operation == "scale":
+        action = getattr(Scale, target.partition(".")[2])
+        pixels = numpy.asarray(image.pixels, dtype=numpy.uint32)
+        function = lambda: action(pixels, image.width, image.height,
+                ratio)
+    return Case(target, operation, size, parameter, None, function)
+
+
+def draw_case(target, size, image):
+    function = None
+    name = target.partition(":")[2] if target.startswith("Image:") else None
+    if target == "Image" or target == "cyImage" or (name in
+            Image.backends("line")):
+        # Draw on a copy so that later cases get the original image
+        image = image.from_data(image.width, copy.copy(image.pixels))
+        function = lambda: draw(image, name)
+    return Case(target, "draw", size, None, None, function)
+
+
+def draw(image, backend=None):
+    """draws on the image using its methods or, if backend is given, by
+    calling that drawing backend directly"""
+    width = image.width - 1
+    height = image.height - 1
+    if backend is None:
+        line, rectangle, ellipse = image.line, image.rectangle, image.ellipse
+    else:
+        line, rectangle, ellipse = (functools.partial(Image.backend(
+                operation, backend)[1], image.pixels, image.width,
+                image.height) for operation in ("line", "rectangle",
+                "ellipse"))
+    black = Image.color_for_name("black")
+    red = Image.color_for_name("red")
+    rectangle(0, 0, width, height, outline=black, fill=red)
+    ellipse(0, 0, width, height, outline=black,
+            fill=Image.color_for_name("yellow"))
+    ellipse(width // 4, height // 4, (width * 3) // 4, (height * 3) // 4,
+            fill=Image.color_for_name("blue"))
+    for x in range(0, width, max(1, width // 16)):
+        line(x, 0, width - x, height, black)
+
+
+def run(case, warmups, repeats):
+    if case.function is None:
+        return None
+    try:
+        if case.setup is not None:
+            case.setup()
+        for _ in range(warmups):
+            case.function()
+        times = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            case.function()
+            times.append(time.perf_counter() - start)
+    except Image.Error:
+        return None
+    return Result(case.target, case.operation, case.size, case.parameter,
+            times)
+
+
+def percentile(values, percent):
+    """returns the given percentile of values using linear interpolation
+    between the closest ranks"""
+    values = sorted(values)
+    index = (len(values) - 1) * percent / 100
+    lower = math.floor(index)
+    upper = math.ceil(index)
+    return values[lower] + ((values[upper] - values[lower]) *
+                            (index - lower))
+
+
+def statistics(times):
+    stats = {"min": min(times), "max": max(times),
+             "mean": sum(times) / len(times), "runs": len(times)}
+    for percent in PERCENTILES:
+        stats["p{}".format(percent)] = percentile(times, percent)
+    stats["median"] = stats["p50"]
+    return stats
+
+
+def key_text(item):
+    parameter = "" if item.parameter is None else " {}".format(
+            item.parameter)
+    return "{} {} {}{}".format(item.target, item.operation, item.size,
+            parameter)
+
+
+def describe(result):
+    stats = statistics(result.times)
+    return "{:<42} median {:9.5f} sec  p90 {:9.5f}  p99 {:9.5f}".format(
+            key_text(result), stats["median"], stats["p90"], stats["p99"])
+
+
+def create_report(args, results):
+    meta = {"date": datetime.datetime.now().isoformat(),
+            "python": platform.python_version(),
+            "platform": platform.platform(), "warmups": args.warmups,
+            "repeats": args.repeats, "backends": Image.backend_info()}
+    entries = []
+    for result in results:
+        entry = result._asdict()
+        entry.update(statistics(result.times))
+        entries.append(entry)
+    return {"meta": meta, "results": entries}
+
+
+def result_key(entry):
+    return (entry["target"], entry["operation"], entry["size"],
+            entry["parameter"])
+
+
+def compare(baseline, report, threshold):
+    """prints how each result compares with the baseline and returns
+    the number of regressions"""
+    print("\nComparing medians with the baseline of {}:".format(
+            baseline["meta"]["date"]))
+    old = {result_key(entry): entry for entry in baseline["results"]}
+    regressions = 0
+    for entry in report["results"]:
+        previous = old.get(result_key(entry))
+        if previous is None:
+            continue
+        change = (entry["median"] - previous["median"]) / previous["median"]
+        flag = ""
+        if change > threshold:
+            flag = " REGRESSION"
+            regressions += 1
+        key = "{} {} {} {}".format(*result_key(entry)).replace(" None", "")
+        print("{:<42} {:9.5f} -> {:9.5f} sec {:+7.1%}{}".format(key,
+                previous["median"], entry["median"], change, flag))
+    print("{} regression{}".format(regressions, "" if regressions == 1
+            else "s"))
+    return regressions
+
+
+if __name__ == "__main__":
+    main()
@@ -22,6 +22,7 @@ SOLID = 0xFF000000 # + to RGB color int to get a solid ARGB color int
 
 
 class Error(Exception): pass
+class Canceled(Error): pass
 
 
 def sanitized_name(name):
@@ -23,13 +23,14 @@ the scipy image processing functions.
 """
 
 import sys
-from libc.math cimport round
-from libc.stdlib cimport abs
 import numpy
 cimport numpy
 cimport cython
+import cyImage.cyImage.Png as Png
 import cyImage.cyImage.Xbm as Xbm
 import cyImage.cyImage.Xpm as Xpm
+import cyImage.cyImage._Composite as Composite
+import cyImage.cyImage._Draw as Draw
 import cyImage.cyImage._Scale as Scale
 from cyImage.Globals import *
 
@@ -121,28 +122,11 @@ class Image:
         self.pixels[(y * self.width) + x] = color
 
 
-    # Bresenham's mid-point line scanning algorithm from 
-    # http://en.wikipedia.org/wiki/Bresenham%27s_line_algorithm 
     def line(self, int x0, int y0, int x1, int y1, _DTYPE_t color):
         """draws the line in the given color; the coordinates must be in
         range; the color must be an ARGB int"""
-        cdef int dx = abs(x1 - x0)
-        cdef int dy = abs(y1 - y0)
-        cdef int xInc = 1 if x0 < x1 else -1
-        cdef int yInc = 1 if y0 < y1 else -1
-        cdef int err = dx - dy
-        cdef int err2
-        while True:
-            self.set_pixel(x0, y0, color)
-            if x0 == x1 and y0 == y1:
-                break
-            err2 = 2 * err
-            if err2 > -dy:
-                err -= dy
-                x0 += xInc
-            if err2 < dx:
-                err += dx
-                y0 += yInc
+        Draw.line(self.pixels, self.width, self.height, x0, y0, x1, y1,
+                color)
 
 
     def rectangle(self, int x0, int y0, int x1, int y1, outline=None,
@@ -153,21 +137,8 @@ class Image:
         the coordinates must be in range; the outline and fill colors
         must be ARGB ints"""
         assert outline is not None or fill is not None
-        if fill is not None:
-            if y0 > y1:
-                y0, y1 = y1, y0
-            if outline is not None: # no point drawing over the outline
-                x0 += 1
-                x1 -= 1
-                y0 += 1
-                y1 -= 1
-            for y in range(y0, y1 + 1):
-                self.line(x0, y, x1, y, fill)
-        if outline is not None:
-            self.line(x0, y0, x1, y0, outline)
-            self.line(x1, y0, x1, y1, outline)
-            self.line(x1, y1, x0, y1, outline)
-            self.line(x0, y1, x0, y0, outline)
+        Draw.rectangle(self.pixels, self.width, self.height, x0, y0, x1,
+                y1, outline, fill)
 
 
     def ellipse(self, int x0, int y0, int x1, int y1, outline=None,
@@ -178,76 +149,28 @@ class Image:
         the coordinates must be in range; the outline and fill colors
         must be ARGB ints"""
         assert outline is not None or fill is not None
-        if x0 > x1:
-            x0, x1 = x1, x0
-        if y0 > y1:
-            y0, y1 = y1, y0
-        cdef int width = x1 - x0
-        cdef int height = y1 - y0
-        cdef int halfWidth, halfHeight, midX, midY
-        cdef double dx, dy, a, b, a2, b2, p
-        if fill is not None:
-            # Algorithm based on
-            # http://stackoverflow.com/questions/10322341/
-            # simple-algorithm-for-drawing-filled-ellipse-in-c-c
-            halfWidth = width // 2
-            halfHeight = height // 2
-            midX = x0 + halfWidth
-            midY = y0 + halfHeight
-            for y in range(-halfHeight, halfHeight + 1):
-                for x in range(-halfWidth, halfWidth + 1):
-                    dx =  x / halfWidth
-                    dy =  y / halfHeight
-                    if ((dx * dx) + (dy * dy)) <= 1:
-                        self.set_pixel(<int>round(midX + x),
-                                       <int>round(midY + y), fill)
-        if outline is not None:
-            # Midpoint ellipse algorithm from "Computer Graphics
-            # Principles and Practice".
-            if x1 > x0:
-                midX = ((x1 - x0) // 2) + x0
-            else:
-                midX = ((x0 - x1) // 2) + x1
-            if y1 > y0:
-                midY = ((y1 - y0) // 2) + y0
-            else:
-                midY = ((y0 - y1) // 2) + y1
-
-            def ellipse_point(dx, dy):
-                # dx is always an int; dy is always a float
-                self.set_pixel(midX + dx, <int>round(midY + dy), outline)
-                self.set_pixel(midX - dx, <int>round(midY - dy), outline)
-                self.set_pixel(midX + dx, <int>round(midY - dy), outline)
-                self.set_pixel(midX - dx, <int>round(midY + dy), outline)
-
-            a = abs(x1 - x0) / 2
-            b = abs(y1 - y0) / 2
-            a2 = a ** 2
-            b2 = b ** 2
-            dx = 0
-            dy = b
-            p = b2 - (a2 * b) + (a2 / 4)
-            ellipse_point(dx, dy)
-            while (a2 * (dy - 0.5)) > (b2 * (dx + 1)):
-                if p < 0:
-                    p += b2 * ((2 * dx) + 3)
-                    dx += 1
-                else:
-                    p += (b2 * ((2 * dx) + 3)) + (a2 * ((-2 * dy) + 2))
-                    dx += 1
-                    dy -= 1
-                ellipse_point(dx, dy)
-            p = ((b2 * ((dx + 0.5) ** 2)) + (a2 * ((dy - 1) ** 2)) -
-                 (a2 * b2))
-            while dy > 0:
-                if p < 0:
-                    p += (b2 * ((2 * dx) + 2)) + (a2 * ((-2 * dy) + 3))
-                    dx += 1
-                    dy -= 1
-                else:
-                    p += a2 * ((-2 * dy) + 3)
-                    dy -= 1
-                ellipse_point(dx, dy)
+        Draw.ellipse(self.pixels, self.width, self.height, x0, y0, x1, y1,
+                outline, fill)
+
+
+    def composite(self, other, int x, int y, mode="over",
+            int threads=0):
+        """blends the other image onto this one with its top-left corner
+        at (x, y); the parts of other that fall outside this image are
+        ignored
+
+        mode is "over", "multiply", "screen", or "add"; the result is
+        exactly the same as Image.Image.composite()'s. The rows are
+        blended in parallel by the given number of threads (0 means
+        cyImage.cyImage._Scale.THREADS) without holding the GIL.
+        """
+        cdef int x0 = max(0, x)
+        cdef int y0 = max(0, y)
+        cdef int x1 = min(self.width, x + other.width)
+        cdef int y1 = min(self.height, y + other.height)
+        if x0 < x1 and y0 < y1:
+            Composite.composite(self.pixels, self.width, other.pixels,
+                    other.width, x0, y0, x1, y1, x, y, mode, threads)
 
 
     def subsample(self, int stride):
@@ -278,20 +201,29 @@ class Image:
         return self.from_data(self.width // stride, pixels)
 
 
-    def scale(self, double ratio):
+    def scale(self, double ratio, int threads=0, progress=None,
+            int every=0):
         """returns a smoothly scaled copy of this image
 
         ratio is how much to scale by, e.g., 0.75 means reduce width and
         height to ¾ their original size, 0.5 to half (making the image ¼
         of the original size), and so on.
 
-        Scaling produces good results even for text.
+        Scaling produces good results even for text. The rows are scaled
+        in parallel by the given number of threads (0 means
+        cyImage.cyImage._Scale.THREADS) without holding the GIL.
+
+        If progress is given it is called as progress(done, total) with
+        the number of scaled rows produced so far and in all, every
+        every rows (0 means enough rows to cover about
+        cyImage.cyImage._Scale.PROGRESS_PIXELS pixels); if it returns a
+        true value Canceled is raised.
         """
         assert 0 < ratio < 1
         cdef int columns
         cdef _DTYPE_t[:] pixels
         columns, pixels = Scale.scale(self.pixels, self.width, self.height,
-                ratio)
+                ratio, threads, 0, -1, progress, every)
         return self.from_data(columns, pixels)
 
 
@@ -323,5 +255,5 @@ class Image:
         file.write("\n")
 
 
-_loadForSuffix = {".xbm": Xbm.load, ".xpm": Xpm.load,}
-_saveForSuffix = {".xbm": Xbm.save, ".xpm": Xpm.save,}
+_loadForSuffix = {".png": Png.load, ".xbm": Xbm.load, ".xpm": Xpm.load,}
+_saveForSuffix = {".png": Png.save, ".xbm": Xbm.save, ".xpm": Xpm.save,}
@@ -0,0 +1,382 @@
+#!/usr/bin/env python3
+# cython: language_level=3
+# Copyright © 2012-13 Qtrac Ltd. All rights reserved.
+# This program or module is free software: you can redistribute it
+# and/or modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version. It is provided for
+# educational purposes and is distributed in the hope that it will be
+# useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+
+# Unlike Image/Png.py this module doesn't need PyPNG: it reads and writes
+# the PNG chunks itself and uses zlib for the compression. All the per
+# byte work (unfiltering, filtering, and converting between PNG samples
+# and ARGB colors) is done in typed loops that don't hold the GIL.
+#
+# It can load greyscale, palette, RGB, greyscale with alpha, and RGBA
+# images of any bit depth, interlaced or not; 16-bit samples are scaled
+# to 8 bits. It always saves non-interlaced 8-bit RGBA images.
+
+import struct
+import zlib
+import numpy
+cimport numpy
+cimport cython
+from libc.stdlib cimport abs
+from cyImage.Globals import *
+
+
+_DTYPE = numpy.uint32 # See: http://docs.cython.org/src/tutorial/numpy.html
+ctypedef numpy.uint32_t _DTYPE_t
+
+_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+cdef enum: # Color types
+    GREY = 0
+    RGB = 2
+    PALETTE = 3
+    GREY_ALPHA = 4
+    RGBA = 6
+
+cdef enum: # Filter types
+    NONE = 0
+    SUB = 1
+    UP = 2
+    AVERAGE = 3
+    PAETH = 4
+
+_CHANNELS = {GREY: 1, RGB: 3, PALETTE: 1, GREY_ALPHA: 2, RGBA: 4}
+_DEPTHS = {GREY: {1, 2, 4, 8, 16}, RGB: {8, 16}, PALETTE: {1, 2, 4, 8},
+        GREY_ALPHA: {8, 16}, RGBA: {8, 16}}
+# x start, y start, x step, y step for each of the seven Adam7 passes
+_ADAM7 = ((0, 0, 8, 8), (4, 0, 8, 8), (0, 4, 4, 8), (2, 0, 4, 4),
+        (0, 2, 2, 4), (1, 0, 2, 2), (0, 1, 1, 2))
+
+
+def load(image, str filename):
+    with open(filename, "rb") as file:
+        data = file.read()
+    if not data.startswith(_SIGNATURE):
+        raise Error("'{}' is not a PNG file".format(filename))
+    header, palette, transparency, compressed = _read_chunks(data,
+            filename)
+    (width, height, depth, colorType, compression, filterMethod,
+            interlace) = header
+    channels = _CHANNELS.get(colorType)
+    if (channels is None or depth not in _DEPTHS[colorType] or
+            compression != 0 or filterMethod != 0 or interlace not in {0,
+            1}):
+        raise Error("unsupported PNG format in '{}'".format(filename))
+    lookup = _lookup(colorType, depth, palette, transparency, filename)
+    hasKey, keyR, keyG, keyB = _key(colorType, depth, transparency)
+    raw = bytearray(zlib.decompress(compressed))
+    image.width = width
+    image.height = height
+    image.pixels = create_array(width, height)
+    cdef Py_ssize_t offset = 0
+    for xStart, yStart, xStep, yStep in (_ADAM7 if interlace else
+            ((0, 0, 1, 1),)):
+        columns = (width - xStart + xStep - 1) // xStep
+        rows = (height - yStart + yStep - 1) // yStep
+        if columns > 0 and rows > 0:
+            offset = _decode_pass(raw, offset, image.pixels, width,
+                    columns, rows, xStart, yStart, xStep, yStep,
+                    colorType, depth, channels, lookup, hasKey, keyR,
+                    keyG, keyB)
+
+
+def _read_chunks(data, filename):
+    header = palette = transparency = None
+    compressed = []
+    index = len(_SIGNATURE)
+    while index + 8 <= len(data):
+        length, kind = struct.unpack(">I4s", data[index:index + 8])
+        chunk = data[index + 8:index + 8 + length]
+        index += length + 12 # length + kind + data + crc
+        if kind == b"IDAT": # if branches are ordered by frequency
+            compressed.append(chunk)
+        elif kind == b"IHDR":
+            header = struct.unpack(">IIBBBBB", chunk)
+        elif kind == b"PLTE":
+            palette = chunk
+        elif kind == b"tRNS":
+            transparency = chunk
+        elif kind == b"IEND":
+            break
+    if header is None or not compressed:
+        raise Error("failed to parse '{}'".format(filename))
+    return header, palette, transparency, b"".join(compressed)
+
+
+def _lookup(colorType, depth, palette, transparency, filename):
+    """returns a table mapping palette indexes or greyscale samples of 8
+    bits or less to ARGB colors"""
+    lookup = numpy.zeros(256, dtype=_DTYPE)
+    if colorType == PALETTE:
+        if palette is None:
+            raise Error("missing palette in '{}'".format(filename))
+        alphas = transparency or b""
+        for i in range(min(256, len(palette) // 3)):
+            a = alphas[i] if i < len(alphas) else MAX_COMPONENT
+            lookup[i] = color_for_argb(a, palette[i * 3],
+                    palette[(i * 3) + 1], palette[(i * 3) + 2])
+    elif colorType == GREY and depth <= 8:
+        maximum = (1 << depth) - 1
+        key = (struct.unpack(">H", transparency[:2])[0]
+                if transparency is not None else -1)
+        for sample in range(maximum + 1):
+            g = (sample * MAX_COMPONENT) // maximum
+            lookup[sample] = color_for_argb(0 if sample == key else
+                    MAX_COMPONENT, g, g, g)
+    return lookup
+
+
+def _key(colorType, depth, transparency):
+    """returns whether there's a transparent color key and if so its
+    (full depth) sample values"""
+    if transparency is not None:
+        if colorType == GREY and depth == 16:
+            grey = struct.unpack(">H", transparency[:2])[0]
+            return True, grey, grey, grey
+        if colorType == RGB:
+            return (True,) + struct.unpack(">HHH", transparency[:6])
+    return False, 0, 0, 0
+
+
+cdef Py_ssize_t _decode_pass(unsigned char[:] raw, Py_ssize_t offset,
+        _DTYPE_t[:] pixels, int width, int columns, int rows, int xStart,
+        int yStart, int xStep, int yStep, int colorType, int depth,
+        int channels, _DTYPE_t[:] lookup, bint hasKey, int keyR, int keyG,
+        int keyB) except -1:
+    cdef int bitsPerPixel = channels * depth
+    cdef int bpp = bitsPerPixel // 8 if bitsPerPixel >= 8 else 1
+    cdef Py_ssize_t stride = (((<Py_ssize_t>columns * bitsPerPixel) + 7) //
+            8)
+    cdef Py_ssize_t previous = -1 # The first row has no previous row
+    cdef int row, kind
+    for row in range(rows):
+        if offset + 1 + stride > raw.shape[0]:
+            raise Error("truncated PNG image data")
+        kind = raw[offset]
+        if not _unfilter(raw, offset + 1, previous, stride, bpp, kind):
+            raise Error("invalid PNG filter type {}".format(kind))
+        _convert_row(raw, offset + 1, pixels,
+                ((yStart + (row * yStep)) * width) + xStart, xStep, columns,
+                colorType, depth, lookup, hasKey, keyR, keyG, keyB)
+        previous = offset + 1
+        offset += 1 + stride
+    return offset
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef bint _unfilter(unsigned char[:] raw, Py_ssize_t current,
+        Py_ssize_t previous, Py_ssize_t stride, int bpp, int kind
+        ) noexcept nogil:
+    cdef Py_ssize_t i
+    cdef int left, up, upLeft
+    if kind == NONE:
+        return True
+    if kind == SUB:
+        for i in range(bpp, stride):
+            raw[current + i] = (raw[current + i] +
+                                raw[current + i - bpp]) & 0xFF
+    elif kind == UP:
+        if previous >= 0:
+            for i in range(stride):
+                raw[current + i] = (raw[current + i] +
+                                    raw[previous + i]) & 0xFF
+    elif kind == AVERAGE or kind == PAETH:
+        for i in range(stride):
+            left = raw[current + i - bpp] if i >= bpp else 0
+            up = raw[previous + i] if previous >= 0 else 0
+            if kind == AVERAGE:
+                raw[current + i] = (raw[current + i] +
+                                    ((left + up) >> 1)) & 0xFF
+            else:
+                upLeft = (raw[previous + i - bpp]
+                          if previous >= 0 and i >= bpp else 0)
+                raw[current + i] = (raw[current + i] +
+                                    _paeth(left, up, upLeft)) & 0xFF
+    else:
+        return False
+    return True
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef void _convert_row(unsigned char[:] raw, Py_ssize_t start,
+        _DTYPE_t[:] pixels, Py_ssize_t index, int xStep, int columns,
+        int colorType, int depth, _DTYPE_t[:] lookup, bint hasKey,
+        int keyR, int keyG, int keyB) noexcept nogil:
+    cdef int size = depth // 8 # bytes per sample for 8 and 16 bit depths
+    cdef int mask = (1 << depth) - 1
+    cdef Py_ssize_t i = start
+    cdef int column, bit, a, r, g, b
+    if depth < 8: # GREY or PALETTE packed several samples per byte
+        for column in range(columns):
+            bit = column * depth
+            pixels[index] = lookup[(raw[start + (bit >> 3)] >>
+                                    (8 - depth - (bit & 7))) & mask]
+            index += xStep
+    elif depth == 8 and (colorType == GREY or colorType == PALETTE):
+        for column in range(columns):
+            pixels[index] = lookup[raw[i]]
+            i += 1
+            index += xStep
+    else:
+        for column in range(columns):
+            a = 0xFF
+            if colorType == GREY:
+                r = g = b = _component(raw, i, size)
+                if hasKey and _sample(raw, i, size) == keyR:
+                    a = 0
+                i += size
+            elif colorType == GREY_ALPHA:
+                r = g = b = _component(raw, i, size)
+                a = _component(raw, i + size, size)
+                i += 2 * size
+            else: # RGB or RGBA
+                r = _component(raw, i, size)
+                g = _component(raw, i + size, size)
+                b = _component(raw, i + (2 * size), size)
+                if colorType == RGBA:
+                    a = _component(raw, i + (3 * size), size)
+                    i += 4 * size
+                else:
+                    if (hasKey and _sample(raw, i, size) == keyR and
+                            _sample(raw, i + size, size) == keyG and
+                            _sample(raw, i + (2 * size), size) == keyB):
+                        a = 0
+                    i += 3 * size
+            pixels[index] = _color_for_argb(a, r, g, b)
+            index += xStep
+
+
+def save(image, str filename):
+    cdef int width = image.width
+    cdef int height = image.height
+    cdef Py_ssize_t stride = <Py_ssize_t>width * 4
+    rgba = bytearray(stride * height)
+    data = bytearray((stride + 1) * height)
+    _swizzle(image.pixels, rgba)
+    _filter(rgba, data, height, stride)
+    with open(filename, "wb") as file:
+        file.write(_SIGNATURE)
+        _write_chunk(file, b"IHDR", struct.pack(">IIBBBBB", width, height,
+                8, RGBA, 0, 0, 0))
+        _write_chunk(file, b"IDAT", zlib.compress(data))
+        _write_chunk(file, b"IEND", b"")
+
+
+def _write_chunk(file, kind, data):
+    file.write(struct.pack(">I", len(data)))
+    file.write(kind)
+    file.write(data)
+    file.write(struct.pack(">I", zlib.crc32(data, zlib.crc32(kind)) &
+            0xFFFFFFFF))
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef void _swizzle(_DTYPE_t[:] pixels, unsigned char[:] rgba):
+    """converts ARGB colors to RGBA bytes"""
+    cdef Py_ssize_t index, i
+    cdef _DTYPE_t color
+    with nogil:
+        for index in range(pixels.shape[0]):
+            color = pixels[index]
+            i = index * 4
+            rgba[i] = (color >> 16) & 0xFF
+            rgba[i + 1] = (color >> 8) & 0xFF
+            rgba[i + 2] = color & 0xFF
+            rgba[i + 3] = (color >> 24) & 0xFF
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef void _filter(unsigned char[:] rgba, unsigned char[:] data, int height,
+        Py_ssize_t stride):
+    """filters each row using whichever filter gives the smallest sum of
+    absolute differences (the heuristic recommended by the PNG spec)"""
+    cdef Py_ssize_t current, previous, target, i, cost, bestCost
+    cdef int y, kind, best, value
+    with nogil:
+        for y in range(height):
+            current = y * stride
+            previous = current - stride if y > 0 else -1
+            best = NONE
+            bestCost = -1
+            for kind in range(NONE, PAETH + 1):
+                cost = 0
+                for i in range(stride):
+                    value = _filtered(rgba, current, previous, i, kind)
+                    cost += value if value < 128 else 256 - value
+                    if bestCost != -1 and cost >= bestCost:
+                        break
+                if bestCost == -1 or cost < bestCost:
+                    best = kind
+                    bestCost = cost
+            target = y * (stride + 1)
+            data[target] = best
+            for i in range(stride):
+                data[target + 1 + i] = _filtered(rgba, current, previous,
+                        i, best)
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef inline int _filtered(unsigned char[:] rgba, Py_ssize_t current,
+        Py_ssize_t previous, Py_ssize_t i, int kind) noexcept nogil:
+    cdef int value = rgba[current + i]
+    cdef int left = rgba[current + i - 4] if i >= 4 else 0
+    cdef int up = rgba[previous + i] if previous >= 0 else 0
+    cdef int upLeft
+    if kind == SUB:
+        value -= left
+    elif kind == UP:
+        value -= up
+    elif kind == AVERAGE:
+        value -= (left + up) >> 1
+    elif kind == PAETH:
+        upLeft = rgba[previous + i - 4] if previous >= 0 and i >= 4 else 0
+        value -= _paeth(left, up, upLeft)
+    return value & 0xFF
+
+
+cdef inline int _paeth(int a, int b, int c) noexcept nogil:
+    cdef int p = a + b - c
+    cdef int pa = abs(p - a)
+    cdef int pb = abs(p - b)
+    cdef int pc = abs(p - c)
+    if pa <= pb and pa <= pc:
+        return a
+    if pb <= pc:
+        return b
+    return c
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef inline int _sample(unsigned char[:] raw, Py_ssize_t i, int size
+        ) noexcept nogil:
+    # The most significant byte of a 16-bit sample comes first
+    return raw[i] if size == 1 else (raw[i] << 8) | raw[i + 1]
+
+
+@cython.cdivision(True)
+cdef inline int _component(unsigned char[:] raw, Py_ssize_t i, int size
+        ) noexcept nogil:
+    """returns the 8-bit color component for an 8 or 16-bit sample"""
+    if size == 1:
+        return raw[i]
+    return ((_sample(raw, i, size) * 0xFF) + 0x7FFF) // 0xFFFF # Rounded
+
+
+cdef inline _DTYPE_t _color_for_argb(int a, int r, int g, int b
+        ) noexcept nogil:
+    """returns a numpy.uint32 representing the given ARGB values"""
+    return (((a & 0xFF) << 24) | ((r & 0xFF) << 16) | ((g & 0xFF) << 8) |
+            (b & 0xFF))
@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+# cython: language_level=3
+# Copyright © 2012 Qtrac Ltd. All rights reserved.
+# This program or module is free software: you can redistribute it
+# and/or modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version. It is provided for
+# educational purposes and is distributed in the hope that it will be
+# useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+
+# The drawing primitives used by cyImage's Image and (as its "cyimage"
+# line, rectangle, and ellipse backends) by Image.Image. They draw
+# exactly the same pixels as Image's pure Python methods.
+
+from libc.math cimport rint
+from libc.stdlib cimport abs
+import numpy
+cimport numpy
+cimport cython
+
+
+ctypedef numpy.uint32_t _DTYPE_t
+
+
+def line(_DTYPE_t[:] pixels, int width, int height, int x0, int y0,
+        int x1, int y1, _DTYPE_t color):
+    """draws the line in the given color, changing the pixels in place"""
+    with nogil:
+        _line(pixels, width, height, x0, y0, x1, y1, color)
+
+
+def rectangle(_DTYPE_t[:] pixels, int width, int height, int x0, int y0,
+        int x1, int y1, outline=None, fill=None):
+    """draws a rectangle with the given outline and fill colors (either
+    may be None), changing the pixels in place"""
+    cdef int y
+    cdef _DTYPE_t color
+    if fill is not None:
+        color = fill
+        if y0 > y1:
+            y0, y1 = y1, y0
+        if outline is not None: # no point drawing over the outline
+            x0 += 1
+            x1 -= 1
+            y0 += 1
+            y1 -= 1
+        with nogil:
+            for y in range(y0, y1 + 1):
+                _span(pixels, width, height, x0, x1, y, color)
+    if outline is not None:
+        color = outline
+        with nogil:
+            _line(pixels, width, height, x0, y0, x1, y0, color)
+            _line(pixels, width, height, x1, y0, x1, y1, color)
+            _line(pixels, width, height, x1, y1, x0, y1, color)
+            _line(pixels, width, height, x0, y1, x0, y0, color)
+
+
+def ellipse(_DTYPE_t[:] pixels, int width, int height, int x0, int y0,
+        int x1, int y1, outline=None, fill=None):
+    """draws an ellipse with the given outline and fill colors (either
+    may be None), changing the pixels in place"""
+    cdef _DTYPE_t color
+    if x0 > x1:
+        x0, x1 = x1, x0
+    if y0 > y1:
+        y0, y1 = y1, y0
+    if fill is not None:
+        color = fill
+        with nogil:
+            _ellipse_fill(pixels, width, height, x0, y0, x1, y1, color)
+    if outline is not None:
+        color = outline
+        with nogil:
+            _ellipse_outline(pixels, width, height, x0, y0, x1, y1, color)
+
+
+# The drawing primitives work directly on the pixels memory view without
+# the GIL. Pixels that fall outside the image are silently clipped.
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef inline void _set_pixel(_DTYPE_t[:] pixels, int width, int height,
+        int x, int y, _DTYPE_t color) noexcept nogil:
+    if 0 <= x < width and 0 <= y < height:
+        pixels[(y * width) + x] = color
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef inline void _span(_DTYPE_t[:] pixels, int width, int height, int x0,
+        int x1, int y, _DTYPE_t color) noexcept nogil:
+    """fills the horizontal run of pixels from x0 to x1 inclusive"""
+    cdef int x, offset
+    if y < 0 or y >= height:
+        return
+    if x0 > x1:
+        x0, x1 = x1, x0
+    if x0 < 0:
+        x0 = 0
+    if x1 >= width:
+        x1 = width - 1
+    offset = y * width # Compute this per span rather than per pixel
+    for x in range(x0, x1 + 1):
+        pixels[offset + x] = color
+
+
+# Bresenham's mid-point line scanning algorithm from 
+# http://en.wikipedia.org/wiki/Bresenham%27s_line_algorithm 
+cdef void _line(_DTYPE_t[:] pixels, int width, int height, int x0, int y0,
+        int x1, int y1, _DTYPE_t color) noexcept nogil:
+    if y0 == y1: # Horizontal lines are common (e.g., rectangles)
+        _span(pixels, width, height, x0, x1, y0, color)
+        return
+    cdef int dx = abs(x1 - x0)
+    cdef int dy = abs(y1 - y0)
+    cdef int xInc = 1 if x0 < x1 else -1
+    cdef int yInc = 1 if y0 < y1 else -1
+    cdef int err = dx - dy
+    cdef int err2
+    while True:
+        _set_pixel(pixels, width, height, x0, y0, color)
+        if x0 == x1 and y0 == y1:
+            break
+        err2 = 2 * err
+        if err2 > -dy:
+            err -= dy
+            x0 += xInc
+        if err2 < dx:
+            err += dx
+            y0 += yInc
+
+
+# Algorithm based on
+# http://stackoverflow.com/questions/10322341/
+# simple-algorithm-for-drawing-filled-ellipse-in-c-c
+# but since the ellipse is symmetrical each row is filled as a single
+# span from its leftmost inside pixel to its rightmost.
+@cython.cdivision(True)
+cdef void _ellipse_fill(_DTYPE_t[:] pixels, int width, int height, int x0,
+        int y0, int x1, int y1, _DTYPE_t color) noexcept nogil:
+    cdef int halfWidth = (x1 - x0) // 2
+    cdef int halfHeight = (y1 - y0) // 2
+    cdef int midX = x0 + halfWidth
+    cdef int midY = y0 + halfHeight
+    cdef int x, y
+    cdef double dx, dy
+    for y in range(-halfHeight, halfHeight + 1):
+        dy = (<double>y / halfHeight) if halfHeight else 0.0
+        for x in range(-halfWidth, 1):
+            dx = (<double>x / halfWidth) if halfWidth else 0.0
+            if ((dx * dx) + (dy * dy)) <= 1:
+                _span(pixels, width, height, midX + x, midX - x, midY + y,
+                        color)
+                break
+
+
+# Midpoint ellipse algorithm from "Computer Graphics Principles and
+# Practice".
+cdef void _ellipse_outline(_DTYPE_t[:] pixels, int width, int height,
+        int x0, int y0, int x1, int y1, _DTYPE_t color) noexcept nogil:
+    cdef int midX = ((x1 - x0) // 2) + x0
+    cdef int midY = ((y1 - y0) // 2) + y0
+    cdef double a = abs(x1 - x0) / 2.0
+    cdef double b = abs(y1 - y0) / 2.0
+    cdef double a2 = a * a
+    cdef double b2 = b * b
+    cdef int dx = 0
+    cdef double dy = b
+    cdef double p = b2 - (a2 * b) + (a2 / 4)
+    _ellipse_point(pixels, width, height, midX, midY, dx, dy, color)
+    while (a2 * (dy - 0.5)) > (b2 * (dx + 1)):
+        if p < 0:
+            p += b2 * ((2 * dx) + 3)
+            dx += 1
+        else:
+            p += (b2 * ((2 * dx) + 3)) + (a2 * ((-2 * dy) + 2))
+            dx += 1
+            dy -= 1
+        _ellipse_point(pixels, width, height, midX, midY, dx, dy, color)
+    p = ((b2 * ((dx + 0.5) * (dx + 0.5))) + (a2 * ((dy - 1) * (dy - 1))) -
+         (a2 * b2))
+    while dy > 0:
+        if p < 0:
+            p += (b2 * ((2 * dx) + 2)) + (a2 * ((-2 * dy) + 3))
+            dx += 1
+            dy -= 1
+        else:
+            p += a2 * ((-2 * dy) + 3)
+            dy -= 1
+        _ellipse_point(pixels, width, height, midX, midY, dx, dy, color)
+
+
+cdef inline void _ellipse_point(_DTYPE_t[:] pixels, int width, int height,
+        int midX, int midY, int dx, double dy, _DTYPE_t color
+        ) noexcept nogil:
+    # dx is always an int; dy is always a double. rint() rounds halves to
+    # even as Python's round() does (C's round() rounds them away from 0)
+    _set_pixel(pixels, width, height, midX + dx, <int>rint(midY + dy),
+            color)
+    _set_pixel(pixels, width, height, midX - dx, <int>rint(midY - dy),
+            color)
+    _set_pixel(pixels, width, height, midX + dx, <int>rint(midY - dy),
+            color)
+    _set_pixel(pixels, width, height, midX - dx, <int>rint(midY + dy),
+            color)
@@ -13,10 +13,21 @@
 # Throughout, pixels and newPixels are really of type
 # numpy.ndarray[_DTYPE_t] but using a memory view is almost 4x faster
 
-from libc.math cimport round # Use C rather than Python round()
+# The row loop runs in parallel using OpenMP if the module was built with
+# it (see setup.py) and serially otherwise; either way it runs without
+# the GIL so that other Python threads can make progress meanwhile.
+
+# rint() rounds halves to even as Python's round() and numpy.round() do
+# (C's round() rounds them away from 0), so every scale() backend
+# produces exactly the same pixels (and numbers of rows and columns)
+from libc.math cimport rint
+import multiprocessing
+import os
 import numpy
 cimport numpy
 cimport cython
+from cython.parallel cimport prange
+from cyImage.Globals import Canceled
 
 
 _DTYPE = numpy.uint32 # See: http://docs.cython.org/src/tutorial/numpy.html
@@ -31,37 +42,91 @@ cdef struct Argb:
 DEF MAX_COMPONENT = 0xFF
 
 
+# The default amount of work between calls to scale()'s progress callback
+PROGRESS_PIXELS = 65536
+
+# The number of threads to use when scale() isn't given a thread count;
+# honors OMP_NUM_THREADS and can be changed at runtime.
+try:
+    THREADS = max(1, int(os.environ.get("OMP_NUM_THREADS", "")))
+except ValueError:
+    THREADS = multiprocessing.cpu_count()
+
+
 @cython.boundscheck(False)
-def scale(_DTYPE_t[:] pixels, int width, int height, double ratio):
+def scale(_DTYPE_t[:] pixels, int width, int height, double ratio,
+        int threads=0, int first=0, int last=-1, progress=None,
+        int every=0):
     """returns a smoothly scaled copy of this image
 
     ratio is how much to scale by, e.g., 0.75 means reduce width and
     height to ¾ their original size, 0.5 to half (making the image ¼
     of the original size), and so on.
+
+    threads is how many threads to scale with; 0 means use THREADS.
+
+    first and last are the range of the scaled image's rows to produce;
+    a last of -1 means up to the last row.
+
+    If progress is given it is called as progress(done, total) with the
+    number of rows produced so far and in all before any rows are
+    scaled and then after every every rows (0 means enough rows to
+    cover about PROGRESS_PIXELS of the original pixels); if it returns a
+    true value Canceled is raised. The callback is made with the GIL held
+    between runs of the parallel row loop so it doesn't slow the loop
+    itself.
     """
     assert 0 < ratio < 1
-    cdef int rows = <int>round(height * ratio)
-    cdef int columns = <int>round(width * ratio)
-    cdef _DTYPE_t[:] newPixels = numpy.zeros(rows * columns, dtype=_DTYPE)
+    cdef int rows = <int>rint(height * ratio)
+    cdef int columns = <int>rint(width * ratio)
+    if last < 0:
+        last = rows
+    assert 0 <= first < last <= rows
+    cdef _DTYPE_t[:] newPixels = numpy.zeros((last - first) * columns,
+            dtype=_DTYPE)
     cdef double yStep = height / rows
     cdef double xStep = width / columns
-    cdef int index = 0
-    cdef int row, column, y0, y1, x0, x1
-    for row in range(rows):
-        y0 = <int>round(row * yStep)
-        y1 = <int>round(y0 + yStep)
-        for column in range(columns):
-            x0 = <int>round(column * xStep)
-            x1 = <int>round(x0 + xStep)
-            newPixels[index] = _mean(pixels, width, height, x0, y0, x1, y1)
-            index += 1
+    cdef int row, top, bottom
+    if threads <= 0:
+        threads = THREADS
+    if progress is None:
+        every = last - first # All the rows in one go
+    elif every <= 0: # Each scaled row covers width / ratio pixels
+        every = max(1, <int>rint(PROGRESS_PIXELS * ratio / width))
+    top = first
+    while top < last:
+        if progress is not None and progress(top - first, last - first):
+            raise Canceled("scaling canceled")
+        bottom = min(top + every, last)
+        for row in prange(top, bottom, nogil=True, num_threads=threads,
+                schedule="static"):
+            _scale_row(pixels, width, height, newPixels, row, first,
+                    columns, xStep, yStep)
+        top = bottom
+    if progress is not None and progress(last - first, last - first):
+        raise Canceled("scaling canceled")
     return columns, newPixels
 
 
+@cython.boundscheck(False)
+cdef void _scale_row(_DTYPE_t[:] pixels, int width, int height,
+        _DTYPE_t[:] newPixels, int row, int first, int columns,
+        double xStep, double yStep) noexcept nogil:
+    cdef int y0 = <int>rint(row * yStep)
+    cdef int y1 = <int>rint(y0 + yStep)
+    cdef int index = (row - first) * columns
+    cdef int column, x0, x1
+    for column in range(columns):
+        x0 = <int>rint(column * xStep)
+        x1 = <int>rint(x0 + xStep)
+        newPixels[index + column] = _mean(pixels, width, height, x0, y0,
+                x1, y1)
+
+
 @cython.cdivision(True)
 @cython.boundscheck(False)
 cdef _DTYPE_t _mean(_DTYPE_t[:] pixels, int width, int height, int x0,
-        int y0, int x1, int y1):
+        int y0, int x1, int y1) noexcept nogil:
     cdef int alphaTotal = 0
     cdef int redTotal = 0
     cdef int greenTotal = 0
@@ -82,21 +147,22 @@ cdef _DTYPE_t _mean(_DTYPE_t[:] pixels, int width, int height, int x0,
             greenTotal += argb.green
             blueTotal += argb.blue
             count += 1
-    cdef int a = <int>round(alphaTotal / count)
-    cdef int r = <int>round(redTotal / count)
-    cdef int g = <int>round(greenTotal / count)
-    cdef int b = <int>round(blueTotal / count)
+    cdef int a = <int>rint(<double>alphaTotal / count)
+    cdef int r = <int>rint(<double>redTotal / count)
+    cdef int g = <int>rint(<double>greenTotal / count)
+    cdef int b = <int>rint(<double>blueTotal / count)
     return _color_for_argb(a, r, g, b)
 
 
-cdef inline Argb _argb_for_color(_DTYPE_t color):
+cdef inline Argb _argb_for_color(_DTYPE_t color) noexcept nogil:
     """returns an ARGB quadruple for a color specified as a numpy.uint32"""
     return Argb((color >> 24) & MAX_COMPONENT,
             (color >> 16) & MAX_COMPONENT, (color >> 8) & MAX_COMPONENT,
             (color & MAX_COMPONENT))
 
 
-cdef inline _DTYPE_t _color_for_argb(int a, int r, int g, int b):
+cdef inline _DTYPE_t _color_for_argb(int a, int r, int g,
+        int b) noexcept nogil:
     """returns a numpy.uint32 representing the given ARGB values"""
     return (((a & MAX_COMPONENT) << 24) | ((r & MAX_COMPONENT) << 16) |
             ((g & MAX_COMPONENT) << 8) | (b & MAX_COMPONENT))
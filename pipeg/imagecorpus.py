@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+# Copyright © 2012-13 Qtrac Ltd. All rights reserved.
+# This program or module is free software: you can redistribute it
+# and/or modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version. It is provided for
+# educational purposes and is distributed in the hope that it will be
+# useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+
+"""
+Creates a reproducible corpus of synthetic images for the benchmarks
+and for the imagescale programs.
+
+The images are drawn with Image's drawing primitives using a random
+palette and random rectangles, ellipses, and lines, plus optional
+noise. Everything is derived from the seed, so the same parameters
+always produce the same files.
+
+    imagecorpus.py -c 50 -d skewed --formats xpm,png /tmp/corpus
+    imagescale-m.py -s 64 /tmp/corpus /tmp/scaled
+"""
+
+import argparse
+import os
+import random
+import sys
+import Image
+import Qtrac
+
+
+DISTRIBUTIONS = ("uniform", "skewed")
+
+
+def main():
+    args = handle_commandline()
+    try:
+        filenames = generate(args.target, args.count, args.min_size,
+                args.max_size, args.distribution, args.formats,
+                args.palette, args.noise, args.seed, report=Qtrac.report)
+    except (EnvironmentError, Image.Error) as err:
+        Qtrac.report("error: {}".format(err), True)
+        sys.exit(1)
+    Qtrac.report("created {} image{} in {}".format(len(filenames),
+            "" if len(filenames) == 1 else "s", args.target), True)
+
+
+def handle_commandline():
+    parser = argparse.ArgumentParser(description="Creates a reproducible "
+            "corpus of synthetic images")
+    parser.add_argument("-c", "--count", type=int, default=20,
+            help="the number of images to create [default: %(default)d]")
+    parser.add_argument("-m", "--min-size", default="32x32",
+            help="the smallest WIDTHxHEIGHT [default: %(default)s]")
+    parser.add_argument("-M", "--max-size", default="400x300",
+            help="the largest WIDTHxHEIGHT [default: %(default)s]")
+    parser.add_argument("-d", "--distribution", choices=DISTRIBUTIONS,
+            default=DISTRIBUTIONS[0],
+            help="how sizes are distributed between the smallest and "
+                "largest; skewed gives mostly small images and a few "
+                "large ones [default: %(default)s]")
+    parser.add_argument("-f", "--formats", default="xpm,xbm,png",
+            help="comma-separated formats to cycle through "
+                "[default: %(default)s]")
+    parser.add_argument("-p", "--palette", type=int, default=16,
+            help="the number of colors to draw with [default: "
+                "%(default)d]")
+    parser.add_argument("-n", "--noise", type=float, default=0.0,
+            help="the fraction of pixels (0.0-1.0) set to random palette "
+                "colors [default: %(default)s]")
+    parser.add_argument("-S", "--seed", type=int, default=1,
+            help="the random seed [default: %(default)d]")
+    parser.add_argument("target",
+            help="the directory for the images (created if necessary)")
+    args = parser.parse_args()
+    try:
+        args.min_size = parse_size(args.min_size)
+        args.max_size = parse_size(args.max_size)
+    except ValueError:
+        parser.error("sizes must be given as WIDTHxHEIGHT, e.g., 64x48")
+    if (args.min_size[0] > args.max_size[0] or
+            args.min_size[1] > args.max_size[1]):
+        parser.error("the minimum size is larger than the maximum size")
+    args.formats = [suffix.strip().lstrip(".").lower()
+                    for suffix in args.formats.split(",") if suffix.strip()]
+    if args.count < 1 or args.palette < 2 or not (0 <= args.noise <= 1):
+        parser.error("need a positive count, a palette of at least two "
+                "colors, and a noise fraction between 0 and 1")
+    return args
+
+
+def parse_size(text):
+    width, height = (int(x) for x in text.lower().split("x"))
+    if width < 4 or height < 4:
+        raise ValueError("too small")
+    return width, height
+
+
+def generate(target, count=20, minSize=(32, 32), maxSize=(400, 300),
+        distribution="uniform", formats=("xpm", "xbm", "png"), palette=16,
+        noise=0.0, seed=1, report=None):
+    """creates count images in the target directory and returns their
+    filenames
+
+    Each image's size is chosen between minSize and maxSize according
+    to the distribution and its format cycles through formats. Each
+    image is drawn using its own random number generator seeded from
+    seed and its index, so an image doesn't change if the count does.
+    """
+    os.makedirs(target, exist_ok=True)
+    rand = random.Random(seed)
+    filenames = []
+    for index in range(count):
+        width, height = random_size(rand, minSize, maxSize, distribution)
+        suffix = formats[index % len(formats)]
+        filename = os.path.join(target, "image{:04d}.{}".format(index,
+                suffix))
+        image = synthetic_image(width, height, palette, noise,
+                (seed * 1000003) + index)
+        image.save(filename)
+        filenames.append(filename)
+        if report is not None:
+            report("created {} ({}x{})".format(filename, width, height))
+    return filenames
+
+
+def random_size(rand, minSize, maxSize, distribution="uniform"):
+    """returns a random (width, height) between minSize and maxSize"""
+    fraction = rand.random()
+    if distribution == "skewed":
+        fraction **= 3
+    width = minSize[0] + round(fraction * (maxSize[0] - minSize[0]))
+    height = minSize[1] + round(fraction * (maxSize[1] - minSize[1]))
+    return width, height
+
+
+def synthetic_image(width, height, palette=16, noise=0.0, seed=1):
+    """returns a reproducible image of the given size drawn with a
+    random palette of palette colors
+
+    The number of shapes drawn grows with the image's area so that
+    large images have as much detail as small ones; noise is the
+    fraction of pixels set to a random palette color.
+    """
+    assert width >= 4 and height >= 4
+    rand = random.Random(seed)
+    colors = [Image.color_for_rgb(rand.randrange(256), rand.randrange(256),
+              rand.randrange(256)) for _ in range(palette)]
+    image = Image.Image.create(width, height, colors[0])
+    for _ in range(max(4, (width * height) // 2000)):
+        x0 = rand.randrange(width - 2)
+        x1 = rand.randrange(x0 + 2, width)
+        y0 = rand.randrange(height - 2)
+        y1 = rand.randrange(y0 + 2, height)
+        color = rand.choice(colors)
+        shape = rand.random()
+        if shape < 0.4:
+            image.rectangle(x0, y0, x1, y1, outline=rand.choice(colors),
+                            fill=color)
+        elif shape < 0.8:
+            image.ellipse(x0, y0, x1, y1, fill=color)
+        else:
+            image.line(x0, y0, x1, y1, color)
+    for _ in range(round(width * height * noise)):
+        image.set_pixel(rand.randrange(width), rand.randrange(height),
+                        rand.choice(colors))
+    return image
+
+
+if __name__ == "__main__":
+    main()
@@ -9,12 +9,10 @@
 # MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
 # General Public License for more details.
 
+import collections
 import os
 import tempfile
-try:
-    import cyImage as Image
-except ImportError:
-    import Image
+import Image # Uses cyImage's backends if available
 
 
 YELLOW, CYAN, BLUE, RED, BLACK = (Image.color_for_name(color)
@@ -46,6 +44,22 @@ def draw_and_save_image(image, filename):
 
 
 class ImageProxy:
+    """Records drawing commands and only creates and draws the image when
+    it is first needed
+
+    The commands are then coalesced: those whose every pixel is
+    overwritten by a later opaque filled rectangle are dropped, and
+    runs of set_pixel() calls along a row in one color become lines. The
+    rendered images are cached keyed by their command lists so that
+    proxies with the same commands share one rendering, each getting a
+    copy-on-write clone() of it. The cache holds at most RENDERED_BYTES
+    of pixels (least recently used renderings are dropped first) and
+    renderings bigger than that aren't cached at all.
+    """
+
+    Rendered = collections.OrderedDict() # commands: Image; LRU first
+    RenderedBytes = 0
+    RENDERED_BYTES = 32 * 1024 * 1024
 
     def __init__(self, ImageClass, width=None, height=None, filename=None):
         assert (width is not None and height is not None) or \
@@ -62,15 +76,138 @@ class ImageProxy:
     @property
     def image(self):
         if self.__image is None:
-            command = self.commands.pop(0)
-            function, *args = command
-            self.__image = function(*args)
-            for command in self.commands:
-                function, *args = command
-                function(self.image, *args)
+            key = self._key() if hasattr(self.Image, "clone") else None
+            image = ImageProxy.Rendered.get(key) if key is not None else None
+            if image is None:
+                function, *args = self.commands[0]
+                image = function(*args)
+                for function, *args in self._coalesced():
+                    function(image, *args)
+                if key is not None:
+                    self._cache(key, image)
+            else:
+                ImageProxy.Rendered.move_to_end(key)
+            if key is not None:
+                image = image.clone() # So the cached one is never changed
+            self.__image = image
+            self.commands = []
         return self.__image
 
 
+    def _cache(self, key, image):
+        size = image.width * image.height * 4
+        if size > self.RENDERED_BYTES:
+            return
+        ImageProxy.Rendered[key] = image
+        ImageProxy.RenderedBytes += size
+        while ImageProxy.RenderedBytes > self.RENDERED_BYTES:
+            _, old = ImageProxy.Rendered.popitem(last=False)
+            ImageProxy.RenderedBytes -= old.width * old.height * 4
+
+
+    def _key(self):
+        """returns the render cache key for the commands, or None if they
+        can't be cached"""
+        key = tuple(self.commands)
+        if len(self.commands[0]) == 4: # Loaded so include the file's state
+            try:
+                stat = os.stat(self.commands[0][-1])
+            except EnvironmentError:
+                return None # Let loading report the error
+            key += ((stat.st_mtime_ns, stat.st_size),)
+        try:
+            hash(key)
+        except TypeError:
+            return None
+        return key
+
+
+    def _coalesced(self):
+        """returns the drawing commands (i.e., after the first which
+        creates the image) without those whose every pixel is overwritten
+        by a later opaque filled rectangle, and with each run of
+        set_pixel() calls along a row in one color made into a line"""
+        commands = []
+        covers = []
+        for command in reversed(self.commands[1:]):
+            function, *args = command
+            box = self._bounds(function, args)
+            if box is not None and any(_inside(box, cover)
+                                       for cover in covers):
+                continue
+            cover = self._cover(function, args)
+            if cover is not None:
+                covers.append(cover)
+            commands.append(command)
+        commands.reverse()
+        return self._spans(commands)
+
+
+    def _bounds(self, function, args):
+        """returns the (x0, y0, x1, y1) that holds every pixel the
+        command may draw, or None if unknown"""
+        if function is self.Image.set_pixel:
+            x, y = args[:2]
+            return x, y, x, y
+        if function in {self.Image.line, self.Image.rectangle,
+                        self.Image.ellipse}:
+            x0, y0, x1, y1 = args[:4]
+            margin = 0
+            if function is self.Image.ellipse: # Rounding
+                margin = 1
+            elif function is self.Image.rectangle and None not in args[4:]:
+                margin = 1 # Outlined and filled shrinks by 1 (maybe out)
+            return (min(x0, x1) - margin, min(y0, y1) - margin,
+                    max(x0, x1) + margin, max(y0, y1) + margin)
+        return None
+
+
+    def _cover(self, function, args):
+        """returns the (x0, y0, x1, y1) that the command paints over
+        with opaque colors if it is a filled rectangle, otherwise None"""
+        if function is not self.Image.rectangle:
+            return None
+        x0, y0, x1, y1, outline, fill = args
+        if fill is None or not _opaque(fill):
+            return None
+        if outline is None:
+            return min(x0, x1), min(y0, y1), max(x0, x1), max(y0, y1)
+        # An outline is drawn just inside the fill; see Image.rectangle()
+        if _opaque(outline) and x0 < x1 and y0 < y1:
+            return x0 + 1, y0 + 1, x1 - 1, y1 - 1
+        return None
+
+
+    def _spans(self, commands):
+        merged = []
+        span = None # [x0, y, x1, color] of consecutive set_pixel()s
+        for command in commands:
+            function, *args = command
+            if function is self.Image.set_pixel:
+                x, y, color = args
+                if (span is not None and y == span[1] and
+                        color == span[3] and x == span[2] + 1):
+                    span[2] = x
+                    continue
+                self._add_span(merged, span)
+                span = [x, y, x, color]
+            else:
+                self._add_span(merged, span)
+                span = None
+                merged.append(command)
+        self._add_span(merged, span)
+        return merged
+
+
+    def _add_span(self, merged, span):
+        if span is not None:
+            x0, y, x1, color = span
+            if x0 == x1:
+                merged.append((self.Image.set_pixel, x0, y, color))
+            else:
+                merged.append((self.Image.line, x0, y, x1, y, color))
+
+
     def load(self, filename):
         self.__image = None
         self.commands = [(self.Image, None, None, filename)]
@@ -81,21 +218,21 @@ class ImageProxy:
 
 
     def set_pixel(self, x, y, color):
-        if self.image is None:
+        if self.__image is None:
             self.commands.append((self.Image.set_pixel, x, y, color))
         else:
             self.image.set_pixel(x, y, color)
 
 
     def line(self, x0, y0, x1, y1, color):
-        if self.image is None:
+        if self.__image is None:
             self.commands.append((self.Image.line, x0, y0, x1, y1, color))
         else:
             self.image.line(x0, y0, x1, y1, color)
 
 
     def rectangle(self, x0, y0, x1, y1, outline=None, fill=None):
-        if self.image is None:
+        if self.__image is None:
             self.commands.append((self.Image.rectangle, x0, y0, x1, y1,
                     outline, fill))
         else:
@@ -103,7 +240,7 @@ class ImageProxy:
 
 
     def ellipse(self, x0, y0, x1, y1, outline=None, fill=None):
-        if self.image is None:
+        if self.__image is None:
             self.commands.append((self.Image.ellipse, x0, y0, x1, y1,
                     outline, fill))
         else:
@@ -137,5 +274,14 @@ class ImageProxy:
         return self.image.height
 
 
+def _inside(box, cover):
+    return (cover[0] <= box[0] and cover[1] <= box[1] and
+            box[2] <= cover[2] and box[3] <= cover[3])
+
+
+def _opaque(color):
+    return (int(color) >> 24) == 0xFF
+
+
 if __name__ == "__main__":
     main()
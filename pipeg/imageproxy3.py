@@ -0,0 +1,330 @@
+#!/usr/bin/env python3
+# Copyright © 2012-13 Qtrac Ltd. All rights reserved.
+# This program or module is free software: you can redistribute it
+# and/or modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version. It is provided for
+# educational purposes and is distributed in the hope that it will be
+# useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+
+import collections
+import mmap
+import os
+import tempfile
+import time
+import Image # Uses cyImage's backends if available
+import Qtrac
+from Image import Raw
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+YELLOW, CYAN, BLUE, RED = (Image.color_for_name(color)
+    for color in ("yellow", "cyan", "blue", "red"))
+
+
+def main():
+    filename = os.path.join(tempfile.gettempdir(), "huge.argb")
+    start = time.perf_counter()
+    image = TiledImageProxy.create(filename, 8000, 6000, YELLOW)
+    print("created {} ({:,} pixels) in {:.3f} sec".format(filename,
+            image.width * image.height, time.perf_counter() - start))
+    start = time.perf_counter()
+    image.ellipse(4000, 3000, 4120, 3040, BLUE, CYAN)
+    image.rectangle(4060, 3010, 4500, 3030, fill=RED)
+    region = image.crop(3990, 2990, 520, 60)
+    print("drew and cropped with {} of {} tiles resident in {:.3f} "
+            "sec".format(len(image.tiles), image.columns * image.rows,
+            time.perf_counter() - start))
+    filename = os.path.join(tempfile.gettempdir(), "region.xpm")
+    region.save(filename)
+    print("saved", filename)
+    image.close()
+
+
+class TiledImageProxy:
+    """Provides the drawing and pixel methods of an Image for an .argb
+    file (see Image/Raw.py) that may be far too big to load, by reading
+    only the square tiles that each operation touches
+
+    The file is memory mapped and a tile is made into an Image the
+    first time it is used. At most tiles of them are kept (least
+    recently used tiles are discarded first) but tiles that have been
+    drawn on are kept until save()d. So pixel(), crop(), and drawing in
+    a small region of a huge image take time and memory in proportion
+    to the region.
+    """
+
+    def __init__(self, filename, tile=256, tiles=64):
+        assert tile >= 2 and tile % 2 == 0 # Even; see _draw()
+        self.filename = filename
+        self.tile = tile
+        self.most = max(1, tiles)
+        self.tiles = collections.OrderedDict() # (column, row): Image
+        self.dirty = set() # (column, row)s of changed tiles
+        self.file = self.map = self.source = None
+        self._open()
+        self.columns = -(-self.width // tile)
+        self.rows = -(-self.height // tile)
+
+
+    @classmethod
+    def create(Class, filename, width, height, background=None, **kwargs):
+        """creates an .argb file of the given size and background color
+        (row by row, so it needn't fit in memory) and returns a
+        TiledImageProxy for it"""
+        background = background if background is not None else (
+                Image.ColorForName["transparent"])
+        row = Raw.bytes_for_pixels(Image.create_array(width, 1,
+                background))
+        with open(filename, "wb") as file:
+            file.write(Raw.header(width, height))
+            for _ in range(height):
+                file.write(row)
+        return Class(filename, **kwargs)
+
+
+    def _open(self):
+        self.file = open(self.filename, "rb")
+        try:
+            self.width, self.height = Raw.parse_header(self.file.read(
+                    Raw.HEADER_SIZE))
+            size = Raw.HEADER_SIZE + (self.width * self.height * 4)
+            if os.fstat(self.file.fileno()).st_size != size:
+                raise Image.Error("invalid ARGB file: expected {} "
+                        "bytes".format(size))
+            self.map = mmap.mmap(self.file.fileno(), 0,
+                    access=mmap.ACCESS_READ)
+            if numpy is not None: # A zero-copy view of the file's pixels
+                self.source = numpy.frombuffer(self.map, dtype="<u4",
+                        offset=Raw.HEADER_SIZE).reshape(self.height,
+                        self.width)
+        except BaseException:
+            self.close()
+            raise
+
+
+    def close(self):
+        """closes the file; any unsaved changes are lost"""
+        self.source = None # Must go before the map can be closed
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+    @property
+    def size(self):
+        return self.width, self.height
+
+
+    def _tile(self, column, row, dirty=False):
+        """returns the Image for the given tile, reading it from the file
+        if it isn't resident; if dirty is True it will be kept until
+        saved"""
+        key = (column, row)
+        image = self.tiles.get(key)
+        if image is None:
+            image = self.tiles[key] = self._read(column, row)
+        else:
+            self.tiles.move_to_end(key)
+        if dirty:
+            self.dirty.add(key)
+        self._evict()
+        return image
+
+
+    def _read(self, column, row):
+        x0, y0 = column * self.tile, row * self.tile
+        x1 = min(x0 + self.tile, self.width)
+        y1 = min(y0 + self.tile, self.height)
+        if self.source is not None:
+            pixels = self.source[y0:y1, x0:x1].astype(numpy.uint32).ravel()
+        else:
+            pixels = Image.create_array(0, 0)
+            for y in range(y0, y1):
+                pixels.extend(Raw.pixels_for_bytes(self._row_bytes(y, x0,
+                        x1)))
+        return Image.from_data(x1 - x0, pixels)
+
+
+    def _row_bytes(self, y, x0, x1):
+        offset = Raw.HEADER_SIZE + (((y * self.width) + x0) * 4)
+        return self.map[offset:offset + ((x1 - x0) * 4)]
+
+
+    def _evict(self):
+        if len(self.tiles) <= self.most:
+            return
+        for key in list(self.tiles)[:-1]: # LRU first; not the newest
+            if key not in self.dirty:
+                del self.tiles[key]
+                if len(self.tiles) <= self.most:
+                    break
+
+
+    def pixel(self, x, y):
+        """returns the color at the given pixel as an ARGB int; x and y
+        must be in range"""
+        tile = self._tile(x // self.tile, y // self.tile)
+        return tile.pixel(x % self.tile, y % self.tile)
+
+
+    def set_pixel(self, x, y, color):
+        """sets the given pixel to the given color; x and y must be in
+        range; color must be an ARGB int"""
+        tile = self._tile(x // self.tile, y // self.tile, True)
+        tile.set_pixel(x % self.tile, y % self.tile, color)
+
+
+    def line(self, x0, y0, x1, y1, color):
+        self._draw(Image.Image.line, x0, y0, x1, y1, color)
+
+
+    def rectangle(self, x0, y0, x1, y1, outline=None, fill=None):
+        self._draw(Image.Image.rectangle, x0, y0, x1, y1, outline, fill)
+
+
+    def ellipse(self, x0, y0, x1, y1, outline=None, fill=None):
+        self._draw(Image.Image.ellipse, x0, y0, x1, y1, outline, fill)
+
+
+    def _draw(self, method, x0, y0, x1, y1, *args):
+        """draws using the Image method on the tile or cropped region that
+        holds (x0, y0, x1, y1) (plus a pixel's margin since rectangle()
+        and ellipse() can draw just beyond it)
+
+        The offsets are kept even because ellipse() uses round() which
+        rounds halves to even, so moving by an odd offset would move
+        some of its pixels by one.
+        """
+        left = max(0, min(x0, x1) - 1)
+        top = max(0, min(y0, y1) - 1)
+        right = min(self.width - 1, max(x0, x1) + 1)
+        bottom = min(self.height - 1, max(y0, y1) + 1)
+        column, row = left // self.tile, top // self.tile
+        if right // self.tile == column and bottom // self.tile == row:
+            image = self._tile(column, row, True)
+            x, y = column * self.tile, row * self.tile
+            method(image, x0 - x, y0 - y, x1 - x, y1 - y, *args)
+        else:
+            x, y = left - (left % 2), top - (top % 2)
+            image = self.crop(x, y, right + 1 - x, bottom + 1 - y)
+            method(image, x0 - x, y0 - y, x1 - x, y1 - y, *args)
+            self.paste(image, x, y)
+
+
+    def crop(self, x, y, width, height):
+        """returns a new Image of the given width and height copied from
+        this image with its top-left corner at (x, y); the region must be
+        inside this image"""
+        if not (0 <= x and 0 <= y and 0 < width and 0 < height and
+                x + width <= self.width and y + height <= self.height):
+            raise Image.Error("can't crop a {}x{} region at ({}, {}) from "
+                    "a {}x{} image".format(width, height, x, y, self.width,
+                    self.height))
+        image = Image.create(width, height)
+        for (column, row), x0, y0, x1, y1 in self._overlaps(x, y, width,
+                height):
+            tile = self._tile(column, row)
+            _copy(tile.pixels, tile.width, x0 - (column * self.tile),
+                    y0 - (row * self.tile), image.pixels, width, x0 - x,
+                    y0 - y, x1 - x0, y1 - y0)
+        return image
+
+
+    def paste(self, image, x, y):
+        """copies the other image onto this one with its top-left corner
+        at (x, y); the parts that fall outside this image are ignored"""
+        x0, y0 = max(0, x), max(0, y)
+        x1 = min(self.width, x + image.width)
+        y1 = min(self.height, y + image.height)
+        if x0 >= x1 or y0 >= y1:
+            return
+        for (column, row), x0, y0, x1, y1 in self._overlaps(x0, y0,
+                x1 - x0, y1 - y0):
+            tile = self._tile(column, row, True)
+            _copy(image.pixels, image.width, x0 - x, y0 - y, tile.pixels,
+                    tile.width, x0 - (column * self.tile),
+                    y0 - (row * self.tile), x1 - x0, y1 - y0)
+
+
+    def _overlaps(self, x, y, width, height):
+        """yields the (column, row) of each tile that overlaps the region
+        and the (x0, y0, x1, y1) of the overlap (x1 and y1 exclusive)"""
+        for row in range(y // self.tile, (y + height - 1) // self.tile + 1):
+            top = row * self.tile
+            for column in range(x // self.tile,
+                                (x + width - 1) // self.tile + 1):
+                left = column * self.tile
+                yield ((column, row), max(x, left), max(y, top),
+                       min(x + width, left + self.tile),
+                       min(y + height, top + self.tile))
+
+
+    def save(self, filename=None):
+        """saves the image; to an .argb file this is done row by row, but
+        any other format needs the whole image to be in memory
+
+        Saving to the proxy's own file writes a new file and replaces the
+        old one so that it is never left half written.
+        """
+        filename = filename if filename is not None else self.filename
+        if os.path.splitext(filename)[1].lower() != ".argb":
+            self.crop(0, 0, self.width, self.height).save(filename)
+            return
+        descriptor, temporary = tempfile.mkstemp(
+                dir=os.path.dirname(os.path.abspath(filename)),
+                suffix=".argb")
+        try:
+            with open(descriptor, "wb") as file:
+                file.write(Raw.header(self.width, self.height))
+                for y in range(self.height):
+                    file.write(self._save_row(y))
+            if os.path.abspath(filename) == os.path.abspath(
+                    self.filename):
+                self.close() # Some platforms can't replace a mapped file
+                os.replace(temporary, filename)
+                self._open()
+                self.dirty.clear()
+            else:
+                os.replace(temporary, filename)
+        finally:
+            Qtrac.remove_if_exists(temporary) # Only if not replaced
+
+
+    def _save_row(self, y):
+        row = y // self.tile
+        top = row * self.tile
+        parts = []
+        for column in range(self.columns):
+            x0 = column * self.tile
+            x1 = min(x0 + self.tile, self.width)
+            if (column, row) in self.dirty:
+                tile = self.tiles[column, row]
+                start = (y - top) * tile.width
+                parts.append(Raw.bytes_for_pixels(
+                        tile.pixels[start:start + tile.width]))
+            else: # Unchanged so the file's bytes are just what's needed
+                parts.append(self._row_bytes(y, x0, x1))
+        return b"".join(parts)
+
+
+def _copy(source, sourceWidth, sx, sy, target, targetWidth, tx, ty, width,
+        height):
+    """copies the width x height rectangle at (sx, sy) of the source
+    pixels to (tx, ty) of the target pixels"""
+    for y in range(height):
+        s = ((sy + y) * sourceWidth) + sx
+        t = ((ty + y) * targetWidth) + tx
+        target[t:t + width] = source[s:s + width]
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,295 @@
+#!/usr/bin/env python3
+# Copyright © 2012-13 Qtrac Ltd. All rights reserved.
+# This program or module is free software: you can redistribute it
+# and/or modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version. It is provided for
+# educational purposes and is distributed in the hope that it will be
+# useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+
+import argparse
+import asyncio
+import collections
+import concurrent.futures
+import math
+import multiprocessing
+import os
+import sys
+import time
+import Image
+import ImageJobs
+import Qtrac
+
+
+Result = collections.namedtuple("Result",
+        "copied scaled name stats seconds bytes timing")
+Summary = collections.namedtuple("Summary", "todo copied scaled canceled")
+Limits = collections.namedtuple("Limits", "threads window runStats")
+
+
+def main():
+    (size, smooth, source, target, concurrency, limits,
+     manifest) = handle_commandline()
+    Qtrac.report("starting...")
+    summary = scale(size, smooth, source, target, concurrency, limits,
+            manifest)
+    if manifest is not None:
+        manifest.save()
+    if limits.runStats is not None:
+        limits.runStats.save()
+    summarize(summary, concurrency)
+
+
+def handle_commandline():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-c", "--concurrency", type=int,
+            default=multiprocessing.cpu_count(),
+            help="specify the concurrency (for debugging and "
+                "timing) [default: %(default)d]")
+    parser.add_argument("-t", "--threads", type=int, default=4,
+            help="the most files to be reading and the most to be "
+                "writing at any one time [default: %(default)d]")
+    parser.add_argument("-w", "--window", type=int, default=0,
+            help="the most images waiting between one stage (reading, "
+                "scaling, writing) and the next [default: 2 × "
+                "concurrency]")
+    parser.add_argument("-s", "--size", default=400, type=int,
+            help="make a scaled image that fits the given dimension "
+                "[default: %(default)d]")
+    parser.add_argument("-S", "--smooth", action="store_true",
+            help="use smooth scaling (slow but good for text)")
+    parser.add_argument("-i", "--incremental", action="store_true",
+            help="only scale images that are new or changed (or whose "
+                "size or smooth option differs) since the last "
+                "incremental run into the target directory")
+    parser.add_argument("--clean", action="store_true",
+            help="with --incremental, delete target images whose source "
+                "images no longer exist")
+    parser.add_argument("--stats", metavar="FILE",
+            help="write each image's read, load, scale, save, and write "
+                "times and sizes, queue wait, per-worker throughput, and "
+                "latency percentiles to FILE as JSON")
+    parser.add_argument("source",
+            help="the directory containing the original .xpm images")
+    parser.add_argument("target",
+            help="the directory for the scaled .xpm images")
+    args = parser.parse_args()
+    if args.concurrency < 1 or args.threads < 1:
+        parser.error("the concurrency and threads must be at least 1")
+    source = os.path.abspath(args.source)
+    target = os.path.abspath(args.target)
+    if source == target:
+        parser.error("source and target must be different")
+    if not os.path.exists(args.target):
+        os.makedirs(target)
+    manifest = None
+    if args.incremental:
+        manifest = ImageJobs.Manifest(target, (args.size, args.smooth),
+                args.clean)
+    runStats = None
+    if args.stats:
+        runStats = ImageJobs.RunStats(args.stats,
+                os.path.basename(sys.argv[0]), args.concurrency)
+    limits = Limits(args.threads, args.window if args.window > 0 else
+            2 * args.concurrency, runStats)
+    return (args.size, args.smooth, source, target, args.concurrency,
+            limits, manifest)
+
+
+def scale(size, smooth, source, target, concurrency, limits, manifest):
+    loop = asyncio.new_event_loop()
+    task = loop.create_task(pipeline(size, smooth, source, target,
+            concurrency, limits, manifest))
+    try:
+        return loop.run_until_complete(task)
+    except KeyboardInterrupt: # May not work on Windows
+        Qtrac.report("canceling...")
+        task.cancel()
+        return loop.run_until_complete(task)
+    finally:
+        loop.close()
+
+
+async def pipeline(size, smooth, source, target, concurrency, limits,
+        manifest):
+    """reads each source image's bytes (in a thread), decodes, scales,
+    and encodes them (in a process), and writes the new bytes (in a
+    thread), with at most limits.window images waiting between stages
+
+    Since reading and writing don't hold up the processes, slow storage
+    (e.g., a network share) doesn't leave them idle as long as enough
+    threads are reading ahead.
+    """
+    loop = asyncio.get_event_loop()
+    counts = collections.Counter()
+    toRead = asyncio.Queue(limits.window)
+    toScale = asyncio.Queue(limits.window)
+    toWrite = asyncio.Queue(limits.window)
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=2 * limits.threads) as threads, \
+            concurrent.futures.ProcessPoolExecutor(
+            max_workers=concurrency) as processes:
+        readers = [loop.create_task(read_files(loop, threads, toRead,
+                   toScale, limits.runStats))
+                   for _ in range(limits.threads)]
+        scalers = [loop.create_task(scale_images(loop, processes, size,
+                   smooth, toScale, toWrite)) for _ in range(concurrency)]
+        writers = [loop.create_task(write_files(loop, threads, toWrite,
+                   counts, manifest, limits.runStats))
+                   for _ in range(limits.threads)]
+        try:
+            await add_jobs(loop, threads, source, target, toRead, counts,
+                    manifest)
+            await stop(toRead, readers)
+            await stop(toScale, scalers)
+            await stop(toWrite, writers)
+        except asyncio.CancelledError:
+            for task in readers + scalers + writers:
+                task.cancel()
+            await asyncio.gather(*readers, *scalers, *writers,
+                    return_exceptions=True)
+            counts["canceled"] = True
+    return Summary(counts["todo"], counts["copied"], counts["scaled"],
+            bool(counts["canceled"]))
+
+
+async def add_jobs(loop, threads, source, target, toRead, counts,
+        manifest):
+    jobs = ImageJobs.get_jobs(source, target, manifest)
+    while True: # The directory walk may be slow too so use a thread
+        job = await loop.run_in_executor(threads, next, jobs, None)
+        if job is None:
+            break
+        counts["todo"] += 1
+        await toRead.put(job)
+
+
+async def stop(queue, tasks):
+    """tells the tasks that get from queue to finish once they've
+    handled what's already in it, and waits until they have"""
+    for _ in tasks:
+        await queue.put(None)
+    await asyncio.gather(*tasks)
+
+
+async def read_files(loop, threads, toRead, toScale, runStats):
+    while True:
+        job = await toRead.get()
+        if job is None:
+            break
+        start = time.perf_counter()
+        try:
+            data = await loop.run_in_executor(threads, read_file, job[0])
+        except EnvironmentError as err:
+            Qtrac.report(str(err), True)
+            continue
+        if runStats is not None: # Time queued for a process from now
+            runStats.submit([job])
+        await toScale.put((job, data, time.perf_counter() - start))
+
+
+async def scale_images(loop, processes, size, smooth, toScale, toWrite):
+    while True:
+        item = await toScale.get()
+        if item is None:
+            break
+        (sourceImage, targetImage), data, seconds = item
+        try:
+            result, newData = await loop.run_in_executor(processes,
+                    scale_one, size, smooth, data, sourceImage, targetImage)
+        except Exception as err: # E.g., the process died; keep draining
+            Qtrac.report("{}: {}".format(sourceImage, err), True)
+            continue
+        Image.merge_stats(result.stats)
+        if result.timing is not None:
+            result.timing["stages"]["read"] = seconds
+        if newData is not None:
+            await toWrite.put((result, newData))
+
+
+async def write_files(loop, threads, toWrite, counts, manifest,
+        runStats):
+    while True:
+        item = await toWrite.get()
+        if item is None:
+            break
+        result, data = item
+        start = time.perf_counter()
+        try:
+            await loop.run_in_executor(threads, write_file, result.name,
+                    data)
+        except EnvironmentError as err:
+            Qtrac.report(str(err), True)
+            continue
+        if runStats is not None:
+            result.timing["stages"]["write"] = time.perf_counter() - start
+            runStats.add(result.timing)
+        counts["copied"] += result.copied
+        counts["scaled"] += result.scaled
+        if manifest is not None:
+            manifest.done(result.name)
+        Qtrac.report("{} {}".format("copied" if result.copied else
+                "scaled", os.path.basename(result.name)))
+
+
+def read_file(filename):
+    with open(filename, "rb") as file:
+        return file.read()
+
+
+def write_file(filename, data):
+    with open(filename, "wb") as file:
+        file.write(data)
+
+
+def scale_one(size, smooth, data, sourceImage, targetImage):
+    """returns a Result and the bytes of the target image (or None if
+    the source image couldn't be loaded or scaled)"""
+    start = time.perf_counter()
+    timer = ImageJobs.Timer(targetImage)
+    try:
+        oldImage = Image.from_bytes(data, sourceImage)
+        timer.lap("load")
+        if oldImage.width <= size and oldImage.height <= size:
+            newImage = oldImage
+            copied, scaled = 1, 0
+        else:
+            if smooth:
+                scale = min(size / oldImage.width, size / oldImage.height)
+                newImage = oldImage.scale(scale)
+            else:
+                stride = int(math.ceil(max(oldImage.width / size,
+                                           oldImage.height / size)))
+                newImage = oldImage.subsample(stride)
+            timer.lap("scale")
+            copied, scaled = 0, 1
+        newData = newImage.to_bytes(targetImage)
+        timer.lap("save")
+    except Exception as err: # E.g., a corrupt image; keep the process
+        Qtrac.report("{}: {}".format(sourceImage, err), True)
+        return Result(0, 0, targetImage, Image.stats(reset=True), 0,
+                len(data), None), None
+    timing = timer.record(oldImage.width * oldImage.height, len(data),
+            len(newData))
+    return Result(copied, scaled, targetImage, Image.stats(reset=True),
+            time.perf_counter() - start, len(data), timing), newData
+
+
+def summarize(summary, concurrency):
+    message = "copied {} scaled {} ".format(summary.copied, summary.scaled)
+    difference = summary.todo - (summary.copied + summary.scaled)
+    if difference:
+        message += "skipped {} ".format(difference)
+    message += "using {} processes".format(concurrency)
+    if summary.canceled:
+        message += " [canceled]"
+    Qtrac.report(message)
+    print()
+    if Image.stats():
+        print(Image.format_stats())
+
+
+if __name__ == "__main__":
+    main()
@@ -16,21 +16,29 @@ import multiprocessing
 import os
 import sys
 import Image
+import ImageJobs
 import Qtrac
 
 
-Result = collections.namedtuple("Result", "todo copied scaled name")
+Result = collections.namedtuple("Result",
+        "todo copied scaled name timing")
 
 
 def main():
-    size, smooth, source, target, concurrency = handle_commandline()
+    (size, smooth, source, target, concurrency, manifest,
+     runStats) = handle_commandline()
     Qtrac.report("starting...")
     canceled = False
     try:
-        scale(size, smooth, source, target, concurrency)
+        scale(size, smooth, source, target, concurrency, manifest,
+                runStats)
     except KeyboardInterrupt:
         Qtrac.report("canceling...")
         canceled = True
+    if manifest is not None:
+        manifest.save()
+    if runStats is not None:
+        runStats.save()
     summarize(concurrency, canceled)
 
 
@@ -45,6 +53,17 @@ def handle_commandline():
                 "[default: %(default)d]")
     parser.add_argument("-S", "--smooth", action="store_true",
             help="use smooth scaling (slow but good for text)")
+    parser.add_argument("-i", "--incremental", action="store_true",
+            help="only scale images that are new or changed (or whose "
+                "size or smooth option differs) since the last "
+                "incremental run into the target directory")
+    parser.add_argument("--clean", action="store_true",
+            help="with --incremental, delete target images whose source "
+                "images no longer exist")
+    parser.add_argument("--stats", metavar="FILE",
+            help="write each image's load, scale, and save times and "
+                "sizes, queue wait, per-worker throughput, and latency "
+                "percentiles to FILE as JSON")
     parser.add_argument("source",
             help="the directory containing the original .xpm images")
     parser.add_argument("target",
@@ -56,36 +75,44 @@ def handle_commandline():
         args.error("source and target must be different")
     if not os.path.exists(args.target):
         os.makedirs(target)
-    return args.size, args.smooth, source, target, args.concurrency
-
-
-def scale(size, smooth, source, target, concurrency):
-    pipeline = create_pipeline(size, smooth, concurrency)
+    manifest = None
+    if args.incremental:
+        manifest = ImageJobs.Manifest(target, (args.size, args.smooth),
+                args.clean)
+    runStats = None
+    if args.stats:
+        runStats = ImageJobs.RunStats(args.stats,
+                os.path.basename(sys.argv[0]), args.concurrency)
+    return (args.size, args.smooth, source, target, args.concurrency,
+            manifest, runStats)
+
+
+def scale(size, smooth, source, target, concurrency, manifest, runStats):
+    pipeline = create_pipeline(size, smooth, concurrency, manifest,
+            runStats)
     for i, (sourceImage, targetImage) in enumerate(
-            get_jobs(source, target)):
+            ImageJobs.get_jobs(source, target, manifest)):
+        if runStats is not None:
+            runStats.submit([(sourceImage, targetImage)])
         pipeline.send((sourceImage, targetImage, i % concurrency))
 
 
-def create_pipeline(size, smooth, concurrency):
+def create_pipeline(size, smooth, concurrency, manifest, runStats):
     pipeline = None
-    sink = results()
+    sink = results(manifest, runStats)
     for who in range(concurrency):
         pipeline = scaler(pipeline, sink, size, smooth, who)
     return pipeline
 
 
-def get_jobs(source, target):
-    for name in os.listdir(source):
-        yield os.path.join(source, name), os.path.join(target, name)
-
-
 @Qtrac.coroutine
 def scaler(receiver, sink, size, smooth, me):
     while True:
         sourceImage, targetImage, who = (yield)
         if who == me:
             try:
-                result = scale_one(size, smooth, sourceImage, targetImage)
+                result = scale_one(size, smooth, sourceImage, targetImage,
+                        "coroutine {}".format(me))
                 sink.send(result)
             except Image.Error as err:
                 Qtrac.report(str(err), True)
@@ -94,22 +121,28 @@ def scaler(receiver, sink, size, smooth, me):
 
 
 @Qtrac.coroutine
-def results():
+def results(manifest, runStats):
     while True:
         result = (yield)
         results.todo += result.todo
         results.copied += result.copied
         results.scaled += result.scaled
+        if manifest is not None:
+            manifest.done(result.name)
+        if runStats is not None:
+            runStats.add(result.timing)
         Qtrac.report("{} {}".format("copied" if result.copied else "scaled",
                 os.path.basename(result.name)))
 results.todo = results.copied = results.scaled = 0
 
 
-def scale_one(size, smooth, sourceImage, targetImage):
+def scale_one(size, smooth, sourceImage, targetImage, worker=None):
+    timer = ImageJobs.Timer(targetImage, worker)
     oldImage = Image.from_file(sourceImage)
+    timer.lap("load")
     if oldImage.width <= size and oldImage.height <= size:
-        oldImage.save(targetImage)
-        return Result(1, 1, 0, targetImage)
+        newImage = oldImage
+        copied, scaled = 1, 0
     else:
         if smooth:
             scale = min(size / oldImage.width, size / oldImage.height)
@@ -118,8 +151,13 @@ def scale_one(size, smooth, sourceImage, targetImage):
             stride = int(math.ceil(max(oldImage.width / size,
                                        oldImage.height / size)))
             newImage = oldImage.subsample(stride)
-        newImage.save(targetImage)
-        return Result(1, 0, 1, targetImage)
+        timer.lap("scale")
+        copied, scaled = 0, 1
+    newImage.save(targetImage)
+    timer.lap("save")
+    return Result(1, copied, scaled, targetImage, timer.record(
+            oldImage.width * oldImage.height, os.path.getsize(sourceImage),
+            os.path.getsize(targetImage)))
 
 
 def summarize(concurrency, canceled):
@@ -132,6 +170,8 @@ def summarize(concurrency, canceled):
         message += " [canceled]"
     Qtrac.report(message)
     print()
+    if Image.stats():
+        print(Image.format_stats())
 
 
 if __name__ == "__main__":
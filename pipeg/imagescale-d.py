@@ -0,0 +1,448 @@
+#!/usr/bin/env python3
+# Copyright © 2012-13 Qtrac Ltd. All rights reserved.
+# This program or module is free software: you can redistribute it
+# and/or modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version. It is provided for
+# educational purposes and is distributed in the hope that it will be
+# useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+
+"""
+Scales images using worker processes on any number of machines.
+
+The coordinator walks the source directory and serves the jobs and
+results over TCP using a multiprocessing.managers.BaseManager; worker
+processes (on this machine or on others) connect, take batches of
+jobs, scale them, and send back the results. A worker that stops
+sending heartbeats (e.g., because it or its machine died) is considered
+lost and any batches it had taken are given to other workers; a batch
+that has been given out MAX_REQUEUES times without being finished (say,
+because one of its images kills every worker that tries it) is counted
+as failed instead. If no worker is heard from at all for the timeout
+the coordinator gives up.
+
+The jobs are filenames, so the source and target directories must be
+at the same paths on every machine (e.g., on a shared file system).
+
+    imagescale-d.py -a 0.0.0.0:11003 -k secret -c 2 source target
+    imagescale-d.py -w coordinator.example.com:11003 -k secret -c 8
+"""
+
+import argparse
+import collections
+import math
+import multiprocessing
+import multiprocessing.managers
+import os
+import queue
+import socket
+import threading
+import time
+import Image
+import ImageJobs
+import Qtrac
+
+
+ADDRESS = "localhost:11003"
+AUTHKEY = "imagescale" # Only allowed for localhost; see handle_commandline()
+MAX_REQUEUES = 2
+
+Result = collections.namedtuple("Result",
+        "copied scaled name stats seconds bytes")
+Summary = collections.namedtuple("Summary",
+        "todo copied scaled canceled workers requeued")
+
+
+def main():
+    args = handle_commandline()
+    if args.worker:
+        Qtrac.report("connecting to {}...".format(args.worker))
+        work(args.worker, args.authkey, args.concurrency)
+        return
+    Qtrac.report("starting...")
+    summary = coordinate(args)
+    if args.manifest is not None:
+        args.manifest.save()
+    summarize(summary)
+
+
+def handle_commandline():
+    parser = argparse.ArgumentParser(description="Scale images using "
+            "worker processes on this and other machines")
+    parser.add_argument("-a", "--address", default=ADDRESS,
+            help="as coordinator, the HOST:PORT to accept workers on "
+                "[default: %(default)s]")
+    parser.add_argument("-w", "--worker", metavar="HOST:PORT",
+            help="run as a worker (with concurrency processes) for the "
+                "coordinator at HOST:PORT rather than as a coordinator")
+    parser.add_argument("-k", "--authkey",
+            default=os.environ.get("IMAGESCALE_AUTHKEY"),
+            help="the shared secret that workers must give the "
+                "coordinator; required unless the address is localhost "
+                "[default: $IMAGESCALE_AUTHKEY]")
+    parser.add_argument("-c", "--concurrency", type=int,
+            default=multiprocessing.cpu_count(),
+            help="the number of worker processes to run on this machine "
+                "(may be 0 for a coordinator) [default: %(default)d]")
+    parser.add_argument("-t", "--timeout", type=float, default=10,
+            help="as coordinator, give a worker's jobs to other workers "
+                "if it hasn't been heard from for this many seconds "
+                "[default: %(default)s]")
+    parser.add_argument("-b", "--batch", type=float, default=0.05,
+            help="group small images so that each task takes about "
+                "this many seconds [default: %(default)s]")
+    parser.add_argument("-s", "--size", default=400, type=int,
+            help="make a scaled image that fits the given dimension "
+                "[default: %(default)d]")
+    parser.add_argument("-S", "--smooth", action="store_true",
+            help="use smooth scaling (slow but good for text)")
+    parser.add_argument("-i", "--incremental", action="store_true",
+            help="only scale images that are new or changed (or whose "
+                "size or smooth option differs) since the last "
+                "incremental run into the target directory")
+    parser.add_argument("--clean", action="store_true",
+            help="with --incremental, delete target images whose source "
+                "images no longer exist")
+    parser.add_argument("source", nargs="?",
+            help="the directory containing the original .xpm images")
+    parser.add_argument("target", nargs="?",
+            help="the directory for the scaled .xpm images")
+    args = parser.parse_args()
+    try:
+        address = parse_address(args.worker or args.address)
+    except ValueError:
+        parser.error("addresses must be given as HOST:PORT")
+    if args.authkey is None:
+        if address[0] not in {"localhost", "127.0.0.1"}:
+            parser.error("an authkey is needed unless the address is "
+                    "localhost")
+        args.authkey = AUTHKEY
+    args.authkey = args.authkey.encode("utf-8")
+    if args.worker:
+        if args.concurrency < 1:
+            parser.error("a worker needs at least one process")
+        args.worker = address
+        return args
+    args.address = address
+    if args.source is None or args.target is None:
+        parser.error("a coordinator needs source and target directories")
+    args.source = os.path.abspath(args.source)
+    args.target = os.path.abspath(args.target)
+    if args.source == args.target:
+        parser.error("source and target must be different")
+    if not os.path.exists(args.target):
+        os.makedirs(args.target)
+    args.manifest = None
+    if args.incremental:
+        args.manifest = ImageJobs.Manifest(args.target, (args.size,
+                args.smooth), args.clean)
+    return args
+
+
+def parse_address(text):
+    host, _, port = text.rpartition(":")
+    return host or "localhost", int(port)
+
+
+class Dispatcher:
+    """Hands out batches of jobs to workers and collects their results,
+    keeping track of which worker has which batch so that the batches
+    taken by a lost worker can be given to others.
+
+    A Dispatcher lives in the coordinator; workers use it through a
+    proxy, so all its methods take and return picklable values and are
+    thread-safe (each worker connection is served by its own thread).
+    """
+
+    def __init__(self, size, smooth):
+        self.size = size
+        self.smooth = smooth
+        self.jobs = queue.Queue() # (batchId, batch)
+        self.results = queue.Queue() # lists of Results
+        self.lock = threading.Lock()
+        self.taken = {} # batchId: (worker, batch) for batches in flight
+        self.done = set() # batchIds whose results have been received
+        self.heard = {} # worker: time.monotonic() when last heard from
+        self.workers = set() # Every worker that has connected
+        self.lastHeard = time.monotonic() # From any worker (or creation)
+        self.requeues = collections.Counter() # batchId: times requeued
+        self.finished = threading.Event()
+
+
+    def parameters(self):
+        """returns the size and smooth parameters for scaling"""
+        return self.size, self.smooth
+
+
+    def get(self, worker, timeout=1.0):
+        """returns a (batchId, batch) for the worker to scale, or None if
+        there isn't one within timeout seconds or all the work is
+        done"""
+        self.heartbeat(worker)
+        if self.finished.is_set():
+            return None
+        try:
+            batchId, batch = self.jobs.get(timeout=timeout)
+        except queue.Empty:
+            return None
+        with self.lock:
+            self.taken[batchId] = (worker, batch)
+        return batchId, batch
+
+
+    def put(self, worker, batchId, results):
+        """accepts the worker's results for the batchId batch; results
+        for a batch that another worker has already finished (because
+        it was requeued) are ignored"""
+        self.heartbeat(worker)
+        with self.lock:
+            self.taken.pop(batchId, None)
+            if batchId in self.done:
+                return
+            self.done.add(batchId)
+        self.results.put(results)
+
+
+    def heartbeat(self, worker):
+        """records that the worker is alive"""
+        with self.lock:
+            self.heard[worker] = self.lastHeard = time.monotonic()
+            self.workers.add(worker)
+
+
+    def silence(self):
+        """returns how many seconds it is since any worker was heard from
+        (or since the dispatcher was created if none has been)"""
+        with self.lock:
+            return time.monotonic() - self.lastHeard
+
+
+    def is_finished(self):
+        return self.finished.is_set()
+
+
+    def add(self, batchId, batch):
+        self.jobs.put((batchId, batch))
+
+
+    def requeue_lost(self, timeout):
+        """puts back the batches of every worker that hasn't been heard
+        from for timeout seconds and returns how many batches were put
+        back; a batch that has already been put back MAX_REQUEUES times
+        is given failed results instead"""
+        now = time.monotonic()
+        with self.lock:
+            lost = {worker for worker, heard in self.heard.items()
+                    if now - heard > timeout}
+            for worker in lost:
+                del self.heard[worker]
+                Qtrac.report("lost worker {}".format(worker), True)
+            requeued = []
+            failed = []
+            for batchId, (worker, batch) in list(self.taken.items()):
+                if worker not in lost:
+                    continue
+                del self.taken[batchId]
+                if self.requeues[batchId] < MAX_REQUEUES:
+                    self.requeues[batchId] += 1
+                    requeued.append((batchId, batch))
+                else:
+                    self.done.add(batchId)
+                    failed.append(batch)
+        for job in requeued:
+            self.jobs.put(job)
+        for batch in failed:
+            Qtrac.report("giving up on a batch of {} images from {} "
+                    "after it was requeued {} times".format(len(batch),
+                    os.path.dirname(batch[0][0]), MAX_REQUEUES), True)
+            self.results.put([Result(0, 0, targetImage, {}, 0, 0)
+                              for _, targetImage in batch])
+        return len(requeued)
+
+
+class Manager(multiprocessing.managers.BaseManager): pass
+
+
+def coordinate(args):
+    dispatcher = Dispatcher(args.size, args.smooth)
+    Manager.register("dispatcher", callable=lambda: dispatcher)
+    manager = Manager(address=args.address, authkey=args.authkey)
+    server = manager.get_server()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    Qtrac.report("serving jobs on {}:{}".format(*args.address), True)
+    for _ in range(args.concurrency): # Local workers connect over TCP too
+        process = multiprocessing.Process(target=worker, args=(
+                args.address, args.authkey))
+        process.daemon = True
+        process.start()
+    summary = Summary(0, 0, 0, False, 0, 0)
+    try:
+        summary = dispatch(args, dispatcher, summary)
+    except KeyboardInterrupt: # May not work on Windows
+        Qtrac.report("canceling...")
+        summary = summary._replace(canceled=True)
+    dispatcher.finished.set()
+    time.sleep(min(1, args.timeout)) # Let the workers see it's finished
+    return summary._replace(workers=len(dispatcher.workers))
+
+
+def dispatch(args, dispatcher, summary):
+    """gives the batches of jobs to the dispatcher, keeping at most a
+    few batches per worker waiting, and collects the results"""
+    batcher = ImageJobs.Batcher(args.batch)
+    batches = iter(batcher.batches(ImageJobs.get_jobs(args.source,
+            args.target, args.manifest)))
+    window = 4 * max(1, args.concurrency, len(dispatcher.workers))
+    batchId = pending = 0
+    interval = args.timeout / 4
+    check = time.monotonic() + interval
+    while True:
+        while batches is not None and pending < window:
+            batch = next(batches, None)
+            if batch is None:
+                batches = None
+                break
+            batchId += 1
+            dispatcher.add(batchId, batch)
+            summary = summary._replace(todo=summary.todo + len(batch))
+            pending += 1
+        if not pending:
+            break
+        now = time.monotonic()
+        if now >= check: # Even if results keep arriving
+            check = now + interval
+            requeued = dispatcher.requeue_lost(args.timeout)
+            summary = summary._replace(requeued=summary.requeued +
+                    requeued)
+            if dispatcher.silence() > args.timeout:
+                Qtrac.report("no workers heard from for {} seconds; "
+                        "giving up".format(args.timeout), True)
+                return summary._replace(canceled=True)
+        try:
+            results = dispatcher.results.get(timeout=max(0, check - now))
+        except queue.Empty:
+            continue
+        pending -= 1
+        batcher.record(results)
+        summary = add_results(results, summary, args.manifest)
+        window = 4 * max(1, args.concurrency, len(dispatcher.workers))
+    return summary
+
+
+def add_results(results, summary, manifest):
+    copied = summary.copied
+    scaled = summary.scaled
+    for result in results:
+        Image.merge_stats(result.stats)
+        if result.copied or result.scaled: # Not failed
+            copied += result.copied
+            scaled += result.scaled
+            if manifest is not None:
+                manifest.done(result.name)
+            Qtrac.report("{} {}".format("copied" if result.copied else
+                    "scaled", os.path.basename(result.name)))
+    return summary._replace(copied=copied, scaled=scaled)
+
+
+def work(address, authkey, concurrency):
+    processes = []
+    for _ in range(concurrency):
+        process = multiprocessing.Process(target=worker, args=(address,
+                authkey))
+        process.start()
+        processes.append(process)
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        Qtrac.report("stopping...")
+
+
+def worker(address, authkey):
+    name = "{}:{}".format(socket.gethostname(), os.getpid())
+    Manager.register("dispatcher")
+    manager = Manager(address=address, authkey=authkey)
+    try:
+        manager.connect()
+        dispatcher = manager.dispatcher()
+        size, smooth = dispatcher.parameters()
+        beater = threading.Thread(target=heartbeat, args=(dispatcher,
+                name), daemon=True)
+        beater.start()
+        while True:
+            job = dispatcher.get(name)
+            if job is None:
+                if dispatcher.is_finished():
+                    break
+                continue
+            batchId, batch = job
+            dispatcher.put(name, batchId, scale_batch(size, smooth, batch))
+    except (EOFError, ConnectionError): # The coordinator has finished
+        pass
+    except KeyboardInterrupt:
+        pass
+
+
+def heartbeat(dispatcher, name, interval=1.0):
+    try:
+        while True:
+            dispatcher.heartbeat(name)
+            time.sleep(interval)
+    except (EOFError, ConnectionError):
+        pass
+
+
+def scale_batch(size, smooth, jobs):
+    results = []
+    for sourceImage, targetImage in jobs:
+        try:
+            results.append(scale_one(size, smooth, sourceImage,
+                    targetImage))
+        except Exception as err: # E.g., a corrupt image; keep the worker
+            Qtrac.report("{}: {}".format(sourceImage, err), True)
+            results.append(Result(0, 0, targetImage,
+                    Image.stats(reset=True), 0, 0))
+    return results
+
+
+def scale_one(size, smooth, sourceImage, targetImage):
+    start = time.perf_counter()
+    oldImage = Image.from_file(sourceImage)
+    if oldImage.width <= size and oldImage.height <= size:
+        oldImage.save(targetImage)
+        copied, scaled = 1, 0
+    else:
+        if smooth:
+            scale = min(size / oldImage.width, size / oldImage.height)
+            newImage = oldImage.scale(scale)
+        else:
+            stride = int(math.ceil(max(oldImage.width / size,
+                                       oldImage.height / size)))
+            newImage = oldImage.subsample(stride)
+        newImage.save(targetImage)
+        copied, scaled = 0, 1
+    return Result(copied, scaled, targetImage, Image.stats(reset=True),
+            time.perf_counter() - start, os.path.getsize(sourceImage))
+
+
+def summarize(summary):
+    message = "copied {} scaled {} ".format(summary.copied, summary.scaled)
+    difference = summary.todo - (summary.copied + summary.scaled)
+    if difference:
+        message += "skipped {} ".format(difference)
+    message += "using {} worker processes".format(summary.workers)
+    if summary.requeued:
+        message += " ({} batches requeued)".format(summary.requeued)
+    if summary.canceled:
+        message += " [canceled]"
+    Qtrac.report(message)
+    print()
+    if Image.stats():
+        print(Image.format_stats())
+
+
+if __name__ == "__main__":
+    main()
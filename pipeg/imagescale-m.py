@@ -19,18 +19,31 @@ import concurrent.futures
 import math
 import multiprocessing
 import os
+import time
 import Image
+import ImageJobs
 import Qtrac
 
 
-Result = collections.namedtuple("Result", "copied scaled name")
+Result = collections.namedtuple("Result",
+        "copied scaled name stats seconds bytes timing")
+Band = collections.namedtuple("Band",
+        "name band columns pixels stats seconds bytes timing")
 Summary = collections.namedtuple("Summary", "todo copied scaled canceled")
+Schedule = collections.namedtuple("Schedule",
+        "window batcher lookahead bandPixels budget runStats")
 
 
 def main():
-    size, smooth, source, target, concurrency = handle_commandline()
+    (size, smooth, source, target, concurrency, schedule,
+     manifest) = handle_commandline()
     Qtrac.report("starting...")
-    summary = scale(size, smooth, source, target, concurrency)
+    summary = scale(size, smooth, source, target, concurrency, schedule,
+            manifest)
+    if manifest is not None:
+        manifest.save()
+    if schedule.runStats is not None:
+        schedule.runStats.save()
     summarize(summary, concurrency)
 
 
@@ -40,85 +53,272 @@ def handle_commandline():
             default=multiprocessing.cpu_count(),
             help="specify the concurrency (for debugging and "
                 "timing) [default: %(default)d]")
+    parser.add_argument("-w", "--window", type=int, default=0,
+            help="the most images to have queued or being scaled at "
+                "any one time [default: 4 × concurrency]")
+    parser.add_argument("-b", "--batch", type=float, default=0.05,
+            help="group small images so that each task takes about "
+                "this many seconds (0 sends images one at a time) "
+                "[default: %(default)s]")
+    parser.add_argument("-l", "--largest-first", type=int, nargs="?",
+            const=0, metavar="LOOKAHEAD",
+            help="scale the images with the most pixels first; if "
+                "LOOKAHEAD is given only reorder that many images at a "
+                "time (to bound memory use for huge trees)")
+    parser.add_argument("-B", "--bands", type=float, default=0,
+            metavar="MEGAPIXELS",
+            help="split images with at least this many megapixels into "
+                "row bands scaled by all the processes [default: don't "
+                "split]")
+    parser.add_argument("-M", "--memory-budget",
+            help="only scale as many images at once as fit in this much "
+                "memory (e.g., 512M or 2G), estimated from their sizes "
+                "[default: unlimited]")
     parser.add_argument("-s", "--size", default=400, type=int,
             help="make a scaled image that fits the given dimension "
                 "[default: %(default)d]")
     parser.add_argument("-S", "--smooth", action="store_true",
             help="use smooth scaling (slow but good for text)")
+    parser.add_argument("-i", "--incremental", action="store_true",
+            help="only scale images that are new or changed (or whose "
+                "size or smooth option differs) since the last "
+                "incremental run into the target directory")
+    parser.add_argument("--clean", action="store_true",
+            help="with --incremental, delete target images whose source "
+                "images no longer exist")
+    parser.add_argument("--stats", metavar="FILE",
+            help="write each image's load, scale, and save times and "
+                "sizes, queue wait, per-worker throughput, and latency "
+                "percentiles to FILE as JSON")
     parser.add_argument("source",
             help="the directory containing the original .xpm images")
     parser.add_argument("target",
             help="the directory for the scaled .xpm images")
     args = parser.parse_args()
+    budget = None
+    if args.memory_budget:
+        try:
+            budget = ImageJobs.MemoryBudget(ImageJobs.parse_bytes(
+                    args.memory_budget), args.size, args.smooth)
+        except ValueError:
+            parser.error("invalid memory budget {}".format(
+                    args.memory_budget))
     source = os.path.abspath(args.source)
     target = os.path.abspath(args.target)
     if source == target:
         args.error("source and target must be different")
     if not os.path.exists(args.target):
         os.makedirs(target)
-    return args.size, args.smooth, source, target, args.concurrency
+    manifest = None
+    if args.incremental:
+        manifest = ImageJobs.Manifest(target, (args.size, args.smooth),
+                args.clean)
+    runStats = None
+    if args.stats:
+        runStats = ImageJobs.RunStats(args.stats,
+                os.path.basename(sys.argv[0]), args.concurrency)
+    schedule = Schedule(args.window if args.window > 0 else
+            4 * args.concurrency, ImageJobs.Batcher(args.batch),
+            args.largest_first, int(args.bands * 1e6), budget, runStats)
+    return (args.size, args.smooth, source, target, args.concurrency,
+            schedule, manifest)
 
 
-def scale(size, smooth, source, target, concurrency):
+def scale(size, smooth, source, target, concurrency, schedule, manifest):
     futures = set()
+    bands = {} # targetImage: {band: Band} for images scaled in bands
+    summary = Summary(0, 0, 0, False)
     with concurrent.futures.ProcessPoolExecutor(
             max_workers=concurrency) as executor:
-        for sourceImage, targetImage in get_jobs(source, target):
-            future = executor.submit(scale_one, size, smooth, sourceImage,
-                    targetImage)
-            futures.add(future)
-        summary = wait_for(futures)
-        if summary.canceled:
+        try:
+            jobs = ImageJobs.get_jobs(source, target, manifest)
+            if schedule.lookahead is not None:
+                jobs = ImageJobs.largest_first(jobs, schedule.lookahead)
+            batches = schedule.batcher.batches(jobs)
+            if schedule.budget is not None:
+                batches = schedule.budget.schedule(batches)
+            for batch in batches:
+                if batch is None: # Wait for memory to be released
+                    summary = wait_for(executor, futures, bands, schedule,
+                            summary, manifest)
+                    continue
+                while len(futures) >= schedule.window:
+                    summary = wait_for(executor, futures, bands, schedule,
+                            summary, manifest)
+                submit(executor, futures, bands, size, smooth, batch,
+                        concurrency, schedule)
+                summary = summary._replace(todo=summary.todo + len(batch))
+            while futures:
+                summary = wait_for(executor, futures, bands, schedule,
+                        summary, manifest)
+        except KeyboardInterrupt:
+            Qtrac.report("canceling...")
+            for future in futures:
+                future.cancel()
             executor.shutdown()
+            summary = summary._replace(canceled=True)
         return summary
-# if we caught the KeyboardInterrupt in this function we'd lose the
-# accumulated todo, copied, scaled counts.
 
 
-def get_jobs(source, target):
-    for name in os.listdir(source):
-        yield os.path.join(source, name), os.path.join(target, name)
+def submit(executor, futures, bands, size, smooth, batch, concurrency,
+        schedule):
+    """submits the batch; a batch of one big enough image is submitted
+    as one task per row band"""
+    if schedule.runStats is not None:
+        schedule.runStats.submit(batch)
+    imageBands = None
+    if schedule.bandPixels and len(batch) == 1:
+        imageBands = ImageJobs.bands_for(size, smooth, batch[0][0],
+                concurrency, schedule.bandPixels)
+    if imageBands is None:
+        futures.add(executor.submit(scale_batch, size, smooth, batch))
+    else:
+        sourceImage, targetImage = batch[0]
+        bands[targetImage] = dict.fromkeys(imageBands)
+        for band in imageBands:
+            futures.add(executor.submit(scale_band, size, smooth,
+                    sourceImage, targetImage, band))
 
 
-def wait_for(futures):
-    canceled = False
-    copied = scaled = 0
-    try:
-        for future in concurrent.futures.as_completed(futures):
-            err = future.exception()
-            if err is None:
-                result = future.result()
+def wait_for(executor, futures, bands, schedule, summary, manifest):
+    """waits for at least one of the futures to finish, removes the
+    finished ones from futures, and returns summary updated with their
+    results; when all of an image's bands have finished a task to join
+    and save them is submitted"""
+    done, _ = concurrent.futures.wait(futures,
+            return_when=concurrent.futures.FIRST_COMPLETED)
+    copied = summary.copied
+    scaled = summary.scaled
+    for future in done:
+        futures.remove(future)
+        results = future.result() # scale_batch() handles Image.Errors
+        if isinstance(results, Band):
+            results = add_band(executor, futures, bands, schedule, results)
+        elif schedule.budget is not None:
+            schedule.budget.release(results[0].name)
+        schedule.batcher.record(results)
+        for result in results:
+            Image.merge_stats(result.stats)
+            if result.copied or result.scaled: # Not failed
                 copied += result.copied
                 scaled += result.scaled
-                Qtrac.report("{} {}".format("copied" if result.copied else
-                        "scaled", os.path.basename(result.name)))
-            elif isinstance(err, Image.Error):
-                Qtrac.report(str(err), True)
-            else:
-                raise err # Unanticipated
-    except KeyboardInterrupt:
-        Qtrac.report("canceling...")
-        canceled = True
-        for future in futures:
-            future.cancel()
-    return Summary(len(futures), copied, scaled, canceled)
+                if manifest is not None:
+                    manifest.done(result.name)
+                if schedule.runStats is not None:
+                    schedule.runStats.add(result.timing)
+                Qtrac.report("{} {}".format("copied" if result.copied
+                        else "scaled", os.path.basename(result.name)))
+    return summary._replace(copied=copied, scaled=scaled)
+
+
+def add_band(executor, futures, bands, schedule, part):
+    """records the band and returns a list of Results: empty unless
+    the band was the image's last and the image failed"""
+    Image.merge_stats(part.stats)
+    parts = bands[part.name]
+    parts[part.band] = part
+    if any(piece is None for piece in parts.values()):
+        return []
+    del bands[part.name]
+    if schedule.budget is not None: # The bands held the source images
+        schedule.budget.release(part.name)
+    parts = [parts[band] for band in sorted(parts)] # Top to bottom
+    if any(piece.pixels is None for piece in parts): # Image.Error
+        return [Result(0, 0, part.name, None, 0, 0, None)]
+    futures.add(executor.submit(join_bands, parts))
+    return []
+
+
+def scale_batch(size, smooth, jobs):
+    results = []
+    for sourceImage, targetImage in jobs:
+        try:
+            results.append(scale_one(size, smooth, sourceImage,
+                    targetImage))
+        except Image.Error as err:
+            Qtrac.report(str(err), True)
+            results.append(Result(0, 0, targetImage,
+                    Image.stats(reset=True), 0, 0, None))
+    return results
 
 
 def scale_one(size, smooth, sourceImage, targetImage):
+    start = time.perf_counter()
+    timer = ImageJobs.Timer(targetImage)
     oldImage = Image.from_file(sourceImage)
+    timer.lap("load")
     if oldImage.width <= size and oldImage.height <= size:
-        oldImage.save(targetImage)
-        return Result(1, 0, targetImage)
+        newImage = oldImage
+        copied, scaled = 1, 0
+    else:
+        newImage = scale_image(size, smooth, oldImage)
+        timer.lap("scale")
+        copied, scaled = 0, 1
+    newImage.save(targetImage)
+    timer.lap("save")
+    sourceBytes = os.path.getsize(sourceImage)
+    return Result(copied, scaled, targetImage, Image.stats(reset=True),
+            time.perf_counter() - start, sourceBytes, timer.record(
+            oldImage.width * oldImage.height, sourceBytes,
+            os.path.getsize(targetImage)))
+
+
+def scale_band(size, smooth, sourceImage, targetImage, band):
+    start = time.perf_counter()
+    timer = ImageJobs.Timer(targetImage)
+    timing = None
+    try:
+        oldImage = Image.from_file(sourceImage)
+        timer.lap("load")
+        newImage = scale_image(size, smooth, oldImage, band)
+        timer.lap("scale")
+        columns, pixels = newImage.width, newImage.pixels
+        timing = timer.record(oldImage.width * oldImage.height, 0, 0)
+    except Image.Error as err:
+        Qtrac.report(str(err), True)
+        columns = pixels = None
+    return Band(targetImage, band, columns, pixels, Image.stats(reset=True),
+            time.perf_counter() - start, os.path.getsize(sourceImage),
+            timing)
+
+
+def join_bands(parts):
+    """returns a list of one Result for the image saved from the bands;
+    its timing is the bands' load and scale times added together and
+    the join's save time"""
+    start = time.perf_counter()
+    name = parts[0].name
+    timer = ImageJobs.Timer(name)
+    newImage = Image.from_data(parts[0].columns, ImageJobs.join_rows(
+            [part.pixels for part in parts]))
+    timing = None
+    try:
+        newImage.save(name)
+        timer.lap("save")
+        scaled = 1
+        timing = timer.record(parts[0].timing["pixels"], parts[0].bytes,
+                os.path.getsize(name))
+        timing["started"] = min(part.timing["started"] for part in parts)
+        for part in parts:
+            for stage, seconds in part.timing["stages"].items():
+                timing["stages"][stage] = (timing["stages"].get(stage, 0.0)
+                                           + seconds)
+    except Image.Error as err:
+        Qtrac.report(str(err), True)
+        scaled = 0
+    seconds = sum(part.seconds for part in parts)
+    return [Result(0, scaled, name, Image.stats(reset=True),
+            seconds + time.perf_counter() - start, parts[0].bytes, timing)]
+
+
+def scale_image(size, smooth, image, band=None):
+    if smooth:
+        scale = min(size / image.width, size / image.height)
+        return image.scale(scale, band)
     else:
-        if smooth:
-            scale = min(size / oldImage.width, size / oldImage.height)
-            newImage = oldImage.scale(scale)
-        else:
-            stride = int(math.ceil(max(oldImage.width / size,
-                                       oldImage.height / size)))
-            newImage = oldImage.subsample(stride)
-        newImage.save(targetImage)
-        return Result(0, 1, targetImage)
+        stride = int(math.ceil(max(image.width / size,
+                                   image.height / size)))
+        return image.subsample(stride, band)
 
 
 def summarize(summary, concurrency):
@@ -131,6 +331,8 @@ def summarize(summary, concurrency):
         message += " [canceled]"
     Qtrac.report(message)
     print()
+    if Image.stats():
+        print(Image.format_stats())
 
 
 if __name__ == "__main__":
@@ -14,19 +14,37 @@ import collections
 import math
 import multiprocessing
 import os
+import queue
 import sys
+import time
 import Image
+import ImageJobs
 import Qtrac
 
 
-Result = collections.namedtuple("Result", "copied scaled name")
+POLL = 1.0 # Seconds between checks for dead worker processes
+
+Result = collections.namedtuple("Result",
+        "copied scaled name stats seconds bytes timing")
 Summary = collections.namedtuple("Summary", "todo copied scaled canceled")
+Schedule = collections.namedtuple("Schedule",
+        "window batcher lookahead budget watch settle runStats")
 
 
 def main():
-    size, smooth, source, target, concurrency = handle_commandline()
+    (size, smooth, source, target, concurrency, schedule,
+     manifest) = handle_commandline()
     Qtrac.report("starting...")
-    summary = scale(size, smooth, source, target, concurrency)
+    if schedule.watch is None:
+        summary = scale(size, smooth, source, target, concurrency,
+                schedule, manifest)
+    else:
+        summary = watch(size, smooth, source, target, concurrency,
+                schedule, manifest)
+    if manifest is not None:
+        manifest.save()
+    if schedule.runStats is not None:
+        schedule.runStats.save()
     summarize(summary, concurrency)
 
 
@@ -36,80 +54,314 @@ def handle_commandline():
             default=multiprocessing.cpu_count(),
             help="specify the concurrency (for debugging and "
                 "timing) [default: %(default)d]")
+    parser.add_argument("-w", "--window", type=int, default=0,
+            help="the most images to have queued at any one time "
+                "[default: 4 × concurrency]")
+    parser.add_argument("-b", "--batch", type=float, default=0.05,
+            help="group small images so that each task takes about "
+                "this many seconds (0 sends images one at a time) "
+                "[default: %(default)s]")
+    parser.add_argument("-l", "--largest-first", type=int, nargs="?",
+            const=0, metavar="LOOKAHEAD",
+            help="scale the images with the most pixels first; if "
+                "LOOKAHEAD is given only reorder that many images at a "
+                "time (to bound memory use for huge trees)")
+    parser.add_argument("-M", "--memory-budget",
+            help="only scale as many images at once as fit in this much "
+                "memory (e.g., 512M or 2G), estimated from their sizes "
+                "[default: unlimited]")
+    parser.add_argument("-W", "--watch", type=float, metavar="SECONDS",
+            help="keep running, checking the source directory for new "
+                "or changed images every SECONDS and scaling them as "
+                "they arrive; stop with Ctrl+C [default: scale once and "
+                "exit]")
+    parser.add_argument("--settle", type=float, default=1.0,
+            metavar="SECONDS",
+            help="with --watch, only scale an image once its size and "
+                "modification time haven't changed for this long so that "
+                "partly written files are skipped [default: %(default)s]")
     parser.add_argument("-s", "--size", default=400, type=int,
             help="make a scaled image that fits the given dimension "
                 "[default: %(default)d]")
     parser.add_argument("-S", "--smooth", action="store_true",
             help="use smooth scaling (slow but good for text)")
+    parser.add_argument("-i", "--incremental", action="store_true",
+            help="only scale images that are new or changed (or whose "
+                "size or smooth option differs) since the last "
+                "incremental run into the target directory")
+    parser.add_argument("--clean", action="store_true",
+            help="with --incremental, delete target images whose source "
+                "images no longer exist")
+    parser.add_argument("--stats", metavar="FILE",
+            help="write each image's load, scale, and save times and "
+                "sizes, queue wait, per-worker throughput, and latency "
+                "percentiles to FILE as JSON")
     parser.add_argument("source",
             help="the directory containing the original .xpm images")
     parser.add_argument("target",
             help="the directory for the scaled .xpm images")
     args = parser.parse_args()
+    budget = None
+    if args.memory_budget:
+        try:
+            budget = ImageJobs.MemoryBudget(ImageJobs.parse_bytes(
+                    args.memory_budget), args.size, args.smooth)
+        except ValueError:
+            parser.error("invalid memory budget {}".format(
+                    args.memory_budget))
     source = os.path.abspath(args.source)
     target = os.path.abspath(args.target)
     if source == target:
         args.error("source and target must be different")
+    if args.watch is not None and args.watch <= 0:
+        parser.error("the watch interval must be positive")
     if not os.path.exists(args.target):
         os.makedirs(target)
-    return args.size, args.smooth, source, target, args.concurrency
+    manifest = None
+    if args.incremental:
+        manifest = ImageJobs.Manifest(target, (args.size, args.smooth),
+                args.clean)
+    runStats = None
+    if args.stats:
+        runStats = ImageJobs.RunStats(args.stats,
+                os.path.basename(sys.argv[0]), args.concurrency)
+    schedule = Schedule(args.window if args.window > 0 else
+            4 * args.concurrency, ImageJobs.Batcher(args.batch),
+            args.largest_first, budget, args.watch, args.settle,
+            runStats)
+    return (args.size, args.smooth, source, target, args.concurrency,
+            schedule, manifest)
 
 
-def scale(size, smooth, source, target, concurrency):
-    canceled = False
-    jobs = multiprocessing.JoinableQueue()
+def scale(size, smooth, source, target, concurrency, schedule, manifest):
+    jobs = multiprocessing.JoinableQueue(schedule.window)
     results = multiprocessing.Queue()
-    create_processes(size, smooth, jobs, results, concurrency)
-    todo = add_jobs(source, target, jobs)
+    workers = Workers(size, smooth, jobs, results, concurrency)
+    summary = Summary(0, 0, 0, False)
     try:
-        jobs.join()
+        summary, pending = add_jobs(source, target, jobs, results, workers,
+                schedule, summary, manifest)
+        while pending > 0: # Every batch puts exactly one list
+            batchResults, lost = wait_for_results(results, workers)
+            pending -= lost
+            if batchResults is not None:
+                summary = add_results(batchResults, schedule, summary,
+                        manifest)
+                pending -= 1
     except KeyboardInterrupt: # May not work on Windows
         Qtrac.report("canceling...")
-        canceled = True
-    copied = scaled = 0
-    while not results.empty(): # Safe because all jobs have finished
-        result = results.get_nowait()
-        copied += result.copied
-        scaled += result.scaled
-    return Summary(todo, copied, scaled, canceled)
-
-
-def create_processes(size, smooth, jobs, results, concurrency):
-    for _ in range(concurrency):
-        process = multiprocessing.Process(target=worker, args=(size,
-                smooth, jobs, results))
+        summary = summary._replace(canceled=True)
+    return summary
+
+
+def watch(size, smooth, source, target, concurrency, schedule, manifest):
+    """scales new or changed images every schedule.watch seconds until
+    interrupted, reporting how long each image took from its arrival to
+    its scaled image being saved
+
+    The worker processes are created once and kept for the whole run
+    so that each image only costs its scaling; any that die are
+    replaced.
+    """
+    jobs = multiprocessing.JoinableQueue(schedule.window)
+    results = multiprocessing.Queue()
+    workers = Workers(size, smooth, jobs, results, concurrency)
+    watcher = ImageJobs.Watcher(target, schedule.settle, manifest)
+    summary = Summary(0, 0, 0, False)
+    latencies = []
+    pending = 0
+    try:
+        while True:
+            deadline = time.monotonic() + schedule.watch
+            pending = max(0, pending - workers.restart_dead())
+            summary, added = add_jobs(source, target, jobs, results,
+                    workers, schedule, summary, watcher, latencies)
+            pending += added
+            while pending:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batchResults = results.get(timeout=min(POLL, timeout))
+                except queue.Empty:
+                    pending = max(0, pending - workers.restart_dead())
+                    continue
+                summary = add_results(batchResults, schedule, summary,
+                        watcher, latencies)
+                pending -= 1
+            if latencies:
+                report_latency(latencies)
+                if manifest is not None:
+                    manifest.save()
+                latencies = []
+            timeout = deadline - time.monotonic()
+            if timeout > 0:
+                time.sleep(timeout)
+    except KeyboardInterrupt: # May not work on Windows
+        Qtrac.report("stopping...")
+        summary = summary._replace(canceled=True)
+    return summary
+
+
+def report_latency(latencies):
+    latencies = sorted(latencies)
+    Qtrac.report("{} image{} arrival to output: median {:.3f} sec p95 "
+            "{:.3f} sec max {:.3f} sec".format(len(latencies),
+            "" if len(latencies) == 1 else "s",
+            latencies[len(latencies) // 2],
+            latencies[min(len(latencies) - 1,
+                          int(len(latencies) * 0.95))], latencies[-1]),
+            True)
+
+
+class Workers:
+    """The worker processes, keeping track of them so that any that die
+    (e.g., killed for using too much memory) can be replaced"""
+
+    def __init__(self, size, smooth, jobs, results, concurrency):
+        self.args = (size, smooth, jobs, results)
+        self.processes = [self._start() for _ in range(concurrency)]
+
+
+    def _start(self):
+        process = multiprocessing.Process(target=worker, args=self.args)
         process.daemon = True
         process.start()
+        return process
+
+
+    def restart_dead(self):
+        """replaces any worker processes that have died and returns how
+        many did; each is assumed to have died scaling a batch whose
+        results will never arrive"""
+        dead = 0
+        for i, process in enumerate(self.processes):
+            if not process.is_alive():
+                Qtrac.report("worker process {} died (exit code {}); "
+                        "restarting it".format(process.pid,
+                        process.exitcode), True)
+                self.processes[i] = self._start()
+                dead += 1
+        return dead
 
 
 def worker(size, smooth, jobs, results):
     while True:
+        batch = jobs.get()
+        batchResults = [Result(0, 0, targetImage, {}, 0, 0, None)
+                        for _, targetImage in batch] # In case of failure
         try:
-            sourceImage, targetImage = jobs.get()
-            try:
-                result = scale_one(size, smooth, sourceImage, targetImage)
-                Qtrac.report("{} {}".format("copied" if result.copied else
-                        "scaled", os.path.basename(result.name)))
-                results.put(result)
-            except Image.Error as err:
-                Qtrac.report(str(err), True)
-        finally:
+            batchResults = scale_batch(size, smooth, batch)
+            for result in batchResults:
+                if result.copied or result.scaled:
+                    Qtrac.report("{} {}".format("copied" if result.copied
+                            else "scaled", os.path.basename(result.name)))
+        except Exception as err:
+            Qtrac.report(str(err), True)
+        finally: # Every batch must put exactly one list
+            results.put(batchResults)
             jobs.task_done()
 
 
-def add_jobs(source, target, jobs):
-    for todo, name in enumerate(os.listdir(source), start=1):
-        sourceImage = os.path.join(source, name)
-        targetImage = os.path.join(target, name)
-        jobs.put((sourceImage, targetImage))
-    return todo
+def wait_for_results(results, workers):
+    """returns the next batch's list of results and 0, or None and the
+    number of worker processes that died (and so batches that were
+    lost) while waiting"""
+    while True:
+        try:
+            return results.get(timeout=POLL), 0
+        except queue.Empty:
+            lost = workers.restart_dead()
+            if lost:
+                return None, lost
+
+
+def add_jobs(source, target, jobs, results, workers, schedule, summary,
+        manifest, latencies=None):
+    """adds the jobs in batches, collecting results as they arrive, and
+    returns the updated summary and how many batches' results have yet
+    to arrive
+
+    The jobs queue holds at most window batches so put() blocks until
+    the workers catch up; this keeps memory use flat however many
+    images there are.
+    """
+    pending = 0
+    imageJobs = ImageJobs.get_jobs(source, target, manifest)
+    if schedule.lookahead is not None:
+        imageJobs = ImageJobs.largest_first(imageJobs, schedule.lookahead)
+    batches = schedule.batcher.batches(imageJobs)
+    if schedule.budget is not None:
+        batches = schedule.budget.schedule(batches)
+    for batch in batches:
+        if batch is None: # Wait for memory to be released
+            batchResults, lost = wait_for_results(results, workers)
+            pending -= lost
+            if batchResults is not None:
+                summary = add_results(batchResults, schedule, summary,
+                        manifest, latencies)
+                pending -= 1
+            if pending <= 0: # A lost batch's memory is never released
+                schedule.budget.release_all()
+            continue
+        if schedule.runStats is not None:
+            schedule.runStats.submit(batch)
+        jobs.put(batch)
+        summary = summary._replace(todo=summary.todo + len(batch))
+        pending += 1
+        while pending > 0 and not results.empty():
+            summary = add_results(results.get(), schedule, summary,
+                    manifest, latencies)
+            pending -= 1
+    return summary, max(0, pending)
+
+
+def add_results(results, schedule, summary, manifest, latencies=None):
+    """returns summary updated with the batch's results; if latencies is
+    a list the manifest must be an ImageJobs.Watcher and each scaled
+    image's seconds since it arrived are appended to it"""
+    if schedule.budget is not None:
+        schedule.budget.release(results[0].name)
+    schedule.batcher.record(results)
+    copied = summary.copied
+    scaled = summary.scaled
+    for result in results:
+        Image.merge_stats(result.stats)
+        if result.copied or result.scaled: # Not failed
+            copied += result.copied
+            scaled += result.scaled
+            if schedule.runStats is not None:
+                schedule.runStats.add(result.timing)
+            if manifest is not None:
+                latency = manifest.done(result.name)
+                if latencies is not None and latency is not None:
+                    latencies.append(latency)
+        elif latencies is not None:
+            manifest.forget(result.name)
+    return summary._replace(copied=copied, scaled=scaled)
+
+
+def scale_batch(size, smooth, jobs):
+    results = []
+    for sourceImage, targetImage in jobs:
+        try:
+            results.append(scale_one(size, smooth, sourceImage,
+                    targetImage))
+        except Exception as err: # E.g., a corrupt image; keep the worker
+            Qtrac.report("{}: {}".format(sourceImage, err), True)
+            results.append(Result(0, 0, targetImage,
+                    Image.stats(reset=True), 0, 0, None))
+    return results
 
 
 def scale_one(size, smooth, sourceImage, targetImage):
+    start = time.perf_counter()
+    timer = ImageJobs.Timer(targetImage)
     oldImage = Image.from_file(sourceImage)
+    timer.lap("load")
     if oldImage.width <= size and oldImage.height <= size:
-        oldImage.save(targetImage)
-        return Result(1, 0, targetImage)
+        newImage = oldImage
+        copied, scaled = 1, 0
     else:
         if smooth:
             scale = min(size / oldImage.width, size / oldImage.height)
@@ -118,8 +370,15 @@ def scale_one(size, smooth, sourceImage, targetImage):
             stride = int(math.ceil(max(oldImage.width / size,
                                        oldImage.height / size)))
             newImage = oldImage.subsample(stride)
-        newImage.save(targetImage)
-        return Result(0, 1, targetImage)
+        timer.lap("scale")
+        copied, scaled = 0, 1
+    newImage.save(targetImage)
+    timer.lap("save")
+    sourceBytes = os.path.getsize(sourceImage)
+    return Result(copied, scaled, targetImage, Image.stats(reset=True),
+            time.perf_counter() - start, sourceBytes, timer.record(
+            oldImage.width * oldImage.height, sourceBytes,
+            os.path.getsize(targetImage)))
 
 
 def summarize(summary, concurrency):
@@ -132,6 +391,8 @@ def summarize(summary, concurrency):
         message += " [canceled]"
     Qtrac.report(message)
     print()
+    if Image.stats():
+        print(Image.format_stats())
 
 
 if __name__ == "__main__":
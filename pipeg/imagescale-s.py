@@ -15,16 +15,22 @@ import math
 import os
 import sys
 import Image
+import ImageJobs
 import Qtrac
 
-Result = collections.namedtuple("Result", "copied scaled")
+Result = collections.namedtuple("Result", "copied scaled timing")
 Summary = collections.namedtuple("Summary", "todo copied scaled canceled")
 
 
 def main():
-    size, smooth, source, target = handle_commandline()
+    (size, smooth, source, target, manifest,
+     runStats) = handle_commandline()
     Qtrac.report("starting...")
-    summary = scale(size, smooth, source, target)
+    summary = scale(size, smooth, source, target, manifest, runStats)
+    if manifest is not None:
+        manifest.save()
+    if runStats is not None:
+        runStats.save()
     summarize(summary)
 
 
@@ -35,6 +41,17 @@ def handle_commandline():
                 "[default: %(default)d]")
     parser.add_argument("-S", "--smooth", action="store_true",
             help="use smooth scaling (slow but good for text)")
+    parser.add_argument("-i", "--incremental", action="store_true",
+            help="only scale images that are new or changed (or whose "
+                "size or smooth option differs) since the last "
+                "incremental run into the target directory")
+    parser.add_argument("--clean", action="store_true",
+            help="with --incremental, delete target images whose source "
+                "images no longer exist")
+    parser.add_argument("--stats", metavar="FILE",
+            help="write each image's load, scale, and save times and "
+                "sizes, and overall throughput and latency percentiles, "
+                "to FILE as JSON")
     parser.add_argument("source",
             help="the directory containing the original .xpm images")
     parser.add_argument("target",
@@ -46,18 +63,31 @@ def handle_commandline():
         args.error("source and target must be different")
     if not os.path.exists(args.target):
         os.makedirs(target)
-    return args.size, args.smooth, source, target
-
-
-def scale(size, smooth, source, target):
+    manifest = None
+    if args.incremental:
+        manifest = ImageJobs.Manifest(target, (args.size, args.smooth),
+                args.clean)
+    runStats = None
+    if args.stats:
+        runStats = ImageJobs.RunStats(args.stats,
+                os.path.basename(sys.argv[0]), 1)
+    return args.size, args.smooth, source, target, manifest, runStats
+
+
+def scale(size, smooth, source, target, manifest, runStats):
     canceled = False
     todo = copied = scaled = 0
-    for sourceImage, targetImage in get_jobs(source, target):
+    for sourceImage, targetImage in ImageJobs.get_jobs(source, target,
+            manifest):
         try:
             todo += 1
             result = scale_one(size, smooth, sourceImage, targetImage)
             copied += result.copied
             scaled += result.scaled
+            if manifest is not None:
+                manifest.done(targetImage)
+            if runStats is not None:
+                runStats.add(result.timing)
             Qtrac.report("{} {}".format("copied" if result.copied
                     else "scaled", os.path.basename(targetImage)))
         except Image.Error as err:
@@ -69,16 +99,13 @@ def scale(size, smooth, source, target):
     return Summary(todo, copied, scaled, canceled)
 
 
-def get_jobs(source, target):
-    for name in os.listdir(source):
-        yield os.path.join(source, name), os.path.join(target, name)
-
-
 def scale_one(size, smooth, sourceImage, targetImage):
+    timer = ImageJobs.Timer(targetImage)
     oldImage = Image.from_file(sourceImage)
+    timer.lap("load")
     if oldImage.width <= size and oldImage.height <= size:
-        oldImage.save(targetImage)
-        return Result(1, 0)
+        newImage = oldImage
+        copied, scaled = 1, 0
     else:
         if smooth:
             scale = min(size / oldImage.width, size / oldImage.height)
@@ -87,8 +114,13 @@ def scale_one(size, smooth, sourceImage, targetImage):
             stride = int(math.ceil(max(oldImage.width / size,
                                        oldImage.height / size)))
             newImage = oldImage.subsample(stride)
-        newImage.save(targetImage)
-        return Result(0, 1)
+        timer.lap("scale")
+        copied, scaled = 0, 1
+    newImage.save(targetImage)
+    timer.lap("save")
+    return Result(copied, scaled, timer.record(oldImage.width *
+            oldImage.height, os.path.getsize(sourceImage),
+            os.path.getsize(targetImage)))
 
 
 def summarize(summary):
@@ -101,6 +133,8 @@ def summarize(summary):
         message += " [canceled]"
     Qtrac.report(message)
     print()
+    if Image.stats():
+        print(Image.format_stats())
 
 
 if __name__ == "__main__":
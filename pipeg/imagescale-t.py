@@ -19,18 +19,25 @@ import concurrent.futures
 import math
 import multiprocessing
 import os
-import Image
+import Image # Uses cyImage's backends if available
+import ImageJobs
 import Qtrac
 
 
-Result = collections.namedtuple("Result", "copied scaled name")
+Result = collections.namedtuple("Result", "copied scaled name timing")
 Summary = collections.namedtuple("Summary", "todo copied scaled canceled")
 
 
 def main():
-    size, smooth, source, target, concurrency = handle_commandline()
+    (size, smooth, source, target, concurrency, window, manifest,
+     runStats) = handle_commandline()
     Qtrac.report("starting...")
-    summary = scale(size, smooth, source, target, concurrency)
+    summary = scale(size, smooth, source, target, concurrency, window,
+            manifest, runStats)
+    if manifest is not None:
+        manifest.save()
+    if runStats is not None:
+        runStats.save()
     summarize(summary, concurrency)
 
 
@@ -40,11 +47,25 @@ def handle_commandline():
             default=multiprocessing.cpu_count(),
             help="specify the concurrency (for debugging and "
                 "timing) [default: %(default)d]")
+    parser.add_argument("-w", "--window", type=int, default=0,
+            help="the most images to have queued or being scaled at "
+                "any one time [default: 4 × concurrency]")
     parser.add_argument("-s", "--size", default=400, type=int,
             help="make a scaled image that fits the given dimension "
                 "[default: %(default)d]")
     parser.add_argument("-S", "--smooth", action="store_true",
             help="use smooth scaling (slow but good for text)")
+    parser.add_argument("-i", "--incremental", action="store_true",
+            help="only scale images that are new or changed (or whose "
+                "size or smooth option differs) since the last "
+                "incremental run into the target directory")
+    parser.add_argument("--clean", action="store_true",
+            help="with --incremental, delete target images whose source "
+                "images no longer exist")
+    parser.add_argument("--stats", metavar="FILE",
+            help="write each image's load, scale, and save times and "
+                "sizes, queue wait, per-worker throughput, and latency "
+                "percentiles to FILE as JSON")
     parser.add_argument("source",
             help="the directory containing the original .xpm images")
     parser.add_argument("target",
@@ -56,58 +77,82 @@ def handle_commandline():
         args.error("source and target must be different")
     if not os.path.exists(args.target):
         os.makedirs(target)
-    return args.size, args.smooth, source, target, args.concurrency
-
-
-def scale(size, smooth, source, target, concurrency):
+    manifest = None
+    if args.incremental:
+        manifest = ImageJobs.Manifest(target, (args.size, args.smooth),
+                args.clean)
+    runStats = None
+    if args.stats:
+        runStats = ImageJobs.RunStats(args.stats,
+                os.path.basename(sys.argv[0]), args.concurrency)
+    window = args.window if args.window > 0 else 4 * args.concurrency
+    return (args.size, args.smooth, source, target, args.concurrency,
+            window, manifest, runStats)
+
+
+def scale(size, smooth, source, target, concurrency, window, manifest,
+        runStats):
     futures = set()
+    summary = Summary(0, 0, 0, False)
     with concurrent.futures.ThreadPoolExecutor(
             max_workers=concurrency) as executor:
-        for sourceImage, targetImage in get_jobs(source, target):
-            futures.add(executor.submit(scale_one, size, smooth,
-                    sourceImage, targetImage))
-        summary = wait_for(futures)
-        if summary.canceled:
+        try:
+            for sourceImage, targetImage in ImageJobs.get_jobs(source,
+                    target, manifest):
+                if len(futures) >= window:
+                    summary = wait_for(futures, summary, manifest,
+                            runStats)
+                if runStats is not None:
+                    runStats.submit([(sourceImage, targetImage)])
+                futures.add(executor.submit(scale_one, size, smooth,
+                        sourceImage, targetImage))
+                summary = summary._replace(todo=summary.todo + 1)
+            while futures:
+                summary = wait_for(futures, summary, manifest, runStats)
+        except KeyboardInterrupt:
+            Qtrac.report("canceling...")
+            for future in futures:
+                future.cancel()
             executor.shutdown()
+            summary = summary._replace(canceled=True)
         return summary
-# if we caught the KeyboardInterrupt in this function we'd lose the
-# accumulated todo, copied, scaled counts.
-
-
-def get_jobs(source, target):
-    for name in os.listdir(source):
-        yield os.path.join(source, name), os.path.join(target, name)
-
-
-def wait_for(futures):
-    canceled = False
-    copied = scaled = 0
-    try:
-        for future in concurrent.futures.as_completed(futures):
-            err = future.exception()
-            if err is None:
-                result = future.result()
-                copied += result.copied
-                scaled += result.scaled
-                Qtrac.report("{} {}".format("copied" if result.copied else
-                        "scaled", os.path.basename(result.name)))
-            elif isinstance(err, Image.Error):
-                Qtrac.report(str(err), True)
-            else:
-                raise err # Unanticipated
-    except KeyboardInterrupt:
-        Qtrac.report("canceling...")
-        canceled = True
-        for future in futures:
-            future.cancel()
-    return Summary(len(futures), copied, scaled, canceled)
+
+
+def wait_for(futures, summary, manifest, runStats):
+    """waits for at least one of the futures to finish, removes the
+    finished ones from futures, and returns summary updated with their
+    results"""
+    done, _ = concurrent.futures.wait(futures,
+            return_when=concurrent.futures.FIRST_COMPLETED)
+    copied = summary.copied
+    scaled = summary.scaled
+    for future in done:
+        futures.remove(future)
+        err = future.exception()
+        if err is None:
+            result = future.result()
+            copied += result.copied
+            scaled += result.scaled
+            if manifest is not None:
+                manifest.done(result.name)
+            if runStats is not None:
+                runStats.add(result.timing)
+            Qtrac.report("{} {}".format("copied" if result.copied else
+                    "scaled", os.path.basename(result.name)))
+        elif isinstance(err, Image.Error):
+            Qtrac.report(str(err), True)
+        else:
+            raise err # Unanticipated
+    return summary._replace(copied=copied, scaled=scaled)
 
 
 def scale_one(size, smooth, sourceImage, targetImage):
+    timer = ImageJobs.Timer(targetImage)
     oldImage = Image.from_file(sourceImage)
+    timer.lap("load")
     if oldImage.width <= size and oldImage.height <= size:
-        oldImage.save(targetImage)
-        return Result(1, 0, targetImage)
+        newImage = oldImage
+        copied, scaled = 1, 0
     else:
         if smooth:
             scale = min(size / oldImage.width, size / oldImage.height)
@@ -116,8 +161,13 @@ def scale_one(size, smooth, sourceImage, targetImage):
             stride = int(math.ceil(max(oldImage.width / size,
                                        oldImage.height / size)))
             newImage = oldImage.subsample(stride)
-        newImage.save(targetImage)
-        return Result(0, 1, targetImage)
+        timer.lap("scale")
+        copied, scaled = 0, 1
+    newImage.save(targetImage)
+    timer.lap("save")
+    return Result(copied, scaled, targetImage, timer.record(
+            oldImage.width * oldImage.height, os.path.getsize(sourceImage),
+            os.path.getsize(targetImage)))
 
 
 def summarize(summary, concurrency):
@@ -130,6 +180,8 @@ def summarize(summary, concurrency):
         message += " [canceled]"
     Qtrac.report(message)
     print()
+    if Image.stats():
+        print(Image.format_stats())
 
 
 if __name__ == "__main__":
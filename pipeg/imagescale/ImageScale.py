@@ -11,28 +11,46 @@
 
 import collections
 import concurrent.futures
+import functools
 import multiprocessing
 import os
+import queue
 import sys
+import time
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__),
         ".."))) # For access to parallel Image
-try:
-    import cyImage as Image
-except ImportError:
-    import Image
+import Image # Uses cyImage's backends if available
+import ThumbnailCache
 from Globals import *
 
 
-Result = collections.namedtuple("Result", "name copied scaled")
+Result = collections.namedtuple("Result", "name copied scaled cached")
 
 
-def scale(size, source, target, report_progress, state, when_finished):
+def scale(size, source, target, report_progress, state, when_finished,
+        fractions=None, report_fraction=None, cache=None):
+    """scales the images in source into target; if fractions is given it
+    must be a multiprocessing.Manager().Queue() through which the
+    workers send (targetImage, fraction scaled) pairs that are passed on
+    to report_fraction(); if cache is given it is a
+    ThumbnailCache.ThumbnailCache whose thumbnails are written instead
+    of scaling their sources and to which new ones are added"""
     futures = set()
     with concurrent.futures.ProcessPoolExecutor(
             max_workers=multiprocessing.cpu_count()) as executor:
         for sourceImage, targetImage in get_jobs(source, target):
+            key = None
+            if cache is not None:
+                key, future = from_cache(cache, size, sourceImage,
+                        targetImage)
+                if future is not None:
+                    report_progress(future)
+                    continue
             future = executor.submit(scale_one, size, sourceImage,
-                    targetImage, state)
+                    targetImage, state, fractions)
+            if key is not None:
+                future.add_done_callback(functools.partial(add_to_cache,
+                        cache, key))
             future.add_done_callback(report_progress)
             futures.add(future)
             if state.value in {CANCELED, TERMINATING}:
@@ -40,17 +58,70 @@ def scale(size, source, target, report_progress, state, when_finished):
                     future.cancel()
                 executor.shutdown()
                 break
-        concurrent.futures.wait(futures) # Keep working until finished
+        while futures: # Keep working until finished
+            _, futures = concurrent.futures.wait(futures, timeout=0.05)
+            if fractions is not None and report_fraction is not None:
+                report_fractions(fractions, report_fraction)
+    if cache is not None:
+        cache.save()
     if state.value != TERMINATING:
         when_finished()
 
 
+def open_cache():
+    """returns the user's thumbnail cache or None if it can't be used"""
+    try:
+        return ThumbnailCache.ThumbnailCache()
+    except EnvironmentError:
+        return None
+
+
+def from_cache(cache, size, sourceImage, targetImage):
+    """returns targetImage's cache key (or None if sourceImage can't be
+    read) and if its thumbnail is cached writes it and returns a
+    finished future whose result is the Result, otherwise None"""
+    try:
+        key = cache.key(sourceImage, size, targetImage)
+        data = cache.get(key)
+        if data is None:
+            return key, None
+        with open(targetImage, "wb") as file:
+            file.write(data)
+    except EnvironmentError: # Leave scale_one() to fail or retry
+        return None, None
+    future = concurrent.futures.Future()
+    future.set_result(Result(targetImage, 0, 0, 1))
+    return key, future
+
+
+def add_to_cache(cache, key, future):
+    if not future.cancelled() and future.exception() is None:
+        targetImage = future.result().name
+        try:
+            with open(targetImage, "rb") as file:
+                cache.put(key, file.read())
+        except EnvironmentError:
+            pass # The cache is only an optimization
+
+
+def report_fractions(fractions, report_fraction):
+    latest = {} # Only report the most recent fraction for each image
+    while True:
+        try:
+            targetImage, fraction = fractions.get_nowait()
+            latest[targetImage] = fraction
+        except queue.Empty:
+            break
+    for targetImage, fraction in latest.items():
+        report_fraction(targetImage, fraction)
+
+
 def get_jobs(source, target):
     for name in os.listdir(source):
         yield os.path.join(source, name), os.path.join(target, name)
 
 
-def scale_one(size, sourceImage, targetImage, state):
+def scale_one(size, sourceImage, targetImage, state, fractions=None):
     if state.value in {CANCELED, TERMINATING}:
         raise Canceled()
     oldImage = Image.Image.from_file(sourceImage)
@@ -58,14 +129,39 @@ def scale_one(size, sourceImage, targetImage, state):
         raise Canceled()
     if oldImage.width <= size and oldImage.height <= size:
         oldImage.save(targetImage)
-        return Result(targetImage, 1, 0)
+        return Result(targetImage, 1, 0, 0)
     else:
         scale = min(size / oldImage.width, size / oldImage.height)
-        newImage = oldImage.scale(scale)
-        if state.value in {CANCELED, TERMINATING}:
+        try:
+            newImage = oldImage.scale(scale, progress=make_progress(
+                    targetImage, state, fractions))
+        except Image.Canceled:
             raise Canceled()
         newImage.save(targetImage)
-        return Result(targetImage, 0, 1)
+        return Result(targetImage, 0, 1, 0)
+
+
+def make_progress(targetImage, state, fractions, interval=0.005):
+    """returns a progress callback for Image.Image.scale() that sends
+    the fraction of targetImage scaled to fractions (if not None) and
+    cancels scaling if the user has canceled
+
+    The callback is called every few rows but only does anything (the
+    state and fractions are in the manager process so each access is
+    slow) if at least interval seconds have passed since it last did;
+    this keeps cancellation prompt without slowing scaling.
+    """
+    last = time.monotonic()
+    def progress(done, total):
+        nonlocal last
+        now = time.monotonic()
+        if now - last < interval:
+            return False
+        last = now
+        if fractions is not None and total:
+            fractions.put((targetImage, done / total))
+        return state.value in {CANCELED, TERMINATING}
+    return progress
 
 
 if __name__ == "__main__":
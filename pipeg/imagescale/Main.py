@@ -48,9 +48,12 @@ class Window(ttk.Frame):
         self.statusText.set("Choose or enter folders, then click Scale...")
         self.dimensionText = tk.StringVar()
         self.restore = settings.get_bool(GENERAL, RESTORE, True)
-        self.total = self.copied = self.scaled = 0
+        self.total = self.copied = self.scaled = self.cached = 0
         self.worker = None
-        self.state = multiprocessing.Manager().Value("i", IDLE)
+        self.cache = ImageScale.open_cache()
+        manager = multiprocessing.Manager()
+        self.state = manager.Value("i", IDLE)
+        self.fractions = manager.Queue()
 
 
     def create_ui(self):
@@ -158,7 +161,9 @@ class Window(ttk.Frame):
     def help(self, event=None):
         paras = [
 """Reads all the images in the source directory and produces smoothly
-scaled copies in the target directory."""]
+scaled copies in the target directory.""",
+"""Scaled copies are cached so images that haven't changed since they
+were last scaled to the same size are just copied from the cache."""]
         messagebox.showinfo("Help — {}".format(APPNAME),
                 "\n\n".join([para.replace("\n", " ") for para in paras]),
                 parent=self)
@@ -218,7 +223,7 @@ scaled copies in the target directory."""]
 
 
     def scale(self):
-        self.total = self.copied = self.scaled = 0
+        self.total = self.copied = self.scaled = self.cached = 0
         self.configure(cursor="watch")
         self.statusText.set("Scaling...")
         self.master.update() # Make sure the GUI refreshes
@@ -228,7 +233,8 @@ scaled copies in the target directory."""]
         self.worker = threading.Thread(target=ImageScale.scale, args=(
                 int(self.dimensionText.get()), self.sourceText.get(),
                 target, self.report_progress, self.state,
-                self.when_finished))
+                self.when_finished, self.fractions, self.report_fraction,
+                self.cache))
         self.worker.daemon = True
         self.worker.start() # returns immediately
 
@@ -242,19 +248,32 @@ scaled copies in the target directory."""]
                 result = future.result()
                 self.copied += result.copied
                 self.scaled += result.scaled
+                self.cached += result.cached
                 name = os.path.basename(result.name)
-                self.statusText.set("{} {}".format(
-                        "Copied" if result.copied else "Scaled", name))
+                self.statusText.set("{} {}".format("Copied" if
+                        result.copied else "Scaled" if result.scaled else
+                        "Cached", name))
                 self.master.update() # Make sure the GUI refreshes
 
 
+    def report_fraction(self, name, fraction):
+        if self.state.value in {CANCELED, TERMINATING}:
+            return
+        with ReportLock:
+            self.statusText.set("Scaling {} {:.0%}".format(
+                    os.path.basename(name), fraction))
+            self.master.update() # Make sure the GUI refreshes
+
+
     # Must only be called by the single worker thread when it has finished
     def when_finished(self):
         self.state.value = IDLE
         self.configure(cursor="arrow")
         self.update_ui()
         result = "Copied {} Scaled {}".format(self.copied, self.scaled)
-        difference = self.total - (self.copied + self.scaled)
+        if self.cached:
+            result += " Cached {}".format(self.cached)
+        difference = self.total - (self.copied + self.scaled + self.cached)
         if difference: # This will kick in if the user canceled
             result += " Skipped {}".format(difference)
         self.statusText.set(result)